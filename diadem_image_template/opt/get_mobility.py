@@ -9,54 +9,57 @@ check_files
 copy_out_to_out
 copy files to diadem_files
 """
+import copy
 import glob
 import os
 import pathlib
-import shlex
 import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+import time
 import uuid
-import zipfile
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Dict, List, Any
+from typing import Dict, List
 
-import psutil
 import structlog
-import yaml
 
 from utils.build_command_from_yml import build_command
-from utils.change_dictionary import copy_with_changes  # todo: rename
+from utils.change_dictionary import SpecificationError, compile_settings, copy_with_changes  # todo: rename
+from utils.general import save_yaml
 from utils.logging_config import configure_logging
-from utils.subprocess_functions import run_command
-from utils.deposit_functions import setup_working_directory, check_and_extract_deposit_restart, \
-    add_periodic_copies_deposit, create_deposit_restart_zip, handle_deposit_working_dir_cleanup, run_analysis, \
-    append_settings, setup_working_directory_t
+from utils.subprocess_functions import command_limits, limit_errors, run_command, run_commands
+from utils.deposit_functions import check_and_extract_deposit_restart, add_periodic_copies_deposit, \
+    create_deposit_restart_zip, run_analysis, append_settings, deposit_working_directory
 from utils.result import get_result_from
+from utils.plots import plot_renderer
 from utils.context_managers import ChangeDirectory
-from utils.lightforge_functions import set_carrier_type
+from utils.lightforge_functions import merge_mobilities, plan_shards
 from utils.quantumpatch_functions import rename_file
+from utils.stage_graph import Stage, StageGraph, StageError
+from utils.stage_cache import StageCache
+from utils.checkpoint import read_stage_marker, remove_stage_marker, write_stage_marker
+from utils.metrics import StageMetrics, aggregate_metrics
+from utils.core_planner import plan_cores
+from utils.staging import stage_files
+from utils.archive import ArchiveWriter, write_archive
+from utils.file_index import FileIndex
+from utils.artifacts import ArtifactManifest
+from utils.tools import MissingToolsError, tool_registry
+from utils import yaml_io
+from utils.template_bundle import TemplateBundle
 
 debug = False
 opt_tmpl = "/opt/tmpl"
+DIAGNOSTIC_COMPRESSLEVEL = 1  # debug and errorStageOut bundles: fast rather than small
 
 # Create a logger
 configure_logging()
 logger = structlog.get_logger()
 
 
-def modify_yaml_file(destination_path):
-    with open(destination_path, 'r') as fid:
-        deposit_cargs_dict = yaml.safe_load(fid)
-
-    deposit_cargs_dict['machineparams']['ncpu'] = 16
-
-    with open(destination_path, 'w') as fid:
-        yaml.safe_dump(deposit_cargs_dict, fid)
-
 def list_directory_contents(path='.'):
     """
     List the contents of a directory and log it.
@@ -83,11 +86,12 @@ def list_installed_micromamba_packages():
         raise
 
 
-def check_required_output_files_exist(filepaths, description="file"):
+def check_required_output_files_exist(filepaths, description="file", index=None):
     """
     Check if a file or list of files exists in the current working directory and log a critical error if any are missing.
     Raise a FileNotFoundError if any file is not found.
     Treat filenames with wildcards (e.g., "Delta_*.png") by finding all files that match the pattern.
+    index (FileIndex): index of the current working directory to match against instead of globbing.
     """
     if isinstance(filepaths, (str, pathlib.Path)):
         filepaths = [filepaths]
@@ -96,7 +100,7 @@ def check_required_output_files_exist(filepaths, description="file"):
     missing_files = []
 
     for pattern in filepaths:
-        matched_files = glob.glob(str(cwd / pattern))
+        matched_files = index.glob(str(pattern)) if index else glob.glob(str(cwd / pattern))
         if not matched_files:
             missing_files.append(str(pattern))
 
@@ -106,13 +110,15 @@ def check_required_output_files_exist(filepaths, description="file"):
             f"Required {description}(s) missing in current working directory: {', '.join(missing_files)}")
 
 
-def create_output_directory_and_copy_files(required_files, output_dir='out'):
+def create_output_directory_and_copy_files(required_files, output_dir='out', index=None):
     """
     Create an output directory and copy the required files into it.
+    The copies are reflinks where the filesystem supports them, see utils.staging.
 
     Parameters:
     required_files (list): List of file paths to be copied, with support for wildcards.
     output_dir (str): Name of the output directory.
+    index (FileIndex): index of the current working directory to match against instead of globbing.
     """
     # Create the output directory using pathlib
     output_dir_path = pathlib.Path(output_dir)
@@ -121,32 +127,33 @@ def create_output_directory_and_copy_files(required_files, output_dir='out'):
     # Copy the required files to the output directory
     for pattern in required_files:
         # Expand the wildcard pattern to match files
-        matched_files = glob.glob(pattern)
+        matched_files = index.glob(pattern) if index else glob.glob(pattern)
         if not matched_files:
             logger.critical(f"No files matched the pattern: {pattern}")
             raise FileNotFoundError(f"No files matched the pattern: {pattern}")
-        for file in matched_files:
-            file_path = pathlib.Path(file)
-            shutil.copy(file_path, output_dir_path)
+        stage_files(matched_files, output_dir_path)
 
     # Return the absolute path of the output directory
     return str(output_dir_path.resolve())
 
 
-def fetch_output_from_previous_executable(previous_executable, sub_dir='out'):
+def fetch_output_from_previous_executable(previous_executable, sub_dir='out', writable=()):
     """
-    Copy files from the previous executable's output directory to the current working directory.
+    Stage the files of the previous executable's output directory into the current working directory.
+    The files are read-only hardlinks where possible, see utils.staging.
 
     Parameters:
     previous_executable (str): Name of the previous executable directory.
     sub_dir (str): Subdirectory inside the previous executable's directory to copy files from.
+    writable (list): Names of the files the current executable modifies in place. They get an own copy.
     """
     prev_output_dir = pathlib.Path('../') / previous_executable / sub_dir
     current_dir = pathlib.Path.cwd()
 
-    for file in prev_output_dir.iterdir():
-        if file.is_file():
-            shutil.copy(file, current_dir)
+    files = [file for file in prev_output_dir.iterdir() if file.is_file()]
+    methods = stage_files([file for file in files if file.name not in writable], current_dir, read_only=True)
+    methods += stage_files([file for file in files if file.name in writable], current_dir)
+    logger.info(f"Fetched {len(files)} files from {prev_output_dir}", **methods)
 
 
 def generate_hostfile(num_cores: int, output_file: str):
@@ -168,7 +175,7 @@ def generate_hostfile(num_cores: int, output_file: str):
 
 def find_executable_path(executable_name):
     """
-    Find the path of an executable by its name.
+    Find the path of an executable by its name. The paths are resolved once, see utils.tools.
 
     Parameters:
     executable_name (str): The name of the executable to find.
@@ -179,15 +186,7 @@ def find_executable_path(executable_name):
     Raises:
     FileNotFoundError: If the executable is not found.
     """
-    try:
-        result = subprocess.run(['which', executable_name], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                encoding='utf8')
-        executable_path = result.stdout.strip()
-        logger.info(f"Found {executable_name} at {executable_path}")
-        return executable_path
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to find {executable_name}", error=str(e))
-        raise FileNotFoundError(f"{executable_name} not found") from e
+    return tool_registry.path(executable_name)
 
 
 class Executable(Enum):
@@ -205,7 +204,8 @@ class Executable(Enum):
 class WorkflowConfig:
     """
     data associated with every Executable is all here.
-    By default, the data is constructed from files in: /opt/tmpl/<Executable.value>/
+    By default, the data is constructed from files in: /opt/tmpl/<Executable.value>/, read from the template bundle
+    of the image (see utils.template_bundle).
     """
     required_files: Dict[Executable, List[str]] = field(default_factory=dict)
     files: Dict[Executable, List[str]] = field(default_factory=dict)
@@ -216,92 +216,87 @@ class WorkflowConfig:
 
     @classmethod
     def from_files(cls, tmpl_folder: str):
-        required_files = cls._read_txt_files(tmpl_folder, 'required_files.txt')
-        files = cls._read_txt_files(tmpl_folder, 'files.txt')
+        return cls.from_bundle(TemplateBundle.load(tmpl_folder))
+
+    @classmethod
+    def from_bundle(cls, templates: TemplateBundle):
+        def lists(file_name):
+            return {executable: templates.lines(f'{executable.value}/{file_name}') for executable in Executable}
+
         operationaFiles = 'operationFiles'
-        debugFiles = cls._read_txt_files(tmpl_folder, f'{operationaFiles}/debugFiles')
-        errorStageOut = cls._read_txt_files(tmpl_folder, f'{operationaFiles}/errorStageout')
-        optionalFiles = cls._read_txt_files(tmpl_folder, f'{operationaFiles}/optionalFiles')
-        result = cls._read_yaml_files(tmpl_folder, 'result.yml')
-        return cls(required_files=required_files, files=files, debugFiles=debugFiles, errorStageOut=errorStageOut,
-                   optionalFiles=optionalFiles, result=result)
-
-    @staticmethod
-    def _read_txt_files(base_directory: str, file_name: str) -> Dict[Executable, List[str]]:
-        files_dict = {}
-        for executable in Executable:
-            file_path = pathlib.Path(base_directory) / executable.value / file_name
-            if file_path.is_file():
-                with open(file_path, 'r') as file:
-                    files_dict[executable] = [line.strip() for line in file.readlines()]
-            else:
-                files_dict[executable] = []
-        return files_dict
-
-    @staticmethod
-    def _read_yaml_files(base_directory: str, file_name: str) -> Dict[Executable, Dict[str, Any]]:
-        yaml_dict = {}
-        for executable in Executable:
-            yaml_path = pathlib.Path(base_directory) / executable.value / file_name
-            if yaml_path.is_file():
-                with open(yaml_path, 'r') as file:
-                    yaml_dict[executable] = yaml.safe_load(file)
-            else:
-                yaml_dict[executable] = {}
-        return yaml_dict
-
-
-def zip_files_or_file_patterns(debug_files, output_zip_path):
-    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for file_pattern in debug_files:
-            for file in glob.glob(file_pattern, recursive=True):
-                if os.path.isfile(file):
-                    zipf.write(file, os.path.relpath(file, start=os.path.dirname(file_pattern)))
-                elif os.path.isdir(file):
-                    for root, dirs, files in os.walk(file):
-                        for file_name in files:
-                            file_path = os.path.join(root, file_name)
-                            zipf.write(file_path, os.path.relpath(file_path, start=os.path.dirname(file_pattern)))
-    return output_zip_path
-
-
-def distribute_files(executable, wf_config: WorkflowConfig, diadem_files_output_dir, debug=False, error_happened=False):
+        result = {executable: templates.document(f'{executable.value}/result.yml')
+                  if f'{executable.value}/result.yml' in templates else {} for executable in Executable}
+        return cls(required_files=lists('required_files.txt'), files=lists('files.txt'),
+                   debugFiles=lists(f'{operationaFiles}/debugFiles'),
+                   errorStageOut=lists(f'{operationaFiles}/errorStageout'),
+                   optionalFiles=lists(f'{operationaFiles}/optionalFiles'), result=result)
+
+
+def zip_files_or_file_patterns(debug_files, output_zip_path, compresslevel=None, index=None, max_workers=None):
+    """
+    Zip the files matching the patterns, directories recursively. The members are compressed in parallel,
+    see utils.archive.
+    index (FileIndex): index of the current working directory to match against instead of globbing.
+    max_workers (int): number of compressing threads, the cores of the stage.
+    """
+    index = index or FileIndex('.')
+    members = []
+    for file_pattern in debug_files:
+        for file in index.glob(file_pattern, recursive=True):
+            if os.path.isfile(file):
+                members.append((file, os.path.relpath(file, start=os.path.dirname(file_pattern))))
+            elif os.path.isdir(file):
+                for file_path in index.files_under(file):
+                    members.append((file_path, os.path.relpath(file_path, start=os.path.dirname(file_pattern))))
+    return write_archive(members, output_zip_path, compresslevel=compresslevel, max_workers=max_workers)
+
+
+def distribute_files(executable, wf_config: WorkflowConfig, diadem_files_output_dir, debug=False, error_happened=False,
+                     n_cpus=None):
     """
     Required files are the files required for the next step of the workflow.
     They go to out folder and later copied over to the simulation folder of the next woorkflow step.
     Other type of files are specified in the DIADEM documentation.
+    n_cpus: cores of the stage, used to compress the zips.
     """
+    # one scan of the simulation folder for all kinds of files below
+    index = FileIndex('.')
+
+    # Process errorStageOut files (zip one level higher), first: the output of a failed stage may be incomplete,
+    # which fails the copies below.
+    if error_happened:
+        error_stageOut_files = wf_config.errorStageOut.get(executable)
+        if error_stageOut_files:
+            zip_files_or_file_patterns(error_stageOut_files, f'../{executable.value}_errorStageOut.zip',
+                                       compresslevel=DIAGNOSTIC_COMPRESSLEVEL, index=index, max_workers=n_cpus)
+
     # Process required files (copy to output directory)
     required_files = wf_config.required_files.get(executable)
     if required_files:
         if not error_happened:
-            check_required_output_files_exist(required_files)
-        create_output_directory_and_copy_files(required_files, 'out')
+            check_required_output_files_exist(required_files, index=index)
+        create_output_directory_and_copy_files(required_files, 'out', index=index)
 
     # Process diadem files (copy to output directory)
     # diadem files are simply "files" in terms of DIADEM.
-    diadem_files = wf_config.files.get(executable)
+    diadem_files = [file for file in wf_config.files.get(executable) if file not in deferred_files.get(executable, ())]
     if diadem_files:
         if not error_happened:
-            check_required_output_files_exist(diadem_files)
-        create_output_directory_and_copy_files(diadem_files, diadem_files_output_dir)
+            check_required_output_files_exist(diadem_files, index=index)
+        create_output_directory_and_copy_files(diadem_files, diadem_files_output_dir, index=index)
     # Process debug files (zip one level higher)
     if debug:
         debug_files = wf_config.debugFiles.get(executable)
         if debug_files:
-            check_required_output_files_exist(debug_files)
-            zip_files_or_file_patterns(debug_files, f'../{executable.value}_debugFiles.zip')
+            check_required_output_files_exist(debug_files, index=index)
+            zip_files_or_file_patterns(debug_files, f'../{executable.value}_debugFiles.zip',
+                                       compresslevel=DIAGNOSTIC_COMPRESSLEVEL, index=index, max_workers=n_cpus)
 
     # Process optional files (zip one level higher)
     optional_files = wf_config.optionalFiles.get(executable)
     if optional_files:
-        zip_files_or_file_patterns(optional_files, f'../{executable.value}_optionalFiles.zip')
-
-    # Process errorStageOut files (zip one level higher)
-    if error_happened:
-        error_stageOut_files = wf_config.errorStageOut.get(executable)
-        if error_stageOut_files:
-            zip_files_or_file_patterns(error_stageOut_files, f'../{executable.value}_errorStageOut.zip')
+        zip_files_or_file_patterns(optional_files, f'../{executable.value}_optionalFiles.zip', index=index,
+                                   max_workers=n_cpus)
 
 
 ########################################################################################################################
@@ -323,16 +318,14 @@ if debug:
     logger.info("HOSTFILE", HOSTFILE=os.environ.get('HOSTFILE'))
 
 try:
-    with open("molecule.yml", 'rt') as infile:
-        moldict = yaml.safe_load(infile)
+    moldict = yaml_io.load("molecule.yml")
     logger.info("Loaded molecule.yml", molecule=moldict)
 except Exception as e:
     logger.error("Failed to load molecule.yml", error=str(e))
     raise
 
 try:
-    with open("calculator.yml", 'rt') as infile:
-        calcdict = yaml.safe_load(infile)
+    calcdict = yaml_io.load("calculator.yml")
     logger.info("Loaded calculator.yml", calculator=calcdict)
 except Exception as e:
     logger.error("Failed to load calculator.yml", error=str(e))
@@ -342,428 +335,644 @@ except Exception as e:
 provides = calcdict["provides"]
 changes = calcdict['specification']
 global_calc_settings = changes.get(
-    'global')  # contains things which are general to all specifications, in this case to all tools. Like number of cpus.
+    'global', {})  # contains things which are general to all specifications, in this case to all tools. Like number of cpus.
 files = calcdict['files']
 
 inchi = moldict["inchi"]
 inchiKey = moldict["inchiKey"]
 
-wf_config = WorkflowConfig.from_files(opt_tmpl)
-
-for executable in Executable:
-    logger.info(f"Specified files for {executable.value}:")
-    logger.info(required_files={executable.value: list(wf_config.required_files.get(executable))})
-    logger.info(files={executable.value: list(wf_config.files.get(executable))})
-    # logger.info(debugFiles={executable.value: list(wf_config.debugFiles.get(executable))})
-    logger.info(errorStageOut={executable.value: list(wf_config.errorStageOut.get(executable))})
-    logger.info(optionalFiles={executable.value: list(wf_config.optionalFiles.get(executable))})
-    logger.info(result={executable.value: list(wf_config.result.get(executable))})
-
+templates = TemplateBundle.load(opt_tmpl)
+logger.info(f"Templates loaded from {templates.origin}", source_hash=templates.source_hash)
+wf_config = WorkflowConfig.from_bundle(templates)
 
-#####
+folder_name = '.'
+pathlib.Path(folder_name).mkdir(parents=True, exist_ok=True)
+diadem_dir_abs_path = pathlib.Path(folder_name).resolve()
+logger.info(f" Folder to copy specified in the Calculator files will be copied to {diadem_dir_abs_path}.")
 
-"""
-Ensure that the script knows where to locate the files specified in the calculator. Otherwise, it makes no sense to proceed.
-This block performs a critical check to ensure consistency between the files required by the calculator and the files produced by various executables.
+resultdict = {inchiKey: {}}  # result that will be processed by front-end.
 
-The files specified in the calculator must match the BASE names of the files listed in the files.txt files for each executable. This is crucial because:
-1. It establishes a clear relationship between the files and the executables that produce them.
-2. The calculator specifies files by their base names, while the files listed in /opt/tmpl/<Exe>/files.txt include the relative paths from the current executable's directory to the file.
+# core budget, split between concurrent stages. Every stage derives its thread, slot and rank counts from its share.
+ncpus = plan_cores(global_calc_settings.get('ncpus'))
+
+# limits of the tools of a stage, global: {limits: {<Executable.value>: {wall_time_s, inactivity_s}}}. A stage
+# whose tools exceed them fails, see utils.subprocess_functions.
+stage_limits = global_calc_settings.get('limits', {})
+
+# maximal number of shards (field groups x replica groups) a lightforge stage is split into, capped by the cores of
+# the stage. Without it (or with 1) every field and simulation runs in one mpirun. Opt-in: the pooled standard
+# deviation of the shards assumes LIGHTFORGE_STD_DDOF, see utils.lightforge_functions. See run_lightforge.
+lightforge_shards = global_calc_settings.get('lightforge_shards')
+
+
+# Settings templates of the executables in /opt/tmpl/<Executable.value>/. Their resolved version is part of the
+# stage cache key. All of them are merged with the specification before the first stage runs, see stage_settings.
+settings_templates = {
+    Executable.QPPARAMETRIZER: 'parametrizer_settings.yml',
+    Executable.DIHEDRAL_PARAMETRIZER: 'dhp_settings.yml',
+    Executable.DEPOSIT: 'deposit_cargs.yml',
+    Executable.QUANTUMPATCH: 'settings_ng.yml',
+    Executable.LIGHTFORGE_HOLE: 'settings',
+    Executable.LIGHTFORGE_ELECTRON: 'settings',
+}
+
+# Diadem files rendered by the plot renderer (utils.plots) instead of the stage itself. They are copied to the diadem
+# folder once the renderer is done, see below stage_graph.run. A resumed stage whose plots are missing submits them
+# again from its result (replot).
+deferred_files = {
+    Executable.LIGHTFORGE_HOLE: ['hole_mobility_vs_sqrt_field.png'],
+    Executable.LIGHTFORGE_ELECTRON: ['electron_mobility_vs_sqrt_field.png'],
+}
+replot = {
+    Executable.LIGHTFORGE_HOLE: lambda result: get_result_from.lightforge_plot(result, 'hole'),
+    Executable.LIGHTFORGE_ELECTRON: lambda result: get_result_from.lightforge_plot(result, 'electron'),
+}
+
+# Results of cacheable stages are reused across runs if STAGE_CACHE_DIR is set (e.g. to a shared volume).
+stage_cache = StageCache(os.environ['STAGE_CACHE_DIR']) if os.environ.get('STAGE_CACHE_DIR') else None
+tool_version = calcdict.get('image', 'unknown')  # the image pins the versions of all tools.
+
+
+def diadem_files_of(executable):
+    """
+    Diadem files of an executable as found in the current directory.
+    """
+    return [file for pattern in wf_config.files.get(executable) for file in glob.glob(pattern)]
 
-Example:
-If the calculator specifies a file as 'output_file.txt', the corresponding entry in /opt/tmpl/<Exe>/files.txt might be '/path/to/output_file.txt'.
 
-This block compares the sets of files to ensure that:
-1. Every file required by the calculator has a corresponding entry in the files produced by the executables.
-2. Every file listed in the files.txt files has a corresponding entry in the calculator.
+def settings_of(executable):
+    """
+    Copy of the settings template of an executable with the changes of the specification applied.
+    """
+    return copy.deepcopy(stage_settings[executable.value])
 
-If there are discrepancies, the script logs the specific missing or extra files and terminates execution to prevent further errors.
-"""
 
+def stage_cache_key(executable, input_dirs):
+    settings = stage_settings.get(executable.value, {})
+    return stage_cache.key(inchiKey, executable.value, settings, input_dirs, tool_version)
 
-def files_names_with_specified_locations(fls):
-    file_names = []
-    for paths in fls.values():
-        for path in paths:
-            file_name = pathlib.Path(path).name
-            file_names.append(file_name)
-    return file_names
 
+def stage(executable, depends_on=(), inputs=(), cacheable=False):
+    """
+    Decorator turning the body of a workflow step into a Stage: the body runs inside the simulation folder of the
+    executable. On failure, the errorStageOut files are collected before the error is passed on to the stage graph.
+    Stages with a verified completion marker from an earlier run are skipped. Cacheable stages are restored from
+    the stage cache instead of being run, if possible.
+    """
 
-files_from_locations = files_names_with_specified_locations(wf_config.files)
-files_from_calculator = files
+    def decorator(body):
+        def run(n_cpus):
+            try:
+                with ChangeDirectory(executable.value):
+                    input_dirs = [pathlib.Path('..') / dependency.value / 'out' for dependency in depends_on]
+                    completed_result = read_stage_marker(executable.value, input_dirs, diadem_dir_abs_path)
+                    if completed_result is not None:
+                        if not all(os.path.isfile(file) for file in deferred_files.get(executable, ())):
+                            logger.info(f"Rendering the missing plots of {executable.value} again")
+                            replot[executable](completed_result)
+                        return completed_result
+                    remove_stage_marker()
+
+                    with StageMetrics(executable.value, n_cpus), \
+                            command_limits(**stage_limits.get(executable.value, {})):
+                        cache_key = stage_cache_key(executable, input_dirs) if cacheable and stage_cache else None
+                        local_resultdict = stage_cache.restore(executable.value, cache_key, diadem_dir_abs_path) \
+                            if cache_key else None
+                        if local_resultdict is None:
+                            local_resultdict = body(n_cpus)
+                            if cache_key:
+                                stage_cache.store(executable.value, cache_key, diadem_files_of(executable),
+                                                  local_resultdict)
+
+                    diadem_file_names = [pathlib.Path(file).name for file in wf_config.files.get(executable)
+                                         if file not in deferred_files.get(executable, ())]
+                    write_stage_marker(executable.value, local_resultdict, input_dirs, diadem_dir_abs_path,
+                                       diadem_file_names)
+                    return local_resultdict
+            except Exception as e:
+                logger.error(f"An error occurred during {executable.value} processing: {e}")
+                with ChangeDirectory(executable.value):
+                    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, error_happened=True, debug=debug)
+                raise
+
+        return Stage(executable.value, run, depends_on=[dependency.value for dependency in depends_on],
+                     inputs=list(inputs), outputs=wf_config.required_files.get(executable))
+
+    return decorator
+
+
+# Stages of the workflow. inputs are the files fetched from the out folders of the dependencies,
+# outputs are the required_files the stage puts into its own out folder.
+
+@stage(Executable.XTB, cacheable=True)
+def run_xtb(n_cpus):
+    executable = Executable.XTB
+    # 1 .PREOPTIMIZATION WITH NO NM SOFTWARE
+    # we generate a bad 3d structure. Plan below:
+    # mol.inchi -[obabel]-> mol.xyz ->[xtb]-> xtbout.xyz -[obabel]-> input_molecule.mol2
+    mol_inchi = 'mol.inchi'
+    with open(mol_inchi, 'w') as outfile:
+        outfile.write(f"{inchi}\n")
+
+    logger.info("Generate 3D conformer of the molecule . . .")
+    initial_conformer_xyz = 'mol.xyz'
+    command = f"obabel -i inchi {mol_inchi} -o xyz -O {initial_conformer_xyz} --gen3d"
+    run_command(command)
+    check_required_output_files_exist(initial_conformer_xyz)
+
+    # optimize using xtb from xtb, not from parametrizer.
+    # we optimize the bad 3d structure [initial_conformer]
+    logger.info("xtb optimization of 3D conformer of the molecule . . .")
+    os.environ['OMP_NUM_THREADS'] = str(n_cpus)
+    command = f"{executable.value} {initial_conformer_xyz} --opt"  # outputs xtbout.xyz
+    run_command(command)
+    xtb_preoptimized_xyz = 'xtbopt.xyz'
+    required_files = [xtb_preoptimized_xyz]
+    check_required_output_files_exist(required_files)
+
+    logger.info("Transfer xyz to mol2 . . .")
+    xtb_preoprimized_mol2 = 'input_molecule.mol2'
+    command = f"obabel -i xyz {xtb_preoptimized_xyz} -o mol2 -O {xtb_preoprimized_mol2}"
+    run_command(command)
+
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, debug=debug)
+
+
+@stage(Executable.QPPARAMETRIZER, depends_on=[Executable.XTB], inputs=['input_molecule.mol2'], cacheable=True)
+def run_qpparametrizer(n_cpus):
+    executable = Executable.QPPARAMETRIZER
+    fetch_output_from_previous_executable(Executable.XTB.value)
+
+    command = f"{executable.value}"
+    destination_path = pathlib.Path.cwd() / 'parametrizer_settings.yml'  # Current directory
+    copy_with_changes(settings_of(executable), {'DFT Engine': {'Threads': str(n_cpus)}}, destination_path)
+
+    os.environ['OMP_NUM_THREADS'] = str(n_cpus)
+    run_command(command)
+
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, debug=debug)
+
+    # result
+    local_resultdict = wf_config.result.get(executable)
+    get_result_from.QPParametrizer(local_resultdict, 'mol_data.yml')
+    # we save the result locally in QPP folder in case the script will crash on a later stage.
+    yaml_io.save(local_resultdict, "result.yml", safe=False)
+    return local_resultdict
+
+
+@stage(Executable.DIHEDRAL_PARAMETRIZER, depends_on=[Executable.QPPARAMETRIZER],
+       inputs=['output_molecule.mol2', 'molecule.spf', 'molecule.pdb'], cacheable=True)
+def run_dihedral_parametrizer(n_cpus):
+    executable = Executable.DIHEDRAL_PARAMETRIZER
+    # add_dihedral_angles.sh and DihedralParametrizer rewrite the files of QPParametrizer.
+    fetch_output_from_previous_executable(Executable.QPPARAMETRIZER.value,
+                                          writable=['output_molecule.mol2', 'molecule.spf', 'molecule.pdb'])
+
+    # 3.0. Prepare HOSTFILE
+    hostfile_name = os.environ.get('HOSTFILE', 'hostfile.txt')  # it might be set from above.  # todo make through the realpath
+    os.environ['HOSTFILE'] = hostfile_name
+    generate_hostfile(n_cpus, hostfile_name)
+
+    # Add dihedral angles
+    output_molecule_mol2_from_parametrizer = 'output_molecule.mol2'
+    molecule_spf_from_parametrizer = 'molecule.spf'
+
+    command = f"{find_executable_path(ADD_DIHEDRAL_ANGLES)} {output_molecule_mol2_from_parametrizer} {molecule_spf_from_parametrizer}"
+    run_command(command)
+
+    # Zip files
+    command = f"zip report.zip {output_molecule_mol2_from_parametrizer} molecule.pdb {molecule_spf_from_parametrizer}"
+    run_command(command)
+
+    # Append mol_data.yml to output_dict.yml ### artem: why do we need this at all?
+    # command = "cat mol_data.yml >> output_dict.yml"  # I did not want to make this because this is bash-specific.
+
+    # Convert mol2 to svg
+    command = "obabel -imol2 output_molecule.mol2 -osvg"
+    run_command(command, output_file="output_molecule.svg")
+
+    destination_path = './dhp_settings.yml'  # Current directory
+    save_yaml(settings_of(executable), destination_path)
 
-if set(files_from_locations) != set(files_from_calculator):
-    missing_files = set(files_from_calculator) - set(files_from_locations)
-    extra_files = set(files_from_locations) - set(files_from_calculator)
+    output_molecule_pdb_after_add_dyhedrals = "molecule.pdb"
+    output_molecule_spf_after_add_dyhedrals = "molecule.spf"
+    dhp_settings = "dhp_settings.yml"
 
-    logger.critical(f"The calculator needs to know where to look for the following files: {files_from_calculator}. "
-                    f"However, paths are only specified for the following files: {files_from_locations}. ")
+    required_files = [output_molecule_pdb_after_add_dyhedrals, output_molecule_spf_after_add_dyhedrals,
+                      dhp_settings]
+    check_required_output_files_exist(required_files)
+
+    executable_path = find_executable_path(executable.value)
+
+    # Run DihedralParametrizer with MPI
+    os.environ['OMP_NUM_THREADS'] = '1'
+    command = f"mpirun --bind-to none $NMMPIARGS $ENVCOMMAND --hostfile $HOSTFILE --mca btl self,vader,tcp python -m mpi4py {executable_path} ./dhp_settings.yml"
+    run_command(command, use_shell=True)
+
+    molecule_pdb_from_DHP_as_generated = 'molecule.pdb'
+    molecule_spf_from_DHP_as_generated = 'dihedral_forcefield.spf'
+    required_files = [molecule_pdb_from_DHP_as_generated, molecule_spf_from_DHP_as_generated]
+    check_required_output_files_exist(required_files)
 
-    if missing_files:
-        logger.critical(
-            f"Missing files that are specified in the calculator but not in the file locations: {missing_files}")
+    molecule_pdb_from_DHP = 'molecule_0.pdb'  # names recognized by Deposit as in WANO. Do not want to use others here.
+    molecule_spf_from_DHP = 'molecule_0.spf'
+    shutil.move(molecule_pdb_from_DHP_as_generated, molecule_pdb_from_DHP)
+    shutil.move(molecule_spf_from_DHP_as_generated, molecule_spf_from_DHP)
 
-    if extra_files:
-        logger.critical(f"Extra files that have paths specified but are not required by the calculator: {extra_files}")
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, debug=debug)
+
+    # no result to go into result.yml
 
-    sys.exit("Exiting due to mismatched files.")
-else:
-    logger.info("Sanity Check Successful: The Calculator knows paths to the [diadem] files that have to be returned.")
 
-# <--
+@stage(Executable.DEPOSIT, depends_on=[Executable.DIHEDRAL_PARAMETRIZER], inputs=['molecule_0.pdb', 'molecule_0.spf'],
+       cacheable=True)
+def run_deposit(n_cpus):
+    executable = Executable.DEPOSIT
+    fetch_output_from_previous_executable(Executable.DIHEDRAL_PARAMETRIZER.value)
 
+    destination_path = pathlib.Path.cwd() / 'deposit_cargs.yml'  # command line args of Deposit as dictionary
+    deposit_cargs = settings_of(executable)
+    deposit_cargs['machineparams']['ncpu'] = n_cpus
+    save_yaml(deposit_cargs, destination_path)
 
-folder_name = '.'
-pathlib.Path(folder_name).mkdir(parents=True, exist_ok=True)
-diadem_dir_abs_path = pathlib.Path(folder_name).resolve()
-logger.info(f" Folder to copy specified in the Calculator files will be copied to {diadem_dir_abs_path}.")
+    # Generate a UUID in Python
+    # todo: do we need to cd and so on??? for consistency??
+    # todo: what happens for Deposit: not only we create Deposit direcory and make sims there, we also create or use some kind of SCRATCH directory, which will not be there on Azure. Resolve?
+    generated_uuid = str(uuid.uuid4())
+    logger.info(f"Generated UUID: {generated_uuid}")
 
-resultdict = {inchiKey: {}}  # result that will be processed by front-end.
+    # Set necessary environment variables
+    env_vars = os.environ.copy()
+    env_vars['GENERATED_UUID'] = generated_uuid
 
-logger.info(" ================================= Workflow starts . . . ================================================")
+    # script_path = 'deposit_init.sh'  # the way deposit run is different
+    # run_shell_script(script_path, env_vars)
 
-# 0. ######################
-executable = Executable.XTB
-###########################
+    # deposit_init commands -->
+    # this will hardlink things from the current to the working dir and change to it silently!! Afterwards, also
+    # if a command fails, new and changed files are moved from work to data (current dir), log files are dropped.
+    with deposit_working_directory("deposit_scratch"):
+        check_and_extract_deposit_restart()  # not used at the moment. left to allow for script extension.
 
-try:
-    with ChangeDirectory(executable.value):
-        # 1 .PREOPTIMIZATION WITH NO NM SOFTWARE
-        # we generate a bad 3d structure. Plan below:
-        # mol.inchi -[obabel]-> mol.xyz ->[xtb]-> xtbout.xyz -[obabel]-> input_molecule.mol2
-        mol_inchi = 'mol.inchi'
-        with open(mol_inchi, 'w') as outfile:
-            outfile.write(f"{inchi}\n")
-
-        logger.info("Generate 3D conformer of the molecule . . .")
-        initial_conformer_xyz = 'mol.xyz'
-        command = f"obabel -i inchi {mol_inchi} -o xyz -O {initial_conformer_xyz} --gen3d"
+        command = build_command(destination_path)  # this is the Deposit commands with appropriate command line args
         run_command(command)
-        required_files = [initial_conformer_xyz]
-        check_required_output_files_exist(initial_conformer_xyz)
 
-        # optimize using xtb from xtb, not from parametrizer.
-        # we optimize the bad 3d structure [initial_conformer]
-        logger.info("xtb optimization of 3D conformer of the molecule . . .")
-        command = f"{executable.value} {initial_conformer_xyz} --opt"  # outputs xtbout.xyz
-        run_command(command)
-        xtb_preoptimized_xyz = 'xtbopt.xyz'
-        required_files = [xtb_preoptimized_xyz]
+        required_files = ['structure.cml']
         check_required_output_files_exist(required_files)
 
-        logger.info("Transfer xyz to mol2 . . .")
-        xtb_preoprimized_mol2 = 'input_molecule.mol2'
-        command = f"obabel -i xyz {xtb_preoptimized_xyz} -o mol2 -O {xtb_preoprimized_mol2}"
+        command = "obabel -i cml structure.cml -o mol2 -O structure.mol2"
         run_command(command)
 
-        distribute_files(executable, wf_config, diadem_dir_abs_path, debug=debug)
-except Exception as e:
-    logger.error(f"An error occurred during {executable.value} processing: {e}")
-    distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
-    sys.exit(1)
+        add_periodic_copies_deposit()
+        create_deposit_restart_zip()
+    run_analysis()
+    append_settings()
+    #
+    # <-- deposit_init commands
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, debug=debug)
 
-# 1 -> 2
-previous_executable = executable  #
+    # result -->
+    local_resultdict = wf_config.result.get(executable)
+    get_result_from.Deposit(local_resultdict, 'DensityAnalysis.out')
+    yaml_io.save(local_resultdict, "result.yml", safe=False)
+    # <-- result
+    return local_resultdict
 
-# 2 ##################################
-executable = executable.QPPARAMETRIZER
-######################################
 
+@stage(Executable.QUANTUMPATCH, depends_on=[Executable.DEPOSIT], inputs=['structurePBC.cml'])
+def run_quantumpatch(n_cpus):
+    executable = Executable.QUANTUMPATCH
+    fetch_output_from_previous_executable(Executable.DEPOSIT.value)
 
-try:
-    with ChangeDirectory(executable.value):
-        # todo: copy the output directory may be a part of the context manager?
+    destination_path = pathlib.Path.cwd() / 'settings_ng.yml'
+    save_yaml(settings_of(executable), destination_path)
 
-        fetch_output_from_previous_executable(previous_executable.value)
+    if 'SCRATCH' not in os.environ:
+        # Generate a random directory inside the current directory which will serve as a SCRATCH
+        current_dir = os.getcwd()
+        scratch_dir = os.path.join(current_dir, "qp_scratch_" + next(tempfile._get_candidate_names()))
+        # Ensure the directory exists
+        os.makedirs(scratch_dir, exist_ok=True)
+        # Set the SCRATCH environment variable
+        os.environ['SCRATCH'] = scratch_dir
 
-        command = f"{executable.value}"
-        source_path = f'{opt_tmpl}/{executable.value}/parametrizer_settings.yml'  # template has the name of the executable
-        destination_path = pathlib.Path.cwd() / 'parametrizer_settings.yml'  # Current directory
-        copy_with_changes(source_path, changes[executable.value], destination_path)
+    logger.info(f"SCRATCH for QuantumPatch is set to: {os.environ['SCRATCH']}")
 
-        run_command(command)
+    # 5.1. RUN QP
+    # the only necessary input for QP: structure or structurePBC is in the current folder.
+    executable_path = find_executable_path(executable.value)
 
-        distribute_files(executable, wf_config, diadem_dir_abs_path, debug=debug)
+    os.environ['OMP_NUM_THREADS'] = '1'
 
-        # result
-        local_resultdict = wf_config.result.get(executable)
-        get_result_from.QPParametrizer(local_resultdict, 'mol_data.yml')
-        resultdict[inchiKey].update(local_resultdict)
-        with open("result.yml", 'wt') as outfile:
-            yaml.dump(local_resultdict,
-                      outfile)  # we save the result locally in QPP folder in case the script will crash on a later stage.
-except Exception as e:
-    logger.error(f"An error occurred during {executable.value} processing: {e}")
-    distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
-    sys.exit(1)
+    command = f'mpirun --bind-to none -np {n_cpus} $NMMPIARGS $ENVCOMMAND --mca btl self,vader,tcp python -m mpi4py {executable_path}'
+    run_command(command, use_shell=True)
 
-# 2->3
-previous_executable = executable
+    required_files = ['Analysis/files_for_kmc/files_for_kmc.zip']  # todo maybe check individual files.
+    check_required_output_files_exist(required_files)
 
-# 3. ########################################
-executable = Executable.DIHEDRAL_PARAMETRIZER
-#############################################
+    # 5.2. Prepare input for LF
+    # The whole Analysis folder is the input of lightforge. Compressed members like files_for_kmc.zip are stored as
+    # they are.
+    directory_to_zip = "Analysis"
+    zipped_analysis_folder = "QP_output_0.zip"
 
+    # Create a zip from Analysis of QP.
+    with ArchiveWriter(zipped_analysis_folder, max_workers=n_cpus) as archive:
+        # Walk through the directory
+        for root, dirs, files in os.walk(directory_to_zip):
+            for file in files:
+                # Create the complete filepath of the file in the zip
+                file_path = os.path.join(root, file)
+                # Add the file to the zip file, preserving the directory structure
+                archive.add(file_path, os.path.relpath(file_path, directory_to_zip))
 
-try:
-    with ChangeDirectory(executable.value):
-        fetch_output_from_previous_executable(previous_executable.value)
-
-        # 3.0. Prepare HOSTFILE
-        all_avail_physical_cpus = psutil.cpu_count(logical=False)
-        numcpus = global_calc_settings.get('ncpus', all_avail_physical_cpus)
-        hostfile_name = os.environ.get('HOSTFILE', 'hostfile.txt')  # it might be set from above.  # todo make through the realpath
-        os.environ['HOSTFILE'] = hostfile_name
-        generate_hostfile(numcpus, hostfile_name)
-
-        # Ensure DEPTOOLS is set in the environment todo needed?
-        dep_tools = os.environ.get('DEPTOOLS')
-        if not dep_tools:
-            logger.error("DEPTOOLS environment variable is not set")
-            raise EnvironmentError("DEPTOOLS environment variable is not set")
-
-        # Add dihedral angles
-        output_molecule_mol2_from_parametrizer = 'output_molecule.mol2'
-        molecule_spf_from_parametrizer = 'molecule.spf'
-
-        command = f"{dep_tools}/add_dihedral_angles.sh {output_molecule_mol2_from_parametrizer} {molecule_spf_from_parametrizer}"
-        run_command(command)
+    logger.info(
+        f"Directory '{directory_to_zip}' zipped into '{zipped_analysis_folder}' successfully. This will be the LF input.")
 
-        # Zip files
-        command = f"zip report.zip {output_molecule_mol2_from_parametrizer} molecule.pdb {molecule_spf_from_parametrizer}"
-        run_command(command)
+    # workaround deltaE_*.png --> deltaE.png:
+    rename_file('Analysis/energy/DeltaE*.png', 'DeltaE.png')
 
-        # Append mol_data.yml to output_dict.yml ### artem: why do we need this at all?
-        # command = "cat mol_data.yml >> output_dict.yml"  # I did not want to make this because this is bash-specific.
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus, debug=debug)
 
-        # Convert mol2 to svg
-        command = "obabel -imol2 output_molecule.mol2 -osvg"
-        run_command(command, output_file="output_molecule.svg")
 
-        source_path = f'{opt_tmpl}/DihedralParametrizer/dhp_settings.yml'
-        destination_path = './dhp_settings.yml'  # Current directory
+LIGHTFORGE_MOBILITIES = 'results/experiments/current_characteristics/mobilities_all_fields.dat'
+SHARD_LOG_PATTERNS = ('logs', '*.stderr', 'Trace*')  # the logs and errorStageout patterns of lightforge
 
-        copy_with_changes(source_path, changes["DihedralParametrizer"], destination_path)
 
-        output_molecule_pdb_after_add_dyhedrals = "molecule.pdb"
-        output_molecule_spf_after_add_dyhedrals = "molecule.spf"
-        dhp_settings = "dhp_settings.yml"
+def run_lightforge_shards(shards, command):
+    """
+    Run the shards of a lightforge experiment concurrently, each in shards/<name> with the inputs of the stage, and
+    merge their mobilities into LIGHTFORGE_MOBILITIES. The logs of the shards go to logs/<name>, see
+    collect_shard_logs.
+    command: lightforge command line with a placeholder {n_cpus}.
+    """
+    input_files = [path for path in pathlib.Path('.').iterdir() if path.is_file() and path.name != 'settings']
+    shutil.rmtree('shards', ignore_errors=True)  # left over from an interrupted run
+    for shard in shards:
+        shard_dir = pathlib.Path('shards') / shard.name
+        shard_dir.mkdir(parents=True)
+        stage_files(input_files, shard_dir, read_only=True)
+        save_yaml(shard.settings, shard_dir / 'settings')
+    logger.info(f"Running lightforge in {len(shards)} shards",
+                shards={shard.name: {'simulations': shard.simulations, 'n_cpus': shard.n_cpus} for shard in shards})
 
-        required_files = [output_molecule_pdb_after_add_dyhedrals, output_molecule_spf_after_add_dyhedrals,
-                          dhp_settings]
-        check_required_output_files_exist(required_files)
+    try:
+        run_commands([f'cd shards/{shard.name} && {command.format(n_cpus=shard.n_cpus)}' for shard in shards],
+                     use_shell=True)
+    finally:
+        collect_shard_logs(shards)
 
-        executable_path = find_executable_path(executable.value)
+    pathlib.Path(LIGHTFORGE_MOBILITIES).parent.mkdir(parents=True, exist_ok=True)
+    merge_mobilities([(f'shards/{shard.name}/{LIGHTFORGE_MOBILITIES}', shard.simulations) for shard in shards],
+                     LIGHTFORGE_MOBILITIES)
 
-        # Run DihedralParametrizer with MPI
-        command = f"mpirun --bind-to none $NMMPIARGS $ENVCOMMAND --hostfile $HOSTFILE --mca btl self,vader,tcp python -m mpi4py {executable_path} ./dhp_settings.yml"
-        run_command(command, use_shell=True)
 
-        molecule_pdb_from_DHP_as_generated = 'molecule.pdb'
-        molecule_spf_from_DHP_as_generated = 'dihedral_forcefield.spf'
-        required_files = [molecule_pdb_from_DHP_as_generated, molecule_spf_from_DHP_as_generated]
-        check_required_output_files_exist(required_files)
+def collect_shard_logs(shards):
+    """
+    Move the logs of the shards (SHARD_LOG_PATTERNS) to logs/<name>, where the debugFiles and errorStageout of the
+    stage find them. Also runs if a shard failed.
+    """
+    for shard in shards:
+        shard_dir = pathlib.Path('shards') / shard.name
+        if not shard_dir.is_dir():
+            continue
+        target = pathlib.Path('logs') / shard.name
+        shutil.rmtree(target, ignore_errors=True)
+        target.mkdir(parents=True)
+        for path in shard_dir.iterdir():
+            if any(path.match(pattern) for pattern in SHARD_LOG_PATTERNS):
+                path.rename(target / path.name)
+
+
+def run_lightforge(executable, n_cpus):
+    fetch_output_from_previous_executable(Executable.QUANTUMPATCH.value)
+    fetch_output_from_previous_executable(
+        Executable.DIHEDRAL_PARAMETRIZER.value)  # yes, files from twp previous tools
+
+    destination_path = pathlib.Path.cwd() / 'settings'  # settings specific to hole/electron
+    settings = settings_of(executable)
+    save_yaml(settings, destination_path)
+
+    executable_path = find_executable_path(executable.value.split('_')[0])  # returns simply lightforge for both hole and electron.
+    carrier_type = executable.value.split('_')[1]  # hole or electron
+
+    os.environ['OMP_NUM_THREADS'] = '1'
+    command = f'mpirun -x OMP_NUM_THREADS --bind-to none -n {{n_cpus}} --mca btl self,vader,tcp python -m mpi4py {executable_path} -s settings'
+    # The fields and the simulations of the experiment are independent: shards of them run concurrently, so that
+    # the slowest field does not set the time of the stage.
+    shards = plan_shards(settings, n_cpus, lightforge_shards)
+    if len(shards) == 1:
+        run_command(command.format(n_cpus=n_cpus), use_shell=True)
+    else:
+        run_lightforge_shards(shards, command)
+
+    # result -->
+    local_resultdict = wf_config.result.get(executable)
+    get_result_from.lightforge(local_resultdict, LIGHTFORGE_MOBILITIES, 'settings', hole_or_electron=carrier_type)
+
+    # get_result_from.lightforge submits the plot <hole/electron>_mobility_vs_sqrt_field.png to the plot renderer, it is
+    # copied as file to the front-end after the workflow, see deferred_files.
+    yaml_io.save(local_resultdict, "result.yml", safe=False)  # this dict is inside the lightforge simulation folder.
+    # <-- result
+
+    distribute_files(executable, wf_config, diadem_dir_abs_path, n_cpus=n_cpus)
+    return local_resultdict
+
+
+# lightforge_hole and lightforge_electron only depend on QuantumPatch and DihedralParametrizer and run concurrently.
+@stage(Executable.LIGHTFORGE_HOLE, depends_on=[Executable.QUANTUMPATCH, Executable.DIHEDRAL_PARAMETRIZER],
+       inputs=['QP_output_0.zip', 'molecule_0.pdb'])
+def run_lightforge_hole(n_cpus):
+    return run_lightforge(Executable.LIGHTFORGE_HOLE, n_cpus)
+
+
+@stage(Executable.LIGHTFORGE_ELECTRON, depends_on=[Executable.QUANTUMPATCH, Executable.DIHEDRAL_PARAMETRIZER],
+       inputs=['QP_output_0.zip', 'molecule_0.pdb'])
+def run_lightforge_electron(n_cpus):
+    return run_lightforge(Executable.LIGHTFORGE_ELECTRON, n_cpus)
+
+
+def log_specified_files(executables):
+    for executable in executables:
+        logger.info(f"Specified files for {executable.value}:")
+        logger.info(required_files={executable.value: list(wf_config.required_files.get(executable))})
+        logger.info(files={executable.value: list(wf_config.files.get(executable))})
+        # logger.info(debugFiles={executable.value: list(wf_config.debugFiles.get(executable))})
+        logger.info(errorStageOut={executable.value: list(wf_config.errorStageOut.get(executable))})
+        logger.info(optionalFiles={executable.value: list(wf_config.optionalFiles.get(executable))})
+        logger.info(result={executable.value: list(wf_config.result.get(executable))})
 
-        molecule_pdb_from_DHP = 'molecule_0.pdb'  # names recognized by Deposit as in WANO. Do not want to use others here.
-        molecule_spf_from_DHP = 'molecule_0.spf'
-        shutil.move(molecule_pdb_from_DHP_as_generated, molecule_pdb_from_DHP)
-        shutil.move(molecule_spf_from_DHP_as_generated, molecule_spf_from_DHP)
 
-        distribute_files(executable, wf_config, diadem_dir_abs_path, debug=debug)
+#####
 
-        # no result to go into result.yml
-except Exception as e:
-    logger.error(f"An error occurred during {executable.value} processing: {e}")
-    distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
-    sys.exit(1)
+"""
+Ensure that the script knows where to locate the files specified in the calculator. Otherwise, it makes no sense to proceed.
+This block performs a critical check to ensure consistency between the files required by the calculator and the files produced by various executables.
 
-# 3->4
-previous_executable = executable
+The files specified in the calculator must match the BASE names of the files listed in the files.txt files for each executable. This is crucial because:
+1. It establishes a clear relationship between the files and the executables that produce them.
+2. The calculator specifies files by their base names, while the files listed in /opt/tmpl/<Exe>/files.txt include the relative paths from the current executable's directory to the file.
 
-# 4.###########################
-executable = Executable.DEPOSIT
-###############################
+Example:
+If the calculator specifies a file as 'output_file.txt', the corresponding entry in /opt/tmpl/<Exe>/files.txt might be '/path/to/output_file.txt'.
 
-try:
-    with ChangeDirectory(executable.value):
-        fetch_output_from_previous_executable(previous_executable.value)
+This block compares the sets of files to ensure that:
+1. Every file required by the calculator has a corresponding entry in the files produced by the executables.
+2. Every file listed in the files.txt files has a corresponding entry in the calculator.
 
-        source_path = f'{opt_tmpl}/{executable.value}/deposit_cargs.yml'  # command line args of Deposit as dictionary
-        destination_path = pathlib.Path.cwd() / 'deposit_cargs.yml'
+If there are discrepancies, the script logs the specific missing or extra files and terminates execution to prevent further errors.
+"""
 
-        copy_with_changes(source_path, changes[executable.value], destination_path)
 
-        # ad hoc --> SET N_PROC TO 16!
-        modify_yaml_file(destination_path)
-        # <-- ad hoc
+def files_names_with_specified_locations(fls):
+    file_names = []
+    for paths in fls.values():
+        for path in paths:
+            file_name = pathlib.Path(path).name
+            file_names.append(file_name)
+    return file_names
 
 
-        # Generate a UUID in Python
-        # todo: do we need to cd and so on??? for consistency??
-        # todo: what happens for Deposit: not only we create Deposit direcory and make sims there, we also create or use some kind of SCRATCH directory, which will not be there on Azure. Resolve?
-        generated_uuid = str(uuid.uuid4())
-        logger.info(f"Generated UUID: {generated_uuid}")
+def check_calculator_files(executables):
+    """
+    Compare the calculator files with the files of the executables that will run. Files of executables that do not
+    run (because of start_from or stop_after) are allowed in the calculator but will not be returned.
+    """
+    files_from_locations = files_names_with_specified_locations(wf_config.files)
+    files_from_running_executables = files_names_with_specified_locations(
+        {executable: wf_config.files.get(executable) for executable in executables})
+    files_from_calculator = files
 
-        # Set necessary environment variables
-        env_vars = os.environ.copy()
-        env_vars['GENERATED_UUID'] = generated_uuid
+    missing_files = set(files_from_calculator) - set(files_from_locations)
+    extra_files = set(files_from_running_executables) - set(files_from_calculator)
+    if missing_files or extra_files:
+        logger.critical(f"The calculator needs to know where to look for the following files: {files_from_calculator}. "
+                        f"However, paths are only specified for the following files: {files_from_running_executables}. ")
 
-        # script_path = 'deposit_init.sh'  # the way deposit run is different
-        # run_shell_script(script_path, env_vars)
+        if missing_files:
+            logger.critical(
+                f"Missing files that are specified in the calculator but not in the file locations: {missing_files}")
 
-        # deposit_init commands -->
-        current_dir, working_dir = setup_working_directory_t("deposit_scratch")  # this will copy things from the current to the working dir and change to it silently!!
-        check_and_extract_deposit_restart()  # not used at the moment. left to allow for script extension.
+        if extra_files:
+            logger.critical(f"Extra files that have paths specified but are not required by the calculator: {extra_files}")
 
-        command = build_command(destination_path)  # this is the Deposit commands with appropriate command line args
-        run_command(command)
+        sys.exit("Exiting due to mismatched files.")
 
-        required_files = ['structure.cml']
-        check_required_output_files_exist(required_files)
+    not_produced_files = set(files_from_calculator) - set(files_from_running_executables)
+    if not_produced_files:
+        logger.warning(f"Files of executables that do not run in this partial workflow will not be returned: "
+                       f"{not_produced_files}")
+    logger.info("Sanity Check Successful: The Calculator knows paths to the [diadem] files that have to be returned.")
 
-        command = "obabel -i cml structure.cml -o mol2 -O structure.mol2"
-        run_command(command)
+# <--
 
-        add_periodic_copies_deposit()
-        create_deposit_restart_zip()
-        handle_deposit_working_dir_cleanup(current_dir,
-                                           working_dir)  # this will first copy everything from work to data (current dir) and then clean up the data dir. Insane.
-        run_analysis()
-        append_settings()
-        #
-        # <-- deposit_init commands
-        distribute_files(executable, wf_config, diadem_dir_abs_path, debug=debug)
-
-        # result -->
-        local_resultdict = wf_config.result.get(executable)
-        get_result_from.Deposit(local_resultdict, 'DensityAnalysis.out')
-        resultdict[inchiKey].update(local_resultdict)
-        with open("result.yml", 'wt') as outfile:
-            yaml.dump(local_resultdict, outfile)
-        # <-- result
-except Exception as e:
-    logger.error(f"An error occurred during {executable.value} processing: {e}")
-    distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
-    sys.exit(1)
 
-# 4->5
-previous_executable = executable
+# External tools of the stages. They are resolved before the first stage runs, see utils.tools.
+ADD_DIHEDRAL_ANGLES = '$DEPTOOLS/add_dihedral_angles.sh'
+stage_tools = {
+    Executable.XTB: ['obabel', 'xtb'],
+    Executable.QPPARAMETRIZER: ['QPParametrizer'],
+    Executable.DIHEDRAL_PARAMETRIZER: [ADD_DIHEDRAL_ANGLES, 'zip', 'obabel', 'mpirun', 'DihedralParametrizer'],
+    Executable.DEPOSIT: ['Deposit', 'obabel', '$DEPTOOLS/add_periodic_copies.py', 'QuantumPatchAnalysis'],
+    Executable.QUANTUMPATCH: ['mpirun', 'QuantumPatch'],
+    Executable.LIGHTFORGE_HOLE: ['mpirun', 'lightforge'],
+    Executable.LIGHTFORGE_ELECTRON: ['mpirun', 'lightforge'],
+}
 
-# 5 ################################
-executable = Executable.QUANTUMPATCH
-###################################
+workflow = StageGraph([run_xtb, run_qpparametrizer, run_dihedral_parametrizer, run_deposit, run_quantumpatch,
+                       run_lightforge_hole, run_lightforge_electron])
 
+# Partial workflows: start_from a later stage using the outputs of earlier stages supplied in the working directory,
+# and/or stop_after a stage. result.yml then contains the results of the stages that ran (and of supplied ones).
 try:
-    with ChangeDirectory(executable.value):
-        fetch_output_from_previous_executable(previous_executable.value)
-
-        source_path = f'{opt_tmpl}/{executable.value}/settings_ng.yml'
-        destination_path = pathlib.Path.cwd() / 'settings_ng.yml'
-        copy_with_changes(source_path, changes[executable.value], destination_path)
-
-        if 'SCRATCH' not in os.environ:
-            # Generate a random directory inside the current directory which will serve as a SCRATCH
-            current_dir = os.getcwd()
-            scratch_dir = os.path.join(current_dir, "qp_scratch_" + next(tempfile._get_candidate_names()))
-            # Ensure the directory exists
-            os.makedirs(scratch_dir, exist_ok=True)
-            # Set the SCRATCH environment variable
-            os.environ['SCRATCH'] = scratch_dir
-
-        logger.info(f"SCRATCH for QuantumPatch is set to: {os.environ['SCRATCH']}")
-
-        # 5.1. RUN QP
-        # the only necessary input for QP: structure or structurePBC is in the current folder.
-        executable_path = find_executable_path(executable.value)
-
-        os.environ['OMP_NUM_THREADS'] = '1'
-        all_avail_physical_cpus = psutil.cpu_count(logical=False)
-        n_cpus_for_qp = changes.get('global', {}).get('ncpus', all_avail_physical_cpus)
+    stage_graph = workflow.select(start_from=global_calc_settings.get('start_from'),
+                                  stop_after=global_calc_settings.get('stop_after'))
+except ValueError as e:
+    logger.critical(f"Invalid stage range: {e}")
+    sys.exit("Exiting due to an invalid stage range.")
+running_executables = [Executable(name) for name in stage_graph.stages]
+logger.info("Stages to run", stages=list(stage_graph.stages), supplied=stage_graph.supplied)
+
+log_specified_files(running_executables)
+
+# Every section of the specification is applied to its template in a dry run, so that a typo in a late stage is found
+# before the first stage runs. The stages write the merged settings. The limits of the stages are checked as well.
+specification_errors = {}
+try:
+    stage_settings = compile_settings(
+        {executable.value: f'{executable.value}/{template}' for executable, template in settings_templates.items()},
+        changes, required=[executable.value for executable in running_executables], load=templates.document)
+except SpecificationError as e:
+    specification_errors.update(e.errors)
+stage_limit_errors = limit_errors(stage_limits, [executable.value for executable in Executable])
+if stage_limit_errors:
+    specification_errors['global'] = stage_limit_errors
+if specification_errors:
+    error = SpecificationError(specification_errors)
+    logger.critical(str(error), errors=error.errors)
+    sys.exit("Exiting due to an invalid specification.")
 
-        command = f'mpirun --bind-to none -np {n_cpus_for_qp} $NMMPIARGS $ENVCOMMAND --mca btl self,vader,tcp python -m mpi4py {executable_path}'
-        run_command(command, use_shell=True)
+try:
+    tool_registry.preflight(tool for executable in running_executables for tool in stage_tools[executable])
+except MissingToolsError as e:
+    logger.critical(str(e), missing=e.missing)
+    sys.exit("Exiting due to missing tools.")
+check_calculator_files(running_executables)
+
+for name in stage_graph.supplied:
+    check_required_output_files_exist([f"{name}/out/{file}" for file in workflow.stages[name].outputs],
+                                      description=f"{name} output")
+
+# results of the stages before start_from, if they were computed in this working directory.
+for name in workflow.stages:
+    result_path = pathlib.Path(name) / "result.yml"
+    if name not in stage_graph.stages and any(name in workflow.ancestors(stage) for stage in stage_graph.stages) \
+            and result_path.is_file():
+        resultdict[inchiKey].update(yaml_io.load(result_path))
 
-        required_files = ['Analysis/files_for_kmc/files_for_kmc.zip']  # todo maybe check individual files.
-        check_required_output_files_exist(required_files)
+logger.info(" ================================= Workflow starts . . . ================================================")
 
-        # 5.2. Prepare input for LF
-        # Define the directory to be zipped and the name of the zip file: needed for lightforge
-        directory_to_zip = "Analysis"
-        required_files = wf_config.required_files.get(executable)
-        zipped_analysis_folder = "QP_output_0.zip"
-
-        # Create a zip from Analysis of QP.
-        with zipfile.ZipFile(zipped_analysis_folder, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Walk through the directory
-            for root, dirs, files in os.walk(directory_to_zip):
-                for file in files:
-                    # Create the complete filepath of the file in the zip
-                    file_path = os.path.join(root, file)
-                    # Add the file to the zip file, preserving the directory structure
-                    zipf.write(file_path, os.path.relpath(file_path, directory_to_zip))
-
-        logger.info(
-            f"Directory '{directory_to_zip}' zipped into '{zipped_analysis_folder}' successfully. This will be the LF input.")
-
-        # workaround deltaE_*.png --> deltaE.png:
-        rename_file('Analysis/energy/DeltaE*.png', 'DeltaE.png')
-        
-        distribute_files(executable, wf_config, diadem_dir_abs_path, debug=debug)
-except Exception as e:
-    logger.error(f"An error occurred during {executable.value} processing: {e}")
-    distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
+workflow_start = time.perf_counter()
+# the plots of the stages are rendered in the background while the next stages run.
+plot_renderer.start()
+try:
+    stage_results = stage_graph.run(ncpus)
+except StageError as e:
+    logger.error(f"Workflow failed: {e}")
+    plot_renderer.wait()
+    aggregate_metrics([pathlib.Path(name) for name in stage_graph.stages], time.perf_counter() - workflow_start)
     sys.exit(1)
+plot_renderer.wait()
+aggregate_metrics([pathlib.Path(name) for name in stage_graph.stages], time.perf_counter() - workflow_start)
 
-# 5->6
-previous_executable = executable
-
-
-# 6. ##########################################################################
-for executable in [Executable.LIGHTFORGE_HOLE, Executable.LIGHTFORGE_ELECTRON]:
-###############################################################################
-    try:
-        with ChangeDirectory(executable.value):
-            fetch_output_from_previous_executable(previous_executable.value)
-            fetch_output_from_previous_executable(
-                Executable.DIHEDRAL_PARAMETRIZER.value)  # yes, files from twp previous tools
-
-            source_path = f'{opt_tmpl}/{executable.value}/settings'  # settings specific to hole/electron
-            destination_path = pathlib.Path.cwd() / 'settings'
-            copy_with_changes(source_path, changes[executable.value], destination_path)
-
-            executable_path = find_executable_path(executable.value.split('_')[0])  # returns simply lightforge for both hole and electron.
-            carrier_type = executable.value.split('_')[1]  # hole or electron
-
-            os.environ['OMP_NUM_THREADS'] = '1'
-            all_avail_physical_cpus = psutil.cpu_count(logical=False)
-            n_cpus_for_lf = changes.get('global', {}).get('ncpus', all_avail_physical_cpus)
-            command = f'mpirun -x OMP_NUM_THREADS --bind-to none -n {n_cpus_for_lf} --mca btl self,vader,tcp python -m mpi4py {executable_path} -s settings'
-            run_command(command, use_shell=True)
-
-            # result -->
-            local_resultdict = wf_config.result.get(executable)
-            get_result_from.lightforge(local_resultdict,
-                                       'results/experiments/current_characteristics/mobilities_all_fields.dat', 'settings',
-                                       hole_or_electron=carrier_type)
-
-            # the side-effect of the get_result_from.lighforge is creating file mobility_vs_sqrt_field_<hole/electron>.png which will be copied as file to the front-end!!!
-            resultdict[inchiKey].update(local_resultdict)
-            with open("result.yml", 'wt') as outfile:  # this dict is inside the lightforge simulation folder.
-                yaml.dump(local_resultdict, outfile)
-            # <-- result
-
-            distribute_files(executable, wf_config, diadem_dir_abs_path)
-    except Exception as e:
-        logger.error(f"An error occurred during {executable.value} processing: {e}")
-        distribute_files(executable, wf_config, diadem_dir_abs_path, error_happened=True, debug=debug)
-        sys.exit(1)
-
-# resultdict will be filled in after every workflow step.
+# resultdict is filled in from the result fragments of the stages.
 # if the workflow succeed, resultdict is complete.
+for executable in Executable:
+    local_resultdict = stage_results.get(executable.value)
+    if local_resultdict:
+        resultdict[inchiKey].update(local_resultdict)
 
-with open("result.yml", 'wt') as outfile:
-    yaml.dump(resultdict, outfile)
+yaml_io.save(resultdict, "result.yml", safe=False)
+
+# stage-out of the plots. A plot that failed to render is missing from the files, but does not fail the workflow.
+for executable in running_executables:
+    for file in deferred_files.get(executable, ()):
+        plot = pathlib.Path(executable.value) / file
+        if plot.is_file():
+            stage_files([plot], diadem_dir_abs_path)
+        else:
+            logger.error(f"Plot {plot} is missing, it was not rendered")
+
+# Run-wide artifact manifest: the out folders, the inputs staged into the stage folders and the diadem files,
+# with the stage zips. Duplicates among out folders and diadem files are replaced by reflinks where possible.
+out_files = [file for name in stage_graph.stages for file in sorted(glob.glob(f"{name}/out/*"))]
+input_files = [f"{name}/{file}" for name, stage_of_graph in stage_graph.stages.items() for file in stage_of_graph.inputs]
+diadem_files = [file for executable in Executable for pattern in wf_config.files.get(executable)
+                for file in glob.glob(pathlib.Path(pattern).name)]
+artifact_manifest = ArtifactManifest()
+artifact_manifest.update(out_files + input_files + diadem_files, zips=sorted(glob.glob('*.zip')))
+artifact_manifest.dedupe(out_files + diadem_files)
+artifact_manifest.save()
 
 logger.info("Listing directory contents at the end")
 list_directory_contents()
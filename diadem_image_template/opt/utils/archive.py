@@ -0,0 +1,147 @@
+"""
+Zip archives written with members compressed in parallel.
+
+zipfile compresses one member after the other on a single core. ArchiveWriter compresses the members on a thread
+pool (zlib releases the GIL) and writes them in the order they were added, so the archive does not depend on the
+scheduling. Members that are compressed already (ALREADY_COMPRESSED) are stored as they are. Members larger than
+MAX_MEMBER_BYTES_IN_MEMORY are streamed by zipfile in the writing thread instead of being held in memory.
+
+zipfile has no API to add a member that is compressed already; write_raw_member uses its internals, which are
+checked for the Python versions in RAW_MEMBER_PYTHON_VERSIONS. On other versions the members are read in parallel,
+but compressed by ZipFile.writestr in the writing thread.
+"""
+import os
+import sys
+import zlib
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Tuple, Union
+
+import structlog
+
+from .core_planner import available_cores
+
+# Get the logger
+logger = structlog.get_logger()
+
+ALREADY_COMPRESSED = ('.gz', '.png', '.zip', '.npz')
+DEFAULT_COMPRESSLEVEL = 6  # zlib default
+MAX_MEMBER_BYTES_IN_MEMORY = 64 * 1024 ** 2
+RAW_MEMBER_PYTHON_VERSIONS = ((3, 8), (3, 13))  # first and last Python version write_raw_member is checked with
+RAW_MEMBERS = RAW_MEMBER_PYTHON_VERSIONS[0] <= sys.version_info[:2] <= RAW_MEMBER_PYTHON_VERSIONS[1]
+
+PathLike = Union[str, os.PathLike]
+
+
+def _compress_member(path: PathLike, arcname: str, compresslevel: int,
+                     compress: bool = True) -> Tuple[zipfile.ZipInfo, bytes]:
+    """
+    Read and compress one member. Returns its ZipInfo with CRC and sizes set and the raw member data.
+    Without compress, only the ZipInfo is prepared and the data is returned as it is read.
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    if arcname.lower().endswith(ALREADY_COMPRESSED):
+        zinfo.compress_type = zipfile.ZIP_STORED
+    elif not compress:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zinfo, data
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)  # raw deflate stream, as zip expects
+        data = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def write_raw_member(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data: bytes) -> None:
+    """
+    Write a member whose data is compressed already (with zinfo.compress_type). zinfo must have CRC, file_size
+    and compress_size set. Follows ZipFile.mkdir, which writes a member without going through a compressor.
+    """
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader())
+        zf.fp.write(data)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+class ArchiveWriter:
+    """
+    Context manager writing a zip archive. Members are added with add(path, arcname) and compressed in parallel
+    with compresslevel (0-9).
+
+    Example:
+        with ArchiveWriter('QP_output_0.zip', compresslevel=1) as archive:
+            archive.add('Analysis/energy/DeltaE.png', 'energy/DeltaE.png')
+    """
+
+    def __init__(self, output_zip_path: PathLike, compresslevel: Optional[int] = None,
+                 max_workers: Optional[int] = None):
+        self.output_zip_path = output_zip_path
+        self.compresslevel = DEFAULT_COMPRESSLEVEL if compresslevel is None else compresslevel
+        self.max_workers = max_workers or available_cores()  # a stage passes its share of the cores
+        self._raw_members = RAW_MEMBERS
+        self._arcnames = set()
+        self._pending = deque()  # futures (or paths of large members) in the order the members were added
+
+    def __enter__(self):
+        self._zipfile = zipfile.ZipFile(self.output_zip_path, 'w', zipfile.ZIP_DEFLATED,
+                                        compresslevel=self.compresslevel)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._write_pending(0)
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._zipfile.close()
+
+    def add(self, path: PathLike, arcname: str) -> None:
+        arcname = arcname.replace(os.sep, '/')
+        if arcname in self._arcnames:
+            return
+        self._arcnames.add(arcname)
+        if os.path.getsize(path) > MAX_MEMBER_BYTES_IN_MEMORY:
+            self._pending.append((path, arcname))
+        else:
+            self._pending.append(self._executor.submit(_compress_member, path, arcname, self.compresslevel,
+                                                       self._raw_members))
+        # bound the memory held by compressed members waiting to be written
+        self._write_pending(2 * self.max_workers)
+
+    def _write_pending(self, keep: int) -> None:
+        while len(self._pending) > keep:
+            member = self._pending.popleft()
+            if isinstance(member, tuple):
+                path, arcname = member
+                compress_type = zipfile.ZIP_STORED if arcname.lower().endswith(ALREADY_COMPRESSED) else None
+                self._zipfile.write(path, arcname, compress_type=compress_type)
+            elif self._raw_members:
+                write_raw_member(self._zipfile, *member.result())
+            else:
+                zinfo, data = member.result()
+                self._zipfile.writestr(zinfo, data, compresslevel=self.compresslevel)
+
+
+def write_archive(members: Iterable[Tuple[PathLike, str]], output_zip_path: PathLike,
+                  compresslevel: Optional[int] = None, max_workers: Optional[int] = None) -> PathLike:
+    """
+    Write the (path, arcname) members into a zip archive. See ArchiveWriter.
+    """
+    with ArchiveWriter(output_zip_path, compresslevel=compresslevel, max_workers=max_workers) as archive:
+        for path, arcname in members:
+            archive.add(path, arcname)
+    return output_zip_path
@@ -0,0 +1,132 @@
+"""
+Run-wide manifest of the artifacts of the workflow, addressed by content.
+
+The same content often lands in several places: the out folder of a stage, the diadem files in the work
+directory, the folder of the next stage and the stage zips (e.g. molecule_0.pdb, output_molecule.mol2). The
+manifest (artifact_manifest.yml) records the sha256 of every file and the zip members with the same content. Files
+are hashed in chunks on a thread pool; files whose size and mtime did not change since the last manifest are not
+hashed again, so updating the manifest and verifying a stage-out against it is cheap.
+
+dedupe() keeps every unique content of the linkable files (out folders and diadem files) once where the filesystem
+can clone files: the other copies become reflinks (copy-on-write) of the first one, see utils.staging. They are not
+hardlinked, as an in-place write to one of them (a rerun, a tool) would change all of them.
+"""
+import hashlib
+import os
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+import structlog
+
+from . import yaml_io
+from .core_planner import available_cores
+from .stage_cache import CHUNK_SIZE
+from .staging import clone_file, stage_file
+
+# Get the logger
+logger = structlog.get_logger()
+
+MANIFEST_FILE = 'artifact_manifest.yml'
+
+
+def hash_file(path: str) -> Dict[str, Any]:
+    """
+    sha256 and crc32 (to recognize zip members) of a file, read in chunks.
+    """
+    sha = hashlib.sha256()
+    crc = 0
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return {'sha256': sha.hexdigest(), 'crc32': crc}
+
+
+def hash_files(paths: Iterable[str], max_workers: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    hash_file of several files on a thread pool (hashlib and zlib release the GIL).
+    """
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=max_workers or available_cores()) as executor:
+        return dict(zip(paths, executor.map(hash_file, paths)))
+
+
+class ArtifactManifest:
+    """
+    files: {path: {'sha256', 'crc32', 'size', 'mtime_ns'}} of the files of the run, paths relative to the work
+    directory. artifacts: {sha256: {'size', 'paths', 'zip_members'}}, every unique content once.
+    """
+
+    def __init__(self, path: str = MANIFEST_FILE):
+        self.path = path
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.artifacts: Dict[str, Dict[str, Any]] = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as infile:
+                self.files = (yaml_io.loads(infile) or {}).get('files', {})
+
+    def update(self, paths: Iterable[str], zips: Iterable[str] = ()) -> None:
+        """
+        Hash the files that are new or changed since the last manifest and collect the artifacts.
+        zips: archives whose members are recorded with the artifacts of the same content (same size and crc32).
+        """
+        stats = {path: os.stat(path) for path in sorted(set(paths)) if os.path.isfile(path)}
+        unchanged = {path: self.files[path] for path, stat_result in stats.items()
+                     if path in self.files and self.files[path]['size'] == stat_result.st_size
+                     and self.files[path]['mtime_ns'] == stat_result.st_mtime_ns}
+        hashed = hash_files(path for path in stats if path not in unchanged)
+        self.files = dict(unchanged)
+        for path, hashes in hashed.items():
+            self.files[path] = {**hashes, 'size': stats[path].st_size, 'mtime_ns': stats[path].st_mtime_ns}
+        self.files = dict(sorted(self.files.items()))
+        logger.info(f"Artifact manifest: {len(hashed)} files hashed, {len(unchanged)} unchanged")
+
+        self.artifacts = {}
+        by_crc = {}
+        for path, entry in self.files.items():
+            artifact = self.artifacts.setdefault(entry['sha256'], {'size': entry['size'], 'paths': [],
+                                                                   'zip_members': []})
+            artifact['paths'].append(path)
+            by_crc[(entry['size'], entry['crc32'])] = artifact
+        for zip_path in zips:
+            try:
+                with zipfile.ZipFile(zip_path) as zf:
+                    for zinfo in zf.infolist():
+                        artifact = by_crc.get((zinfo.file_size, zinfo.CRC))
+                        if artifact is not None:
+                            artifact['zip_members'].append(f'{zip_path}:{zinfo.filename}')
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.warning(f"Failed to read {zip_path}: {e}")
+
+    def duplicates(self) -> List[List[str]]:
+        """
+        Paths of the files with the same content, for every content that is stored more than once.
+        """
+        return [artifact['paths'] for artifact in self.artifacts.values() if len(artifact['paths']) > 1]
+
+    def dedupe(self, linkable: Iterable[str]) -> int:
+        """
+        Replace the copies among the linkable paths by reflinks of the first linkable path with the same content.
+        Copies stay as they are on filesystems that cannot clone. Returns the number of bytes freed.
+        """
+        linkable = set(linkable)
+        freed = 0
+        for paths in self.duplicates():
+            paths = [path for path in paths if path in linkable]
+            for path in paths[1:]:
+                if os.path.samefile(paths[0], path):  # hardlinked by an earlier run: an inode of its own again
+                    stage_file(paths[0], path)
+                elif clone_file(paths[0], path):
+                    freed += self.files[path]['size']
+                else:
+                    continue
+                self.files[path]['mtime_ns'] = os.stat(path).st_mtime_ns
+        if freed:
+            logger.info(f"Artifact manifest: {freed} bytes of duplicates replaced by reflinks")
+        return freed
+
+    def save(self) -> None:
+        with open(self.path, 'wt') as outfile:
+            yaml_io.dumps({'files': self.files, 'artifacts': self.artifacts}, outfile, sort_keys=False)
@@ -1,10 +1,8 @@
-import yaml
+from . import yaml_io
 
 
 def read_params_from_yaml(yaml_file):
-    with open(yaml_file, 'r') as file:
-        params = yaml.safe_load(file)
-    return params
+    return yaml_io.load(yaml_file)
 
 
 def build_command(yaml_file):
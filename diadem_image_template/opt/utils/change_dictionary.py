@@ -1,5 +1,7 @@
+import copy
 import pathlib
-from typing import Union, Dict, Any, Optional
+import yaml
+from typing import Union, Dict, Any, Callable, Iterable, List, Optional
 from .general import load_yaml, save_yaml
 
 
@@ -64,6 +66,82 @@ def copy_with_changes(
         return original_dict
 
 
+class SpecificationError(ValueError):
+    """
+    Raised by compile_settings with all errors of the specification, {section: [error, ...]}.
+    """
+
+    def __init__(self, errors: Dict[str, List[str]]):
+        self.errors = errors
+        super().__init__("Invalid specification:\n" + "\n".join(
+            f"  {section}: {error}" for section, section_errors in errors.items() for error in section_errors))
+
+
+def unknown_keys(original, changes, path=()) -> List[str]:
+    """
+    Keys of changes that update_dict would reject, as 'key/subkey' paths. Unlike update_dict, finds all of them.
+    """
+    unknown = []
+    for key, value in changes.items():
+        key_path = path + (str(key),)
+        if key not in original:
+            unknown.append('/'.join(key_path))
+        elif isinstance(value, dict) and isinstance(original[key], dict):
+            unknown.extend(unknown_keys(original[key], value, key_path))
+        elif isinstance(value, list) and isinstance(original[key], list):
+            for i, item in enumerate(value):
+                if i < len(original[key]) and isinstance(item, dict) and isinstance(original[key][i], dict):
+                    unknown.extend(unknown_keys(original[key][i], item, key_path + (str(i),)))
+    return unknown
+
+
+def compile_settings(
+        templates: Dict[str, Union[str, pathlib.Path]],
+        specification: Dict[str, Any],
+        required: Iterable[str] = (),
+        ignored: Iterable[str] = ('global',),
+        load: Callable[[Any], Dict[str, Any]] = load_yaml
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Dry run of copy_with_changes for every section of the specification with a template ({section: template path}).
+    Returns the merged settings {section: settings}. Collects the errors of all sections (unknown keys, sections
+    without template, missing required sections, unreadable templates) and raises them together as
+    SpecificationError. load reads a template, e.g. TemplateBundle.document.
+    """
+    errors = {}
+    merged = {}
+    ignored = set(ignored)
+    for section in specification:
+        if section not in templates and section not in ignored:
+            errors[section] = ["unknown section"]
+    for section in required:
+        if section in templates and section not in specification:
+            errors[section] = ["missing section"]
+    for section, template in templates.items():
+        if section not in specification:
+            continue
+        changes = specification[section] or {}
+        try:
+            original = load(template)
+        except (OSError, KeyError, yaml.YAMLError) as e:
+            errors[section] = [f"cannot read the template {template}: {e}"]
+            continue
+        if not isinstance(changes, dict):
+            errors[section] = [f"changes must be a mapping, not {type(changes).__name__}"]
+            continue
+        unknown = unknown_keys(original, changes)
+        if unknown:
+            errors[section] = [f"key '{key}' not found in {pathlib.Path(template).name}" for key in unknown]
+            continue
+        try:
+            merged[section] = update_dict(copy.deepcopy(original), changes)
+        except (KeyError, TypeError, AttributeError) as e:
+            errors[section] = [f"cannot apply the changes: {e}"]
+    if errors:
+        raise SpecificationError(errors)
+    return merged
+
+
 # Example usage of the function
 if __name__ == "__main__":
     import argparse
@@ -0,0 +1,86 @@
+"""
+Stage-level checkpoints of the workflow.
+
+After a stage finished, a completion marker is written to its simulation folder. It records the hashes of the
+inputs the stage was run with, of its out folder and of its diadem files, together with its result.yml fragment.
+A rerun in the same working directory skips every stage with a verified marker and takes its result from there.
+"""
+import os
+import pathlib
+from typing import Any, Dict, Iterable, Optional, Union
+
+import structlog
+import yaml
+
+from . import yaml_io
+from .stage_cache import hash_directory, hash_file
+
+# Get the logger
+logger = structlog.get_logger()
+
+MARKER_FILE = '.stage_complete.yml'
+
+
+def _describe(input_dirs: Iterable[Union[str, pathlib.Path]], diadem_dir: Union[str, pathlib.Path],
+              diadem_files: Iterable[str], output_dir: str) -> Dict[str, Any]:
+    diadem_dir = pathlib.Path(diadem_dir)
+    return {
+        'inputs': {str(input_dir): hash_directory(input_dir) for input_dir in input_dirs},
+        'outputs': hash_directory(output_dir) if pathlib.Path(output_dir).is_dir() else {},
+        'diadem_files': {name: hash_file(diadem_dir / name) for name in sorted(diadem_files)},
+    }
+
+
+def write_stage_marker(stage: str, result: Optional[Dict[str, Any]], input_dirs: Iterable[Union[str, pathlib.Path]],
+                       diadem_dir: Union[str, pathlib.Path], diadem_files: Iterable[str],
+                       output_dir: str = 'out') -> None:
+    """
+    Durably write the completion marker of a stage into the current directory.
+    diadem_files: base names of the files the stage copied to diadem_dir.
+    """
+    marker = {'stage': stage, 'result': result or {}, **_describe(input_dirs, diadem_dir, diadem_files, output_dir)}
+    tmp_path = f'{MARKER_FILE}.tmp'
+    with open(tmp_path, 'wt') as outfile:
+        yaml_io.dumps(marker, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, MARKER_FILE)
+    directory_fd = os.open('.', os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    logger.info(f"Stage {stage} marked as completed")
+
+
+def read_stage_marker(stage: str, input_dirs: Iterable[Union[str, pathlib.Path]],
+                      diadem_dir: Union[str, pathlib.Path], output_dir: str = 'out') -> Optional[Dict[str, Any]]:
+    """
+    Read the completion marker of a stage from the current directory and verify it against the files on disk.
+    Returns the result fragment of the stage ({} if it has none), or None if the stage has to be run (again).
+    """
+    if not os.path.isfile(MARKER_FILE):
+        return None
+    try:
+        with open(MARKER_FILE, 'r') as file:
+            marker = yaml_io.loads(file)
+        current = _describe(input_dirs, diadem_dir, marker['diadem_files'], output_dir)
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        logger.warning(f"Unreadable completion marker of stage {stage}, rerunning it", error=str(e))
+        return None
+
+    changed = [key for key in ('inputs', 'outputs', 'diadem_files') if marker.get(key) != current[key]]
+    if marker.get('stage') != stage or changed:
+        logger.warning(f"Completion marker of stage {stage} does not match the files on disk, rerunning it",
+                       changed=changed)
+        return None
+    logger.info(f"Stage {stage} already completed, skipping it")
+    return marker['result']
+
+
+def remove_stage_marker() -> None:
+    """
+    Remove the completion marker from the current directory, before a stage is (re)run.
+    """
+    if os.path.isfile(MARKER_FILE):
+        os.remove(MARKER_FILE)
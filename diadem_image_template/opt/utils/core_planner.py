@@ -0,0 +1,96 @@
+"""
+Number of cores the workflow may use.
+
+psutil.cpu_count(logical=False) counts the physical cores of the host and ignores container limits. The planner
+takes the physical cores within the cpuset of the process (sched_getaffinity) and caps them by the cgroup v2 or v1
+CPU quota. Every stage derives its QPParametrizer Threads, hostfile slots, Deposit ncpu, mpirun -np and
+OMP_NUM_THREADS from the cores it is given.
+"""
+import math
+import os
+import pathlib
+from typing import Optional
+
+import psutil
+import structlog
+
+# Get the logger
+logger = structlog.get_logger()
+
+CGROUP_ROOT = pathlib.Path('/sys/fs/cgroup')
+CPU_TOPOLOGY = pathlib.Path('/sys/devices/system/cpu')
+
+
+def _read(path: pathlib.Path) -> Optional[str]:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota(cgroup_root: pathlib.Path = CGROUP_ROOT) -> Optional[float]:
+    """
+    CPU quota of the container in cores, None if unlimited.
+    cgroup v2: cpu.max = "<quota> <period>" or "max <period>".
+    cgroup v1: cpu/cpu.cfs_quota_us (-1 if unlimited) and cpu/cpu.cfs_period_us.
+    """
+    cpu_max = _read(cgroup_root / 'cpu.max')
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read(cgroup_root / 'cpu' / 'cpu.cfs_quota_us')
+    period = _read(cgroup_root / 'cpu' / 'cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def physical_cores_in_cpuset(cpu_topology: pathlib.Path = CPU_TOPOLOGY) -> int:
+    """
+    Number of physical cores among the logical CPUs the process may run on. Hyperthreads of one core count once.
+    """
+    allowed_cpus = os.sched_getaffinity(0)
+    cores = set()
+    for cpu in allowed_cpus:
+        topology = cpu_topology / f'cpu{cpu}' / 'topology'
+        package = _read(topology / 'physical_package_id')
+        core = _read(topology / 'core_id')
+        if package is None or core is None:
+            # no topology information (e.g. some virtual machines): fall back to psutil for the whole host.
+            physical = psutil.cpu_count(logical=False) or len(allowed_cpus)
+            return min(physical, len(allowed_cpus))
+        cores.add((package, core))
+    return len(cores)
+
+
+def available_cores() -> int:
+    """
+    Physical cores in the cpuset, limited by the cgroup CPU quota. At least 1.
+    """
+    cores = physical_cores_in_cpuset()
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cores = min(cores, math.floor(quota))
+    return max(1, cores)
+
+
+def plan_cores(requested: Optional[int] = None) -> int:
+    """
+    Core budget of the workflow: the requested number of cores (global.ncpus of the calculator), but never more
+    than available, as oversubscribing the cores slows down MPI runs considerably.
+    """
+    cores = available_cores()
+    if requested is None:
+        logger.info(f"Using all {cores} available cores")
+        return cores
+    if int(requested) > cores:
+        logger.warning(f"{requested} cores requested, but only {cores} are available. Using {cores}.")
+        return cores
+    return int(requested)
+
+
+if __name__ == "__main__":
+    print(available_cores())
@@ -1,4 +1,4 @@
-from .logging_config import configure_logging
+import contextlib
 import structlog
 import os
 import shutil
@@ -6,13 +6,82 @@ import zipfile
 import glob
 from .subprocess_functions import run_command
 
-# Ensure the logging configuration is applied
-configure_logging()
-
 # Get the logger
 logger = structlog.get_logger()
 
 
+LOG_FILE_SUFFIXES = (".stderr", ".stdout")
+LOG_FILE_NAMES = ("stdout", "stderr")
+
+
+def _is_log_file(file_name):
+    return file_name.endswith(LOG_FILE_SUFFIXES) or file_name in LOG_FILE_NAMES
+
+
+def _file_signature(path):
+    stat_result = os.stat(path)
+    return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+def populate_working_directory(current_dir, working_dir):
+    """
+    Make the files of current_dir available in working_dir: hardlinks if both are on the same filesystem, copies
+    otherwise. working_dir itself is skipped if it is inside current_dir.
+    Returns the manifest {relative path: (linked, signature)} that sync_working_directory compares against.
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(current_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != working_dir]
+        relative_root = os.path.relpath(root, current_dir)
+        os.makedirs(os.path.join(working_dir, relative_root), exist_ok=True)
+        for file in files:
+            relative_path = os.path.normpath(os.path.join(relative_root, file))
+            s = os.path.join(current_dir, relative_path)
+            d = os.path.join(working_dir, relative_path)
+            try:
+                os.link(s, d)
+                linked = True
+            except OSError:  # e.g. a scratch on another filesystem
+                shutil.copy2(s, d)
+                linked = False
+            manifest[relative_path] = (linked, _file_signature(d))
+    return manifest
+
+
+def sync_working_directory(working_dir, data_dir, manifest=None):
+    """
+    Move the files that are new or changed in working_dir to data_dir (a rename on the same filesystem).
+    Files that are hardlinks of data_dir files were changed in place; they are skipped, as are unchanged copies and
+    log files. Without a manifest, every file is synced.
+    """
+    manifest = manifest or {}
+    moved, skipped, logs = 0, 0, 0
+    for root, dirs, files in os.walk(working_dir):
+        relative_root = os.path.relpath(root, working_dir)
+        os.makedirs(os.path.join(data_dir, relative_root), exist_ok=True)
+        for file in files:
+            relative_path = os.path.normpath(os.path.join(relative_root, file))
+            s = os.path.join(working_dir, relative_path)
+            d = os.path.join(data_dir, relative_path)
+            if _is_log_file(file):
+                logs += 1
+                continue
+            if relative_path in manifest:
+                linked, signature = manifest[relative_path]
+                current_signature = _file_signature(s)
+                if current_signature[:2] == signature[:2] and (linked or current_signature == signature):
+                    skipped += 1
+                    continue
+            try:
+                if os.path.isfile(d):
+                    os.remove(d)  # never write into the inode of an input, e.g. a read-only hardlink.
+                shutil.move(s, d)
+                moved += 1
+            except Exception as e:
+                logger.warning(f"Failed to move {s} to {d}: {e}")
+    logger.info(f"Synced {working_dir} to {data_dir}: {moved} files moved, {skipped} unchanged, {logs} logs dropped")
+
+
 def setup_working_directory():
     current_dir = os.getcwd()
     scratch_dir = os.environ.get('SCRATCH')
@@ -26,18 +95,14 @@ def setup_working_directory():
     else:
         working_dir = current_dir
 
-    os.makedirs(working_dir, exist_ok=True)
-    for item in os.listdir(current_dir):
-        s = os.path.join(current_dir, item)
-        d = os.path.join(working_dir, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, dirs_exist_ok=True)
-        else:
-            shutil.copy2(s, d)
+    manifest = {}
+    if working_dir != current_dir:
+        os.makedirs(working_dir, exist_ok=True)
+        manifest = populate_working_directory(current_dir, working_dir)
 
     logger.info(f"Deposit running on node {os.uname().nodename} in directory {working_dir}")
     os.chdir(working_dir)
-    return current_dir, working_dir
+    return current_dir, working_dir, manifest
 
 
 def setup_working_directory_t(work_dir_name:str):  # test
@@ -57,18 +122,27 @@ def setup_working_directory_t(work_dir_name:str):  # test
     # else:
     #     working_dir = current_dir
 
-    os.makedirs(working_dir, exist_ok=True)
-    for item in os.listdir(current_dir):
-        s = os.path.join(current_dir, item)
-        d = os.path.join(working_dir, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, dirs_exist_ok=True)
-        else:
-            shutil.copy2(s, d)
+    shutil.rmtree(working_dir, ignore_errors=True)  # left over by a failed run
+    os.makedirs(working_dir)
+    manifest = populate_working_directory(current_dir, working_dir)
 
     logger.info(f"Deposit running on node in directory {working_dir}")
     os.chdir(working_dir)
-    return current_dir, working_dir
+    return current_dir, working_dir, manifest
+
+@contextlib.contextmanager
+def deposit_working_directory(work_dir_name: str):
+    """
+    Run the block in the working directory of setup_working_directory_t. Afterwards, also if the block fails, the
+    working directory is synced back to the data directory and removed: the output of a failed command
+    (command_output, see utils.subprocess_functions) ends up in the data directory for the errorStageOut.
+    """
+    current_dir, working_dir, manifest = setup_working_directory_t(work_dir_name)
+    try:
+        yield working_dir
+    finally:
+        handle_deposit_working_dir_cleanup(current_dir, working_dir, manifest)
+
 
 def check_and_extract_deposit_restart():
     if os.environ.get('DO_RESTART') == 'True':
@@ -103,34 +177,17 @@ def create_deposit_restart_zip():
                 os.remove(matched_file)
 
 
-def handle_deposit_working_dir_cleanup(current_dir, working_dir):
-    # todo: here, because unable using rsync, data were first copied to the data dir and then removed from data_dir. Nonsense!
+def handle_deposit_working_dir_cleanup(current_dir, working_dir, manifest=None):
+    """
+    Sync the results from the working directory back to the data directory (current_dir) and remove it.
+    """
     data_dir = current_dir
 
     logger.info(f"Cleaning up working directory: {working_dir}")
 
     if working_dir != data_dir:
         os.makedirs(data_dir, exist_ok=True)
-        for item in os.listdir(working_dir):
-            s = os.path.join(working_dir, item)
-            d = os.path.join(data_dir, item)
-            try:
-                if os.path.isdir(s):
-                    shutil.copytree(s, d, dirs_exist_ok=True)
-                else:
-                    if s != d:  # Ensure source and destination are not the same
-                        shutil.copy2(s, d)
-            except Exception as e:
-                logger.warning(f"Failed to copy {s} to {d}: {e}")
-
-        # Remove specific log files
-        for root, dirs, files in os.walk(data_dir):
-            for file in files:
-                if file.endswith((".stderr", ".stdout")) or file in ["stdout", "stderr"]:
-                    try:
-                        os.remove(os.path.join(root, file))
-                    except Exception as e:
-                        logger.warning(f"Failed to remove {os.path.join(root, file)}: {e}")
+        sync_working_directory(working_dir, data_dir, manifest)
 
         # Change to data directory
         try:
@@ -0,0 +1,156 @@
+"""
+Index of the files and folders of a stage directory, built with a single os.scandir walk.
+
+distribute_files matches the required, diadem, debug, optional and errorStageOut patterns of a stage. Globbing each
+of them walks the directory again, which is slow for QuantumPatch folders with tens of thousands of files.
+FileIndex walks once and matches glob patterns against the index with the semantics of glob.glob: '*', '?' and
+'[...]' do not match '/', names starting with '.' are only matched by patterns starting with '.', and '**' matches
+any number of folders if recursive. Compiled patterns are memoized.
+"""
+import functools
+import glob
+import os
+import re
+from typing import List
+
+import structlog
+
+# Get the logger
+logger = structlog.get_logger()
+
+
+def _translate_segment(segment: str) -> str:
+    """
+    Regular expression of one path segment of a glob pattern.
+    """
+    parts = [] if segment.startswith('.') else [r'(?!\.)']
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[':
+            end = segment.find(']', i + 2 if segment[i + 1:i + 2] in ('!', ']') else i + 1)
+            if end == -1:
+                parts.append(re.escape(char))
+            else:
+                content = segment[i + 1:end].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                parts.append(f'(?!/)[{content}]')
+                i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return ''.join(parts)
+
+
+# regular expressions of glob patterns translated ahead of time, see utils.template_bundle
+_translated = {}
+
+
+def add_translated_patterns(translated) -> None:
+    """
+    Use the regular expressions {(pattern, recursive): regex} of translate_pattern instead of translating again.
+    """
+    _translated.update(translated)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern: str, recursive: bool = False) -> re.Pattern:
+    """
+    Compile a relative glob pattern into a regular expression matching relative paths ('/'-separated).
+    """
+    regex = _translated.get((pattern, recursive))
+    return re.compile(regex if regex is not None else translate_pattern(pattern, recursive), re.DOTALL)
+
+
+def translate_pattern(pattern: str, recursive: bool = False) -> str:
+    """
+    Regular expression (source) of compile_pattern.
+    """
+    segments = pattern.rstrip('/').split('/')
+    regex = ''
+    for position, segment in enumerate(segments):
+        last = position == len(segments) - 1
+        if recursive and segment == '**':
+            # zero or more folders; as the last segment the folder itself and everything below.
+            if last:
+                regex = regex[:-1] + r'(?:/(?!\.)[^/]+)*' if regex else r'(?!\.)[^/]+(?:/(?!\.)[^/]+)*'
+            else:
+                regex += r'(?:(?!\.)[^/]+/)*'
+        else:
+            regex += _translate_segment(segment) + ('' if last else '/')
+    return regex + r'\Z'
+
+
+class FileIndex:
+    """
+    The files and folders below root as paths relative to root.
+
+    Example:
+        index = FileIndex('.')
+        index.glob('*.out')
+        index.files_under('Analysis')
+    """
+
+    def __init__(self, root: str = '.'):
+        self.root = root
+        self.files: List[str] = []
+        self.dirs: List[str] = []
+        self._walk()
+
+    def _walk(self):
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, relative_dir)) as entries:
+                    for entry in entries:
+                        path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            continue
+                        if is_dir:
+                            self.dirs.append(path)
+                            if not entry.is_symlink():
+                                stack.append(path)
+                        else:
+                            self.files.append(path)
+            except OSError as e:
+                logger.warning(f"Failed to index {relative_dir or self.root}: {e}")
+        self.files.sort()
+        self.dirs.sort()
+
+    def glob(self, pattern: str, recursive: bool = False) -> List[str]:
+        """
+        Files and folders matching pattern, like glob.glob(pattern) in root. Patterns leaving root (absolute or
+        with '..') are passed on to glob.glob.
+        """
+        if not pattern:
+            return []
+        if os.path.isabs(pattern) or '..' in pattern.split('/'):
+            return glob.glob(pattern, root_dir=self.root, recursive=recursive)
+        if not glob.has_magic(pattern):
+            path = os.path.normpath(pattern)
+            return [pattern] if path in self._file_set or path in self._dir_set else []
+        regex = compile_pattern(pattern, recursive)
+        return sorted(path for path in self.dirs + self.files if regex.match(path))
+
+    def files_under(self, directory: str) -> List[str]:
+        """
+        All files below directory, hidden ones included (like os.walk).
+        """
+        prefix = os.path.normpath(directory).rstrip('/') + '/'
+        return [path for path in self.files if path.startswith(prefix)]
+
+    @functools.cached_property
+    def _file_set(self):
+        return set(self.files)
+
+    @functools.cached_property
+    def _dir_set(self):
+        return set(self.dirs)
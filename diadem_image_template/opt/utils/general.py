@@ -1,23 +1,17 @@
-import yaml
 import structlog
-from .logging_config import configure_logging
+from . import yaml_io
 import os
 import shutil
 
-# Ensure the logging configuration is applied
-configure_logging()
-
 # Get the logger
 logger = structlog.get_logger()
 
 def load_yaml(file_path):
-    with open(file_path, 'r') as file:
-        return yaml.safe_load(file)
+    return yaml_io.load(file_path)
 
 
 def save_yaml(data, file_path):
-    with open(file_path, 'w') as file:
-        yaml.safe_dump(data, file)
+    yaml_io.save(data, file_path)
 
 
 def rename_dir(src_dir, new_dir_name):
@@ -1,9 +1,10 @@
-import yaml
-from .logging_config import configure_logging
-import structlog
+import copy
+import random
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence, Tuple
 
-# Ensure the logging configuration is applied
-configure_logging()
+from . import yaml_io
+import structlog
 
 # Get the logger
 logger = structlog.get_logger()
@@ -17,23 +18,133 @@ def set_carrier_type(destination_path, carrier_type):
     destination_path (str): Path to the YAML settings file.
     carrier_type (str): The carrier type, either 'hole' or 'electron'.
     """
-    with open(destination_path, 'r') as file:
-        config = yaml.safe_load(file)
-
-    if carrier_type == 'hole':
-        config['particles']['holes'] = True
-        config['particles']['electrons'] = False
-        for experiment in config['experiments']:
-            experiment['initial_holes'] = experiment.pop('initial_electrons', 30)  # Remove initial_electrons if present
-    elif carrier_type == 'electron':
-        config['particles']['holes'] = False
-        config['particles']['electrons'] = True
-        for experiment in config['experiments']:
-            experiment['initial_electrons'] = experiment.pop('initial_holes', 30)  # Remove initial_holes if present
-    else:
-        raise ValueError("carrier_type must be either 'hole' or 'electron'")
-
-    with open(destination_path, 'w') as file:
-        yaml.safe_dump(config, file)
+    with yaml_io.edit(destination_path) as config:
+        if carrier_type == 'hole':
+            config['particles']['holes'] = True
+            config['particles']['electrons'] = False
+            for experiment in config['experiments']:
+                experiment['initial_holes'] = experiment.pop('initial_electrons', 30)  # Remove initial_electrons if present
+        elif carrier_type == 'electron':
+            config['particles']['holes'] = False
+            config['particles']['electrons'] = True
+            for experiment in config['experiments']:
+                experiment['initial_electrons'] = experiment.pop('initial_holes', 30)  # Remove initial_holes if present
+        else:
+            raise ValueError("carrier_type must be either 'hole' or 'electron'")
 
     logger.info(f"Updated carrier type to {carrier_type} in {destination_path}")
+
+
+# Delta degrees of freedom of the standard deviation lightforge writes to mobilities_all_fields.dat, assumed to be the
+# population standard deviation (numpy default). The pooled standard deviation of shards is exact only with the right
+# value, which is why sharding is opt-in (global.lightforge_shards).
+LIGHTFORGE_STD_DDOF = 0
+
+# Key of the seed of the random number generator in the lightforge settings. Every shard gets its own seed (the seed
+# of the settings, or a random one, plus the index of the shard), so that replica shards do not repeat each other.
+LIGHTFORGE_SEED_KEY = 'seed'
+
+
+@dataclass
+class Shard:
+    """
+    Independent part of a lightforge experiment: some of its fields with some of its simulations (replicas).
+    """
+    name: str
+    settings: Dict[str, Any]
+    simulations: int
+    n_cpus: int
+
+
+def _split(count: int, parts: int) -> List[int]:
+    """
+    count split into parts sizes that differ by at most one, e.g. 10, 3 -> [4, 3, 3].
+    """
+    return [count // parts + (i < count % parts) for i in range(parts)]
+
+
+def _field_strengths(field_strength) -> List[Any]:
+    """
+    The fields of field_strength: a string of fields ("0.02 0.03 0.04"), a list of fields or one field.
+    """
+    if isinstance(field_strength, str):
+        return field_strength.split()
+    if isinstance(field_strength, (list, tuple)):
+        return list(field_strength)
+    return [field_strength]
+
+
+def _field_strength_like(field_strength, fields: List[Any]):
+    """
+    fields in the form of field_strength.
+    """
+    if isinstance(field_strength, str):
+        return ' '.join(fields)
+    if isinstance(field_strength, (list, tuple)):
+        return fields
+    return fields[0]
+
+
+def plan_shards(settings: Dict[str, Any], n_cpus: int, max_shards: int = None) -> List[Shard]:
+    """
+    Split the experiment of lightforge settings into at most min(n_cpus, max_shards) shards: first by field, then the
+    simulations of every field group by replica group. The cores are split evenly between the shards. Without
+    max_shards, and for settings with more than one experiment, the settings are not split. Every shard gets its own
+    seed, see LIGHTFORGE_SEED_KEY.
+    """
+    experiments = settings.get('experiments', [])
+    max_shards = max(1, min(n_cpus, max_shards or 1))
+    if len(experiments) != 1 or max_shards == 1:
+        return [Shard('all', settings, sum(e.get('simulations', 1) for e in experiments), n_cpus)]
+
+    experiment = experiments[0]
+    fields = _field_strengths(experiment['field_strength'])
+    simulations = experiment['simulations']
+    field_groups = min(len(fields), max_shards)
+    replica_groups = min(simulations, max_shards // field_groups)
+
+    base_seed = settings.get(LIGHTFORGE_SEED_KEY)
+    if base_seed is None:
+        base_seed = random.SystemRandom().randrange(2 ** 31 - max_shards)
+    shards = []
+    field_sizes = _split(len(fields), field_groups)
+    n_cpus_of_shards = _split(n_cpus, field_groups * replica_groups)
+    for field_group, field_size in enumerate(field_sizes):
+        first = sum(field_sizes[:field_group])
+        group_fields = fields[first:first + field_size]
+        for replica_group, replicas in enumerate(_split(simulations, replica_groups)):
+            shard_settings = copy.deepcopy(settings)
+            shard_experiment = shard_settings['experiments'][0]
+            shard_experiment['field_strength'] = _field_strength_like(experiment['field_strength'], group_fields)
+            shard_experiment['simulations'] = replicas
+            shard_settings[LIGHTFORGE_SEED_KEY] = base_seed + len(shards)
+            shards.append(Shard(f'fields{field_group}_replicas{replica_group}', shard_settings, replicas,
+                                n_cpus_of_shards[len(shards)]))
+    return shards
+
+
+def merge_mobilities(shard_results: Sequence[Tuple[str, int]], output_path: str,
+                     ddof: int = LIGHTFORGE_STD_DDOF) -> None:
+    """
+    Merge the mobilities_all_fields.dat files of shards (path, number of simulations) into one. Every row holds a
+    field, the mean mobility and the standard deviation (with ddof) of the mobilities of the simulations. Rows of the
+    same field are pooled: the mean weighted with the simulations and the standard deviation of all simulations,
+    sqrt((sum (n_i - ddof) * std_i^2 + sum n_i * (mean_i - mean)^2) / (sum n_i - ddof)). Further columns are kept as
+    means weighted with the simulations.
+    """
+    import numpy as np
+
+    rows = {}  # field -> [(simulations, mean, std, further columns...), ...]
+    for path, simulations in shard_results:
+        for row in np.loadtxt(path, ndmin=2):
+            rows.setdefault(float(f'{row[0]:.12g}'), []).append((simulations, *row[1:]))
+
+    merged = []
+    for field in sorted(rows):
+        counts, means, stds, *columns = np.array(rows[field]).T
+        total = counts.sum()
+        mean = counts @ means / total
+        variance = ((counts - ddof) @ stds ** 2 + counts @ (means - mean) ** 2) / max(total - ddof, 1)
+        merged.append((field, mean, np.sqrt(variance), *(counts @ column / total for column in columns)))
+    np.savetxt(output_path, np.array(merged).reshape(len(merged), -1))
+    logger.info(f"Merged the mobilities of {len(shard_results)} shards into {output_path}", fields=len(merged))
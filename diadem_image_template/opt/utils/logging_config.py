@@ -1,14 +1,167 @@
+"""
+Logging of the workflow into log.txt as JSON lines.
+
+Log calls only put the event into a queue; rendering and size capping happen in a background thread
+(logging.handlers.QueueListener) of every process. It passes the rendered lines on to a single writer thread in the
+process that configured logging, also from forked processes (stages, plot renderer). Values longer than
+MAX_FIELD_CHARS (e.g. the stdout of Deposit) are spilled to files in PAYLOAD_DIR and replaced by their head and the
+path of the spill file. The writer rotates log.txt at MAX_LOG_BYTES; as it is the only one, the processes do not
+race on the rotation.
+"""
+import atexit
+import itertools
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+
 import structlog
 
+LOG_FILE = 'log.txt'
+MAX_LOG_BYTES = 100 * 1024 ** 2
+LOG_BACKUP_COUNT = 5
+MAX_FIELD_CHARS = 64 * 1024
+PAYLOAD_HEAD_CHARS = 2 * 1024
+PAYLOAD_DIR = 'log_payloads'
+
+_configured = False
+_listener = None  # renders the records of this process, restarted in forked processes
+_writer = None  # writes the lines of all processes, only in the process that configured logging
+_writer_pid = None
+_payload_counter = itertools.count()
+
+
+def cap_field_sizes(logger, method_name, event_dict):
+    """
+    structlog processor: spill string values longer than MAX_FIELD_CHARS to a file in PAYLOAD_DIR.
+    """
+    for key, value in event_dict.items():
+        if isinstance(value, str) and len(value) > MAX_FIELD_CHARS:
+            os.makedirs(PAYLOAD_DIR, exist_ok=True)
+            path = os.path.join(PAYLOAD_DIR, f"{os.getpid()}_{next(_payload_counter):06d}_{key}.txt")
+            with open(path, 'w') as payload_file:
+                payload_file.write(value)
+            event_dict[key] = f"{value[:PAYLOAD_HEAD_CHARS]} . . . [{len(value)} characters, full payload in {path}]"
+    return event_dict
+
+
+class _EventQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues the record as it is. The default prepare() would render the message on the calling thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class _ForwardHandler(logging.Handler):
+    """
+    Renders a record and passes the line on to the writer, through a queue shared by forked processes.
+    """
+
+    def __init__(self, lines):
+        super().__init__()
+        self.lines = lines
+
+    def emit(self, record):
+        try:
+            self.lines.put(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _LineListener(logging.handlers.QueueListener):
+    """
+    Writes the rendered lines of all processes. multiprocessing.SimpleQueue has neither get(block) nor put_nowait.
+    """
+
+    def dequeue(self, block):
+        line = self.queue.get()
+        return line if line is self._sentinel else logging.makeLogRecord({'msg': line})
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def _start(listener):
+    if listener is not None and listener._thread is None:
+        listener.start()
+
+
+def _stop(listener):
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+
+def _start_listener():
+    _start(_listener)
+
+
+def _stop_listener():
+    _stop(_listener)
+
+
+def _stop_logging():
+    _stop_listener()
+    if os.getpid() == _writer_pid:  # a forked process must not stop the writer of the parent
+        _stop(_writer)
+
+
+def flush_logging():
+    """
+    Wait until the background threads have rendered every queued record; in the process that configured logging
+    also until every line (including those of forked processes that flushed) is written.
+    """
+    _stop_listener()
+    if os.getpid() == _writer_pid:
+        _stop(_writer)
+        _start(_writer)
+    _start_listener()
+
 
 def configure_logging():
-    logging.basicConfig(
-        filename='log.txt',
-        filemode='w',
-        format='%(message)s',
-        level=logging.INFO
-    )
+    """
+    Configure logging to log.txt. Every utils module calls this on import; only the first call does the work.
+    """
+    global _configured, _listener, _writer, _writer_pid
+    if _configured:
+        return
+    _configured = True
+
+    open(LOG_FILE, 'w').close()  # every run starts with an empty log.txt
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=MAX_LOG_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT)
+    lines = multiprocessing.get_context('fork').SimpleQueue()
+    _writer = _LineListener(lines, file_handler)
+    _writer_pid = os.getpid()
+    _writer.start()
+
+    forward_handler = _ForwardHandler(lines)
+    forward_handler.setFormatter(structlog.stdlib.ProcessorFormatter(
+        processors=[
+            structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            structlog.processors.format_exc_info,
+            cap_field_sizes,
+            structlog.processors.JSONRenderer(),
+        ],
+        foreign_pre_chain=[
+            structlog.stdlib.add_logger_name,
+            structlog.stdlib.add_log_level,
+            structlog.processors.TimeStamper(fmt="ISO"),
+        ],
+    ))
+
+    _listener = logging.handlers.QueueListener(queue.SimpleQueue(), forward_handler)
+    _start_listener()
+    atexit.register(_stop_logging)
+    # threads do not survive fork: drain the queue before forking and restart the listener in parent and child. The
+    # writer keeps running in the parent only.
+    os.register_at_fork(before=_stop_listener, after_in_parent=_start_listener, after_in_child=_start_listener)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(_EventQueueHandler(_listener.queue))
+    root_logger.setLevel(logging.INFO)
 
     structlog.configure(
         processors=[
@@ -16,7 +169,7 @@ def configure_logging():
             structlog.stdlib.add_logger_name,
             structlog.stdlib.add_log_level,
             structlog.processors.TimeStamper(fmt="ISO"),
-            structlog.processors.JSONRenderer()
+            structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
         ],
         context_class=dict,
         logger_factory=structlog.stdlib.LoggerFactory(),
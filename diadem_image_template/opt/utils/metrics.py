@@ -0,0 +1,224 @@
+"""
+Resource metrics of stages and of the commands they run.
+
+For every command, a background thread samples the whole process tree (e.g. mpirun and all its ranks) with psutil:
+peak RSS summed over the tree, disk bytes read and written and the number of processes. CPU time comes from
+getrusage of the terminated children. getrusage cannot tell concurrent commands apart, so these get no CPU time of
+their own; CommandGroupMetrics records the CPU time of the group instead. Every stage writes the metrics of its commands and its own totals to
+metrics.yml in its folder; aggregate_metrics combines the stage files into the metrics.yml of the run.
+"""
+import pathlib
+import resource
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import psutil
+import structlog
+
+from . import yaml_io
+
+# Get the logger
+logger = structlog.get_logger()
+
+SAMPLE_INTERVAL = 1.0  # seconds
+METRICS_FILE = 'metrics.yml'
+
+# metrics of the commands run since the current stage started. Stages running concurrently live in their own process.
+_command_metrics: List[Dict[str, Any]] = []
+# metrics of the groups of concurrent commands run since the current stage started.
+_group_metrics: List[Dict[str, Any]] = []
+
+
+def _cpu_seconds(who) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ProcessTreeSampler:
+    """
+    Context manager sampling the process tree below pid in a background thread.
+    """
+
+    def __init__(self, pid: int, interval: Optional[float] = None):
+        self.pid = pid
+        self.interval = interval or SAMPLE_INTERVAL
+        self.peak_rss = 0
+        self.max_processes = 0
+        self._io: Dict[int, Any] = {}  # last seen io counters per pid, processes may vanish between samples.
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample_loop(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                return
+
+    def sample(self):
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root, *root.children(recursive=True)]
+        except psutil.Error:
+            return
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+                self._io[process.pid] = process.io_counters()
+            except (psutil.Error, AttributeError):  # io_counters is not available on every platform.
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_processes = max(self.max_processes, len(processes))
+
+    @property
+    def read_bytes(self) -> int:
+        return sum(counters.read_bytes for counters in self._io.values())
+
+    @property
+    def write_bytes(self) -> int:
+        return sum(counters.write_bytes for counters in self._io.values())
+
+
+class CommandMetrics:
+    """
+    Context manager measuring a command started as process pid. The metrics are recorded for the current stage.
+    """
+
+    def __init__(self, command: str, pid: int, concurrent: bool = False):
+        self.command = command
+        self.concurrent = concurrent  # run in a CommandGroupMetrics, CPU time only for the group
+        self.sampler = ProcessTreeSampler(pid)
+        self.extra = {}  # further metrics of the command, e.g. the size of its output
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_seconds(resource.RUSAGE_CHILDREN)
+        self.sampler.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sampler.__exit__(exc_type, exc_value, traceback)
+        metrics = {
+            'command': self.command,
+            'wall_time_s': time.perf_counter() - self._start,
+            'cpu_time_s': None if self.concurrent else _cpu_seconds(resource.RUSAGE_CHILDREN) - self._cpu_start,
+            'peak_rss_bytes': self.sampler.peak_rss,
+            'read_bytes': self.sampler.read_bytes,
+            'write_bytes': self.sampler.write_bytes,
+            'max_processes': self.sampler.max_processes,
+            **self.extra,
+        }
+        _command_metrics.append(metrics)
+        logger.info("Command metrics", **metrics)
+
+
+def _own_io():
+    try:
+        return psutil.Process().io_counters()
+    except (psutil.Error, AttributeError):
+        return None
+
+
+class CommandGroupMetrics:
+    """
+    Context manager measuring commands run concurrently, each of them measured by a CommandMetrics(concurrent=True).
+    The group is recorded for the current stage with its wall time and the CPU time of all its commands.
+    """
+
+    def __init__(self, commands: List[str]):
+        self.commands = commands
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_seconds(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics = {
+            'commands': self.commands,
+            'wall_time_s': time.perf_counter() - self._start,
+            'cpu_time_s': _cpu_seconds(resource.RUSAGE_CHILDREN) - self._cpu_start,
+        }
+        _group_metrics.append(metrics)
+        logger.info("Concurrent command metrics", **metrics)
+
+
+class StageMetrics:
+    """
+    Context manager measuring a stage with all commands it runs. Writes metrics.yml into the current directory on
+    exit, also if the stage failed.
+    """
+
+    def __init__(self, stage: str, ncpus: int):
+        self.stage = stage
+        self.ncpus = ncpus
+
+    def __enter__(self):
+        _command_metrics.clear()
+        _group_metrics.clear()
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_seconds(resource.RUSAGE_SELF) + _cpu_seconds(resource.RUSAGE_CHILDREN)
+        self._io_start = _own_io()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        own_io = _own_io()
+        own_read = own_io.read_bytes - self._io_start.read_bytes if own_io and self._io_start else 0
+        own_write = own_io.write_bytes - self._io_start.write_bytes if own_io and self._io_start else 0
+        commands = list(_command_metrics)
+        metrics = {
+            'stage': self.stage,
+            'status': 'failed' if exc_type else 'completed',
+            'ncpus': self.ncpus,
+            'wall_time_s': time.perf_counter() - self._start,
+            'cpu_time_s': _cpu_seconds(resource.RUSAGE_SELF) + _cpu_seconds(resource.RUSAGE_CHILDREN) - self._cpu_start,
+            'peak_rss_bytes': max([psutil.Process().memory_info().rss] +
+                                  [command['peak_rss_bytes'] for command in commands]),
+            'read_bytes': own_read + sum(command['read_bytes'] for command in commands),
+            'write_bytes': own_write + sum(command['write_bytes'] for command in commands),
+            'commands': commands,
+        }
+        if _group_metrics:
+            metrics['concurrent_commands'] = list(_group_metrics)
+        with open(METRICS_FILE, 'wt') as outfile:
+            yaml_io.dumps(metrics, outfile, sort_keys=False)
+        logger.info(f"Stage {self.stage} metrics written to {METRICS_FILE}",
+                    **{key: value for key, value in metrics.items() if key != 'commands'})
+
+
+def aggregate_metrics(stage_dirs: Iterable[pathlib.Path], wall_time_s: Optional[float] = None,
+                      output: str = METRICS_FILE) -> Dict[str, Any]:
+    """
+    Combine the metrics.yml files of the stage folders into one metrics file of the whole run.
+    Stage folders without metrics.yml (e.g. stages that did not run) are left out.
+    """
+    stages = {}
+    for stage_dir in stage_dirs:
+        metrics_path = pathlib.Path(stage_dir) / METRICS_FILE
+        if metrics_path.is_file():
+            with open(metrics_path, 'r') as infile:
+                stage_metrics = yaml_io.loads(infile)
+            stage_metrics.pop('commands', None)
+            stages[pathlib.Path(stage_dir).name] = stage_metrics
+
+    total = {
+        'wall_time_s': wall_time_s if wall_time_s is not None else sum(m['wall_time_s'] for m in stages.values()),
+        'cpu_time_s': sum(m['cpu_time_s'] for m in stages.values()),
+        'peak_rss_bytes': max([m['peak_rss_bytes'] for m in stages.values()], default=0),
+        'read_bytes': sum(m['read_bytes'] for m in stages.values()),
+        'write_bytes': sum(m['write_bytes'] for m in stages.values()),
+        'core_seconds': sum(m['wall_time_s'] * m['ncpus'] for m in stages.values()),
+    }
+    metrics = {'total': total, 'stages': stages}
+    with open(output, 'wt') as outfile:
+        yaml_io.dumps(metrics, outfile, sort_keys=False)
+    return metrics
@@ -0,0 +1,132 @@
+"""
+Plots of the results, rendered off the critical path.
+
+plot_renderer.start() forks a renderer process that imports matplotlib (Agg) once and then renders the plots
+submitted by the stages, while the next stages compute. Stages running in forked processes submit through the same
+queue. The orchestrator calls plot_renderer.wait() before the final stage-out. The plot functions draw on their
+own Figure objects and never touch pyplot, so nothing is left over from one plot to the next.
+
+Without a started renderer (tests, single functions run by hand), submit renders right away.
+"""
+import multiprocessing
+import traceback
+from typing import Any, Callable, List, Optional, Sequence
+
+import structlog
+
+# Get the logger
+logger = structlog.get_logger()
+
+
+def _new_figure():
+    from matplotlib.figure import Figure
+
+    return Figure()
+
+
+def mobility_plot(path: str, fields: Sequence[float], mobilities: Sequence[float], stderrs: Sequence[float],
+                  zero_field_mobility: float, slope: float, confidence_interval: Sequence[float]) -> None:
+    """
+    Mobilities vs sqrt(field) with the Poole-Frenkel fit and the zero-field mobility with its confidence interval.
+    """
+    import numpy as np
+
+    sqrt_fields = np.sqrt(np.asarray(fields, dtype=float))
+    lower, upper = confidence_interval
+    figure = _new_figure()
+    axes = figure.subplots()
+    axes.errorbar(sqrt_fields, mobilities, yerr=stderrs, fmt='k.', label='Data')
+    axes.set_yscale('log')
+    axes.set_xlabel(r'$\sqrt{\mathrm{field}}$ $(\mathrm{V/cm})^{0.5}$')
+    axes.set_ylabel(r'$\mathrm{mobility}$ $(\mathrm{cm^2/Vs})$')
+
+    sqrt_field_range = np.linspace(0, sqrt_fields.max(), 100)
+    axes.plot(sqrt_field_range, zero_field_mobility * np.exp(slope * sqrt_field_range), 'r-',
+              label='Weighted Poole-Frenkel fit')
+    axes.errorbar(0, zero_field_mobility, yerr=[[zero_field_mobility - lower], [upper - zero_field_mobility]],
+                  fmt='bo', label=f'Zero-field mobility: {zero_field_mobility:.2e}')
+    axes.legend()
+    figure.savefig(path)
+
+
+def _render(function: Callable[..., None], args: tuple) -> Optional[str]:
+    try:
+        function(*args)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def _serve(jobs, done) -> None:
+    import matplotlib
+
+    matplotlib.use('Agg')  # headless, no display in the container.
+    import matplotlib.figure  # noqa: F401, imported while the stages compute
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            done.send(None)
+            return
+        function, args = job
+        done.send((f"{function.__name__}{args[:1]}", _render(function, args)))
+
+
+class PlotRenderer:
+    """
+    Background process rendering plots, see the module docstring.
+    """
+
+    def __init__(self):
+        self._process = None
+        self._jobs = None
+        self._done = None
+
+    def start(self) -> None:
+        context = multiprocessing.get_context('fork')
+        self._jobs = context.SimpleQueue()  # written by the orchestrator and the stage processes
+        self._done, done = context.Pipe(duplex=False)
+        self._process = context.Process(target=_serve, args=(self._jobs, done), name='plot_renderer', daemon=True)
+        self._process.start()
+        done.close()
+
+    def submit(self, function: Callable[..., None], *args: Any) -> None:
+        """
+        Render function(*args) in the renderer process. function has to be a module-level function.
+        """
+        if self._process is None:
+            error = _render(function, args)
+            if error:
+                logger.error(f"Failed to render {function.__name__}{args[:1]}", error=error)
+            return
+        self._jobs.put((function, args))
+
+    def wait(self) -> List[str]:
+        """
+        Wait until all submitted plots are rendered and stop the renderer. Returns the errors of the failed plots.
+        """
+        if self._process is None:
+            return []
+        errors = []
+        self._jobs.put(None)
+        while True:
+            try:
+                rendered = self._done.recv()
+            except EOFError:  # the renderer died
+                errors.append(f"The plot renderer exited with {self._process.exitcode}")
+                logger.error(errors[-1])
+                break
+            if rendered is None:
+                break
+            name, error = rendered
+            if error:
+                logger.error(f"Failed to render {name}", error=error)
+                errors.append(error)
+        self._process.join()
+        self._done.close()
+        self._process = None
+        return errors
+
+
+# renderer of this run, started by the orchestrator before the stages
+plot_renderer = PlotRenderer()
@@ -1,12 +1,8 @@
 import yaml
-from .logging_config import configure_logging
 import structlog
 import glob
 import os
 
-# Ensure the logging configuration is applied
-configure_logging()
-
 # Get the logger
 logger = structlog.get_logger()
 
@@ -1,15 +1,170 @@
 """
 helper function to write output files and extract relevant information into results.yml format.
+numpy is imported on first use: this module is imported at the start of the workflow,
+but its functions are only needed once the stages produced their output.
 """
+import os
+import re
 import sys
 from typing import Any, Dict, List
 
-import yaml
-import re
-import numpy as np
-from sklearn.linear_model import LinearRegression
-import matplotlib.pyplot as plt
-import math
+import structlog
+
+from . import yaml_io
+from .plots import mobility_plot, plot_renderer
+
+# Get the logger
+logger = structlog.get_logger()
+
+
+BOOTSTRAP_RESAMPLES = 4000
+CONFIDENCE_LEVEL = 0.95
+
+
+def fit_line(x, y, weights=None):
+    """
+    (Weighted) least squares fit of y = intercept + slope * x. Returns (intercept, slope).
+    y may hold several data sets as rows (shape (m, n) for n values of x); intercept and slope are then arrays of
+    length m, all fitted in one array operation.
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.ones_like(x) if weights is None else np.asarray(weights, dtype=float)
+    weights = weights / weights.sum()
+    x_mean = weights @ x
+    y_mean = y @ weights
+    dx = x - x_mean
+    slope = ((y - y_mean[..., None]) @ (weights * dx)) / (weights @ dx ** 2)
+    intercept = y_mean - slope * x_mean
+    if y.ndim == 1:
+        return float(intercept), float(slope)
+    return intercept, slope
+
+
+def poole_frenkel_fit(fields, mobilities, stderrs, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE_LEVEL,
+                      seed=0):
+    """
+    Weighted Poole-Frenkel fit log(mobility) = log(mobility_0) + slope * sqrt(field). The weights are
+    1 / var(log(mobility)) with the standard error of log(mobility) approximated by stderr / mobility.
+    The confidence interval of the zero-field mobility comes from a parametric bootstrap in log space, where the
+    fit is done: the resamples of log(mobility) are normal with the standard errors of log(mobility), so a resampled
+    mobility is always positive. All resamples are drawn and fitted at once.
+    Returns (zero_field_mobility, slope, (lower, upper)).
+    """
+    import numpy as np
+
+    sqrt_fields = np.sqrt(np.asarray(fields, dtype=float))
+    mobilities = np.asarray(mobilities, dtype=float)
+    stderrs = np.asarray(stderrs, dtype=float)
+    log_stderrs = stderrs / mobilities
+    if np.all(log_stderrs > 0):
+        weights = 1 / log_stderrs ** 2
+    else:  # without an error estimate for every field, all fields count the same
+        weights = None
+    log_zero_field_mobility, slope = fit_line(sqrt_fields, np.log(mobilities), weights)
+
+    rng = np.random.default_rng(seed)
+    log_samples = rng.normal(np.log(mobilities), log_stderrs, size=(resamples, len(mobilities)))
+    log_intercepts, _ = fit_line(sqrt_fields, log_samples, weights)
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.exp(np.percentile(log_intercepts, [tail, 100 - tail]))
+    return float(np.exp(log_zero_field_mobility)), float(slope), (float(lower), float(upper))
+
+
+# DensityAnalysis.out: one line per sample and unit, then the summary lines, e.g.
+#   computing density for cuts 9.61 7.91 9.34: 1.1168705941 g/cm3
+#   computing density for cuts 9.61 7.91 9.34: 4.394E+21 1/cm3
+#   box density avg over 20 samples: 1.13 +. 0.01
+#   box density avg over 20 samples: 4.40E+21 + 1.43E+20
+#   molecular volume in nm3: 0.23
+#   First peak in RDF: 5.297805642633229
+#   Avergae neighbors of 80d0 around central 80d0: 19.8
+_NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+DENSITY_SAMPLE_PATTERN = re.compile(rf'computing density for cuts .*:\s*{_NUMBER}\s+(g/cm3|1/cm3)\s*$')
+DENSITY_SUMMARY_PATTERN = re.compile(rf'box density avg over (\d+) samples:\s*{_NUMBER}\s.*?\s{_NUMBER}\s*$')
+DENSITY_VALUE_PATTERNS = {
+    "molecular_volume": re.compile(rf'molecular volume in nm3:\s*{_NUMBER}'),
+    "rdf_first_peak": re.compile(rf'First peak in RDF:\s*{_NUMBER}'),
+    "average_neighbors": re.compile(rf'Aver(?:age|gae) neighbors of .* around .*:\s*{_NUMBER}'),
+}
+DENSITY_UNITS = {"g/cm3": "mass_density", "1/cm3": "number_density"}
+
+
+def _rounding_tolerance(number: str) -> float:
+    """
+    Half a unit of the last digit of a printed number, e.g. 0.005 for '1.13' and 5E+18 for '4.40E+21'.
+    """
+    mantissa, _, exponent = number.lower().partition('e')
+    decimals = len(mantissa.partition('.')[2])
+    return 0.5 * 10.0 ** (int(exponent or 0) - decimals)
+
+
+def _sample_statistics(values) -> Dict[str, Any]:
+    import numpy as np
+
+    return {
+        "value": float(values.mean()),
+        "std": float(values.std()),
+        "stderr": float(values.std(ddof=1) / np.sqrt(values.size)) if values.size > 1 else None,
+        "samples": int(values.size),
+    }
+
+
+def density_analysis(filepath: str) -> Dict[str, Any]:
+    """
+    Read DensityAnalysis.out line by line. The per-sample densities of each unit are collected into arrays and give
+    value (mean), std (standard deviation of the samples, as in the summary lines), stderr (standard error of the
+    mean) and samples; the rounded summary lines only cross-check them. Output without per-sample lines falls back
+    to the summary lines. Returns {mass_density: {...}, number_density: {...}, molecular_volume: float, ...} with
+    the quantities found in the file.
+    """
+    import numpy as np
+
+    samples = {quantity: [] for quantity in DENSITY_UNITS.values()}
+    summaries = []
+    analysis = {}
+    with open(filepath, 'r') as file:
+        for line in file:
+            match = DENSITY_SAMPLE_PATTERN.search(line)
+            if match:
+                samples[DENSITY_UNITS[match.group(2)]].append(float(match.group(1)))
+                continue
+            match = DENSITY_SUMMARY_PATTERN.search(line)
+            if match:
+                summaries.append(match.groups())
+                continue
+            for quantity, pattern in DENSITY_VALUE_PATTERNS.items():
+                match = pattern.search(line)
+                if match:
+                    analysis[quantity] = float(match.group(1))
+                    break
+
+    for quantity, values in samples.items():
+        if values:
+            analysis[quantity] = _sample_statistics(np.array(values))
+
+    # summary lines in the order of the units: mass density, then number density
+    for quantity, (count, mean, std) in zip(DENSITY_UNITS.values(), summaries):
+        statistics = analysis.get(quantity)
+        if statistics is None:
+            logger.warning(f"No per-sample {quantity} in {filepath}, using its summary line")
+            analysis[quantity] = {"value": float(mean), "std": float(std)}
+        elif statistics["samples"] != int(count) \
+                or abs(statistics["value"] - float(mean)) > _rounding_tolerance(mean) \
+                or abs(statistics["std"] - float(std)) > _rounding_tolerance(std):
+            logger.warning(f"The {quantity} of the samples in {filepath} does not match its summary line",
+                           samples=statistics["samples"], value=statistics["value"], std=statistics["std"],
+                           summary=f"{count} samples: {mean} +- {std}")
+    return analysis
+
+
+def _submit_mobility_plot(hole_or_electron, fields, mobilities, stderr_values, zero_field_mobility, slope,
+                          confidence_interval) -> None:
+    plot_renderer.submit(mobility_plot, os.path.abspath(f'{hole_or_electron}_mobility_vs_sqrt_field.png'),
+                         fields.tolist(), mobilities.tolist(), stderr_values.tolist(), zero_field_mobility, slope,
+                         tuple(confidence_interval))
 
 
 class get_result_from:
@@ -19,12 +174,12 @@ class get_result_from:
         yaml_file: mol_data.yml, QPParametrizer output.
         data_dict: template result.ynl from /opt/tmpl/ folders.
         """
+        import numpy as np
 
         def get_dipole_value_from_vector(vector_dipole: List):
             return float(np.sqrt(vector_dipole[0] ** 2 + vector_dipole[1] ** 2 + vector_dipole[2] ** 2))
 
-        with open(yaml_file, 'r') as file:
-            yaml_data = yaml.safe_load(file)
+        yaml_data = yaml_io.load(yaml_file)
 
         if 'homo energy' in yaml_data:
             local_result['HOMO']['value'] = yaml_data['homo energy']
@@ -39,46 +194,18 @@ class get_result_from:
 
     @staticmethod
     def Deposit(local_result: Dict[str, Any], filepath: str) -> None:
-        with open(filepath, 'r') as file:
-            text = file.read()
-
-        # More relaxed regular expression to match the desired patterns
-
-        box_density_pattern = re.compile(
-            r'box density avg over 20 samples:\s*([\d.]+(?:[eE][+-]?\d+)?)\s.*?\s([\d.]+(?:[eE][+-]?\d+)?)')  # output style of DensityAnalysis is error prone and hard to parse.
-
-        volume_pattern = re.compile(r'molecular volume in nm3: ([\d.]+)')
-        rdf_peak_pattern = re.compile(r'First peak in RDF: ([\d.]+)')
-        neighbors_pattern = re.compile(r'Avergae neighbors of 80d0 around central 80d0: ([\d.]+)')
-
-        # Extracting mass density and number density
-        box_density_matches = box_density_pattern.findall(text)
-        if box_density_matches:
-            # First match is the mass density
-            mass_density_match = box_density_matches[0]
-            local_result["morphology"]["results"]["mass_density"]["value"] = float(mass_density_match[0])
-            local_result["morphology"]["results"]["mass_density"]["std"] = float(mass_density_match[1])
-
-            # Second match is the number density (if available)
-            if len(box_density_matches) > 1:
-                number_density_match = box_density_matches[1]
-                local_result["morphology"]["results"]["number_density"]["value"] = float(number_density_match[0])
-                local_result["morphology"]["results"]["number_density"]["std"] = float(number_density_match[1])
-
-        # Extracting molecular volume
-        volume_match = volume_pattern.search(text)
-        if volume_match:
-            local_result["morphology"]["results"]["molecular_volume"]["value"] = float(volume_match.group(1))
-
-        # Extracting first peak in RDF
-        rdf_peak_match = rdf_peak_pattern.search(text)
-        if rdf_peak_match:
-            local_result["morphology"]["results"]["rdf_first_peak"]["value"] = float(rdf_peak_match.group(1))
-
-        # Extracting average neighbors
-        neighbors_match = neighbors_pattern.search(text)
-        if neighbors_match:
-            local_result["morphology"]["results"]["average_neighbors"]["value"] = float(neighbors_match.group(1))
+        """
+        filepath: DensityAnalysis.out of QuantumPatchAnalysis.
+        The densities are the statistics of the per-sample densities, see density_analysis.
+        """
+        analysis = density_analysis(filepath)
+        results = local_result["morphology"]["results"]
+        for quantity in ("mass_density", "number_density"):
+            if quantity in analysis:
+                results[quantity].update(analysis[quantity])
+        for quantity in ("molecular_volume", "rdf_first_peak", "average_neighbors"):
+            if quantity in analysis:
+                results[quantity]["value"] = analysis[quantity]
 
     @staticmethod
     def lightforge(local_result: Dict[str, Any], mobilities_file: str, settings_file: str, hole_or_electron: str) -> None:
@@ -86,63 +213,51 @@ class get_result_from:
         if hole_or_electron not in ['hole', 'electron']:
             sys.exit(f'hole_or_electron may be either "hole" or "electron". It is: {hole_or_electron}. Exiting . . . ')
 
-        # Read data from mobilities_all_fields.dat
-        fields = []
-        mobilities = []
-        stderrs = []
+        import numpy as np
 
-        with open(mobilities_file, 'r') as file:
-            for line in file:
-                parts = line.split()
-                fields.append(float(parts[0]))
-                mobilities.append(float(parts[1]))
-                stderrs.append(float(parts[2]))
+        # Read data from mobilities_all_fields.dat: field, mobility, standard deviation over the simulations
+        fields, mobilities, stderrs = np.loadtxt(mobilities_file, usecols=(0, 1, 2), ndmin=2, unpack=True)
 
         # Read the number of simulations (samples) from the settings YAML file
-        with open(settings_file, 'r') as file:
-            settings = yaml.safe_load(file)
-            num_samples = settings['experiments'][0]['simulations']
+        settings = yaml_io.load(settings_file)
+        num_samples = settings['experiments'][0]['simulations']
 
         # Fill in the local_result dictionary
 
         hole_or_electron_mobility = f'{hole_or_electron}_mobility'
 
-        local_result[hole_or_electron_mobility]["results"]["fields"]["values"] = list(fields)
-        local_result[hole_or_electron_mobility]["results"]["mobilities"]["values"] = list(mobilities)
+        results = local_result[hole_or_electron_mobility]["results"]
+        results["fields"]["values"] = fields.tolist()
+        results["mobilities"]["values"] = mobilities.tolist()
 
         # Calculate standard error
-        stderr_values = [float(std / np.sqrt(num_samples)) for std in stderrs]
-        local_result[hole_or_electron_mobility]["results"]["stderr"]["values"] = list(stderr_values)
-
-        # Perform linear regression to find the zero-field mobility
-        sqrt_fields = np.sqrt(fields).reshape(-1, 1)
-        log_mobilities = np.log(mobilities).reshape(-1, 1)
+        stderr_values = stderrs / np.sqrt(num_samples)
+        results["stderr"]["values"] = stderr_values.tolist()
 
-        model = LinearRegression()
-        model.fit(sqrt_fields, log_mobilities)
-        log_zero_field_mobility = model.intercept_[0]
-        zero_field_mobility = np.exp(log_zero_field_mobility)
+        # Weighted Poole-Frenkel fit for the zero-field mobility, with bootstrap confidence interval
+        zero_field_mobility, slope, (lower, upper) = poole_frenkel_fit(fields, mobilities, stderr_values)
 
         # Set the zero-field mobility in the local_result dictionary
-        local_result[hole_or_electron_mobility]["value"] = float(zero_field_mobility)
-
-        # Plotting the data and the regression line
-        plt.figure()
-        plt.errorbar(sqrt_fields, mobilities, yerr=stderr_values, fmt='k.', label='Data')
-        plt.yscale('log')
-        plt.xlabel(r'$\sqrt{\mathrm{field}}$ $(\mathrm{V/cm})^{0.5}$')
-        plt.ylabel(r'$\mathrm{mobility}$ $(\mathrm{cm^2/Vs})$')
+        local_result[hole_or_electron_mobility]["value"] = zero_field_mobility
+        results.setdefault("zero_field_mobility_ci", {"units": results["mobilities"].get("units")})
+        results["zero_field_mobility_ci"]["values"] = [lower, upper]
+        results["zero_field_mobility_ci"]["confidence_level"] = CONFIDENCE_LEVEL
 
-        # Generate points for the regression line
-        sqrt_field_range = np.linspace(0, sqrt_fields.max(), 100).reshape(-1, 1)
-        log_mobility_pred = model.predict(sqrt_field_range)
-        mobility_pred = np.exp(log_mobility_pred)
+        # Plot of the data and the fit, rendered in the background (see utils.plots)
+        _submit_mobility_plot(hole_or_electron, fields, mobilities, stderr_values, zero_field_mobility, slope,
+                              (lower, upper))
 
-        plt.plot(sqrt_field_range, mobility_pred, 'r-', label='Regression line')
-
-        # Mark the zero-field mobility point
-        plt.plot(0, zero_field_mobility, 'bo', label=f'Zero-field mobility: {zero_field_mobility:.2e}')
-
-        plt.legend()
-        plt.savefig(f'{hole_or_electron}_mobility_vs_sqrt_field.png')
-        # plt.show()
+    @staticmethod
+    def lightforge_plot(local_result: Dict[str, Any], hole_or_electron: str) -> None:
+        """
+        Submit the plot of get_result_from.lightforge again from its result, e.g. for a resumed stage whose plot is
+        missing. The fit is repeated with the same seed, so the plot is the same.
+        """
+        import numpy as np
+
+        results = local_result[f'{hole_or_electron}_mobility']["results"]
+        fields, mobilities, stderr_values = (np.array(results[quantity]["values"], dtype=float)
+                                             for quantity in ("fields", "mobilities", "stderr"))
+        zero_field_mobility, slope, confidence_interval = poole_frenkel_fit(fields, mobilities, stderr_values)
+        _submit_mobility_plot(hole_or_electron, fields, mobilities, stderr_values, zero_field_mobility, slope,
+                              confidence_interval)
@@ -0,0 +1,118 @@
+"""
+Content-addressed cache of stage results.
+
+A stage result is addressed by the molecule, the stage name, the resolved settings of the stage, the hashes of its
+input files and the tool version. An entry holds the out folder of the stage, the diadem files it produced and
+its result.yml fragment:
+
+<cache_dir>/<stage>/<key>/out/...
+<cache_dir>/<stage>/<key>/diadem_files/...
+<cache_dir>/<stage>/<key>/result.yml
+
+Out folders are staged into and out of the cache as read-only hardlinks if the cache is on the same filesystem.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+from typing import Any, Dict, Iterable, Optional, Union
+
+import structlog
+
+from . import yaml_io
+from .staging import stage_files
+
+# Get the logger
+logger = structlog.get_logger()
+
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path: Union[str, pathlib.Path]) -> str:
+    """
+    sha256 of a file, read in chunks.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_directory(directory: Union[str, pathlib.Path]) -> Dict[str, str]:
+    """
+    sha256 of every file in a directory tree by path relative to the directory.
+    """
+    directory = pathlib.Path(directory)
+    return {file.relative_to(directory).as_posix(): hash_file(file)
+            for file in sorted(directory.rglob('*')) if file.is_file()}
+
+
+class StageCache:
+    def __init__(self, cache_dir: Union[str, pathlib.Path]):
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    @staticmethod
+    def key(molecule: str, stage: str, settings: Dict[str, Any], input_dirs: Iterable[Union[str, pathlib.Path]],
+            tool_version: str) -> str:
+        """
+        input_dirs: folders with the input files of the stage, i.e. the out folders of its dependencies.
+        """
+        inputs = {str(input_dir): hash_directory(input_dir) for input_dir in input_dirs}
+        description = {'molecule': molecule, 'stage': stage, 'settings': settings, 'inputs': inputs,
+                       'tool_version': tool_version}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry(self, stage: str, key: str) -> pathlib.Path:
+        return self.cache_dir / stage / key
+
+    def restore(self, stage: str, key: str, diadem_dir: Union[str, pathlib.Path],
+                output_dir: str = 'out') -> Optional[Dict[str, Any]]:
+        """
+        Restore the out folder (into the current directory) and the diadem files of a cached stage.
+        Returns the result.yml fragment of the stage ({} if the stage has none) or None if the key is not cached.
+        """
+        entry = self._entry(stage, key)
+        if not (entry / 'result.yml').is_file():
+            logger.info(f"Stage cache miss for {stage}", key=key)
+            return None
+
+        pathlib.Path(output_dir).mkdir(exist_ok=True)
+        # the entry never shares an inode with the work directory: a tool writing into an input does not change it.
+        stage_files((entry / output_dir).iterdir(), output_dir, read_only=True, hardlink=False)
+        # the diadem files of an earlier run may be hardlinks: replaced, not written through.
+        stage_files((entry / 'diadem_files').iterdir(), diadem_dir)
+        result = yaml_io.load(entry / 'result.yml', cached=False) or {}
+        if result:
+            yaml_io.save(result, 'result.yml', safe=False)
+        logger.info(f"Stage cache hit for {stage}: restored {entry}", key=key)
+        return result
+
+    def store(self, stage: str, key: str, diadem_files: Iterable[Union[str, pathlib.Path]],
+              result: Optional[Dict[str, Any]], output_dir: str = 'out') -> None:
+        """
+        Store the out folder of the current directory, the diadem files and the result fragment of a stage.
+        The entry is assembled in a temporary folder and renamed into place, so readers never see partial entries.
+        """
+        entry = self._entry(stage, key)
+        if entry.is_dir():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_entry = pathlib.Path(tempfile.mkdtemp(prefix=f'.{key}_', dir=entry.parent))
+        try:
+            (tmp_entry / output_dir).mkdir()
+            if pathlib.Path(output_dir).is_dir():
+                stage_files(pathlib.Path(output_dir).iterdir(), tmp_entry / output_dir, read_only=True,
+                            hardlink=False)
+            (tmp_entry / 'diadem_files').mkdir()
+            for file in diadem_files:
+                shutil.copy(file, tmp_entry / 'diadem_files')
+            yaml_io.save(result or {}, tmp_entry / 'result.yml', safe=False)
+            os.rename(tmp_entry, entry)
+            logger.info(f"Stored {stage} in the stage cache: {entry}", key=key)
+        except OSError as e:
+            # another run may have stored the same entry in the meantime; a failing cache must not fail the stage.
+            logger.warning(f"Failed to store {stage} in the stage cache", key=key, error=str(e))
+            shutil.rmtree(tmp_entry, ignore_errors=True)
@@ -0,0 +1,197 @@
+"""
+Stage graph of the workflow.
+
+Every stage declares the files it needs (inputs), the files it hands over to later stages (outputs)
+and the stages it depends on. Stages whose dependencies are all done run together; when more than one
+stage is ready, each of them runs in its own forked process and the core budget is split between them.
+"""
+import multiprocessing
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional
+
+import structlog
+
+from .logging_config import flush_logging
+
+# Get the logger
+logger = structlog.get_logger()
+
+
+class StageError(RuntimeError):
+    """
+    Raised when one or more stages of the graph failed.
+    """
+
+    def __init__(self, failed: Dict[str, str]):
+        self.failed = failed
+        super().__init__(f"Stage(s) failed: {', '.join(f'{name}: {error}' for name, error in failed.items())}")
+
+
+@dataclass
+class Stage:
+    """
+    name: name of the stage, usually Executable.value.
+    run: callable taking the number of cores given to the stage and returning its result.yml fragment (or None).
+    depends_on: names of the stages that have to be finished before this one starts.
+    inputs: files the stage expects from the outputs of its dependencies.
+    outputs: files the stage hands over to later stages (its required_files).
+    """
+    name: str
+    run: Callable[[int], Optional[Dict[str, Any]]]
+    depends_on: List[str] = field(default_factory=list)
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+
+
+def split_cores(ncpus: int, nstages: int) -> List[int]:
+    """
+    Split ncpus between nstages as evenly as possible. Every stage gets at least one core.
+    """
+    base, remainder = divmod(ncpus, nstages)
+    return [max(1, base + (1 if i < remainder else 0)) for i in range(nstages)]
+
+
+def _run_in_child(stage: Stage, ncpus: int, connection) -> None:
+    try:
+        connection.send((True, stage.run(ncpus)))
+    except BaseException as e:  # the parent has to learn about every failure, also about sys.exit.
+        connection.send((False, f"{type(e).__name__}: {e}"))
+    finally:
+        connection.close()
+        flush_logging()  # the child ends with os._exit, atexit handlers do not run.
+
+
+class StageGraph:
+    def __init__(self, stages: List[Stage]):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Stage {stage.name} is defined twice.")
+            self.stages[stage.name] = stage
+        self.supplied: List[str] = []  # stages outside of a selected graph whose outputs the graph depends on.
+        self._validate()
+
+    def _validate(self):
+        for stage in self.stages.values():
+            unknown = [dep for dep in stage.depends_on if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage(s): {unknown}")
+            provided = {output for dep in stage.depends_on for output in self.stages[dep].outputs}
+            missing = [input_file for input_file in stage.inputs if input_file not in provided]
+            if missing:
+                raise ValueError(f"Inputs {missing} of stage {stage.name} are not outputs of its dependencies "
+                                 f"{stage.depends_on}.")
+        self.levels()  # raises on cycles
+
+    def levels(self) -> List[List[Stage]]:
+        """
+        Group the stages into levels. All stages of a level only depend on stages of previous levels.
+        Within a level, the order of definition is kept.
+        """
+        done = set()
+        levels = []
+        remaining = list(self.stages.values())
+        while remaining:
+            ready = [stage for stage in remaining if all(dep in done for dep in stage.depends_on)]
+            if not ready:
+                raise ValueError(f"Cyclic dependencies between stages: {[stage.name for stage in remaining]}")
+            levels.append(ready)
+            done.update(stage.name for stage in ready)
+            remaining = [stage for stage in remaining if stage.name not in done]
+        return levels
+
+    def ancestors(self, name: str) -> List[str]:
+        """
+        Names of all stages the stage depends on, directly or indirectly.
+        """
+        found = set()
+        pending = list(self.stages[name].depends_on)
+        while pending:
+            dependency = pending.pop()
+            if dependency not in found:
+                found.add(dependency)
+                pending.extend(self.stages[dependency].depends_on)
+        return [stage for stage in self.stages if stage in found]
+
+    def descendants(self, name: str) -> List[str]:
+        """
+        Names of all stages that depend on the stage, directly or indirectly.
+        """
+        return [stage for stage in self.stages if name in self.ancestors(stage)]
+
+    def select(self, start_from: Optional[str] = None, stop_after: Optional[str] = None) -> 'StageGraph':
+        """
+        Graph of the stages from start_from (and everything depending on it) up to stop_after (and everything it
+        depends on). Dependencies of the selected stages that are not selected are listed in supplied of the new graph:
+        their outputs have to be supplied in the working directory.
+        """
+        for name in (start_from, stop_after):
+            if name is not None and name not in self.stages:
+                raise ValueError(f"Unknown stage {name}. Known stages: {list(self.stages)}")
+        selected = set(self.stages)
+        if start_from is not None:
+            selected &= {start_from, *self.descendants(start_from)}
+        if stop_after is not None:
+            selected &= {stop_after, *self.ancestors(stop_after)}
+        if not selected:
+            raise ValueError(f"No stage to run from {start_from} up to {stop_after}.")
+
+        stages = []
+        for stage in self.stages.values():
+            if stage.name not in selected:
+                continue
+            depends_on = [dependency for dependency in stage.depends_on if dependency in selected]
+            provided = {output for dependency in depends_on for output in self.stages[dependency].outputs}
+            stages.append(replace(stage, depends_on=depends_on,
+                                  inputs=[input_file for input_file in stage.inputs if input_file in provided]))
+        graph = StageGraph(stages)
+        graph.supplied = [name for name in self.stages if name not in selected and any(
+            name in self.stages[stage].depends_on for stage in selected)]
+        return graph
+
+    def run(self, ncpus: int) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Run all stages level by level. Returns the result fragment of every stage by stage name.
+        Raises StageError if any stage failed; stages of the same level are allowed to finish first.
+        """
+        results = {}
+        for level in self.levels():
+            cores = split_cores(ncpus, len(level))
+            logger.info("Starting stage level", stages=[stage.name for stage in level], cores=cores)
+            if len(level) == 1:
+                stage = level[0]
+                try:
+                    results[stage.name] = stage.run(cores[0])
+                except Exception as e:
+                    raise StageError({stage.name: f"{type(e).__name__}: {e}"}) from e
+            else:
+                results.update(self._run_concurrently(level, cores))
+        return results
+
+    @staticmethod
+    def _run_concurrently(level: List[Stage], cores: List[int]) -> Dict[str, Optional[Dict[str, Any]]]:
+        context = multiprocessing.get_context('fork')  # stages change directory, so they can not share a process.
+        children = []
+        for stage, ncpus in zip(level, cores):
+            parent_connection, child_connection = context.Pipe(duplex=False)
+            process = context.Process(target=_run_in_child, args=(stage, ncpus, child_connection), name=stage.name)
+            process.start()
+            child_connection.close()
+            children.append((stage, process, parent_connection))
+
+        results = {}
+        failed = {}
+        for stage, process, connection in children:
+            try:
+                success, payload = connection.recv()
+            except EOFError:
+                success, payload = False, "process died without reporting a result"
+            process.join()
+            if success:
+                results[stage.name] = payload
+            else:
+                logger.error(f"Stage {stage.name} failed", error=payload, exitcode=process.exitcode)
+                failed[stage.name] = payload
+        if failed:
+            raise StageError(failed)
+        return results
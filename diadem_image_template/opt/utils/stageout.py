@@ -0,0 +1,235 @@
+"""
+Stage-out bundle of the work directory: workdir_bundle.tar.gz and its manifest.
+
+The tar stream is cut into blocks that are gzip-compressed in parallel and written in order; the concatenated gzip
+members form a valid .tar.gz (as written by pigz). Only regular files up to max_file_bytes go into the bundle, except
+the logs (log.txt and the stderr of the commands), of which the last max_file_bytes are bundled when they are larger.
+Scratch folders are excluded, and so are files that are inside the stage zips (<Executable>_debugFiles.zip, ...) in
+the work directory already. The manifest lists every file that was included and every file that was skipped with
+the reason.
+
+If the work directory has an artifact manifest (see utils.artifacts), files with the same content go into the bundle
+once and the manifest records the sha256 of every included file, without hashing anything again.
+
+Run in the work directory after the workflow:
+    PYTHONPATH=/opt python -m utils.stageout
+The command does not configure the logging, as that would truncate log.txt of the run.
+"""
+import argparse
+import fnmatch
+import gzip
+import os
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import structlog
+import yaml
+
+from . import yaml_io
+from .artifacts import MANIFEST_FILE as ARTIFACT_MANIFEST_FILE
+from .core_planner import available_cores
+
+# Get the logger
+logger = structlog.get_logger()
+
+BUNDLE_FILE = 'workdir_bundle.tar.gz'
+MANIFEST_FILE = 'workdir_bundle_manifest.yml'
+DEFAULT_MAX_FILE_BYTES = 500 * 1024
+DEFAULT_COMPRESSLEVEL = 6
+BLOCK_BYTES = 1024 ** 2
+STAGE_ZIP_SUFFIXES = ('_debugFiles.zip', '_optionalFiles.zip', '_errorStageOut.zip')
+EXCLUDED_DIRS = ('deposit_scratch', 'qp_scratch_*')
+TAIL_FILES = ('log.txt', '*_stderr.log', '*.stderr')  # the log of the run, the stderr of the commands and of lightforge
+
+
+class ParallelGzipWriter:
+    """
+    Binary file object compressing what is written in blocks of BLOCK_BYTES on a thread pool, each block as an own
+    gzip member. The blocks are written to fileobj in order.
+    """
+
+    def __init__(self, fileobj, compresslevel: int = DEFAULT_COMPRESSLEVEL, max_workers: Optional[int] = None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.max_workers = max_workers or available_cores()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._buffer = bytearray()
+        self._pending = deque()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_BYTES:
+            self._submit(bytes(self._buffer[:BLOCK_BYTES]))
+            del self._buffer[:BLOCK_BYTES]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        self._write_pending(2 * self.max_workers)  # bound the memory of blocks waiting to be written
+
+    def _write_pending(self, keep: int) -> None:
+        while len(self._pending) > keep:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        self._write_pending(0)
+        self._executor.shutdown()
+
+
+def files_in_stage_zips(root: str) -> Dict[str, int]:
+    """
+    Paths (relative to root) and sizes of the files that are inside the stage zips in root. The members of
+    <Executable>_<kind>.zip are relative to the simulation folder <Executable>.
+    """
+    zipped = {}
+    for name in sorted(os.listdir(root)):
+        suffix = next((suffix for suffix in STAGE_ZIP_SUFFIXES if name.endswith(suffix)), None)
+        if suffix is None:
+            continue
+        stage_dir = name[:-len(suffix)]
+        try:
+            with zipfile.ZipFile(os.path.join(root, name)) as zf:
+                for zinfo in zf.infolist():
+                    zipped[os.path.normpath(os.path.join(stage_dir, zinfo.filename))] = zinfo.file_size
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.warning(f"Failed to read {name}: {e}")
+    return zipped
+
+
+def artifact_hashes(root: str) -> Dict[str, Dict[str, Any]]:
+    """
+    The files recorded in the artifact manifest of root, {} if there is none.
+    """
+    try:
+        with open(os.path.join(root, ARTIFACT_MANIFEST_FILE), 'r') as infile:
+            return (yaml_io.loads(infile) or {}).get('files', {})
+    except (OSError, yaml.YAMLError):
+        return {}
+
+
+def tail_size(path: str, size: int, max_file_bytes: int) -> int:
+    """
+    Size of the tail of a file larger than max_file_bytes that goes into the bundle: at most the last max_file_bytes,
+    starting at a line if there is a line break in them.
+    """
+    with open(path, 'rb') as infile:
+        infile.seek(size - max_file_bytes)
+        tail = infile.read(max_file_bytes)
+    line_start = tail.find(b'\n') + 1
+    return len(tail) - line_start if 0 < line_start < len(tail) else len(tail)
+
+
+def select_files(root: str, max_file_bytes: int, excluded_dirs: Iterable[str] = EXCLUDED_DIRS,
+                 excluded_files: Iterable[str] = (), tail_files: Iterable[str] = TAIL_FILES) \
+        -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Walk root and decide for every regular file whether it goes into the bundle. Of the files matching a pattern of
+    tail_files only the tail goes into the bundle if they are larger than max_file_bytes.
+    Returns the included {'path', 'size'[, 'sha256' | 'truncated_from']} and the skipped {'path', 'size', 'reason'}
+    files, paths relative to root. The size of a truncated file is the size of its tail.
+    """
+    excluded_dirs = tuple(excluded_dirs)
+    tail_files = tuple(tail_files)
+    excluded_files = {os.path.normpath(file) for file in excluded_files}
+    zipped = files_in_stage_zips(root)
+    hashes = artifact_hashes(root)
+    included_content = {}  # sha256: path of the included file
+    included, skipped = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root)
+        kept_dirs = []
+        for dirname in sorted(dirnames):
+            if any(fnmatch.fnmatch(dirname, pattern) for pattern in excluded_dirs):
+                skipped.append({'path': os.path.normpath(os.path.join(relative_dir, dirname)), 'size': None,
+                                'reason': 'scratch'})
+            else:
+                kept_dirs.append(dirname)
+        dirnames[:] = kept_dirs
+        for filename in sorted(filenames):
+            path = os.path.normpath(os.path.join(relative_dir, filename))
+            full_path = os.path.join(root, path)
+            if path in excluded_files or os.path.islink(full_path) or not os.path.isfile(full_path):
+                continue
+            stat_result = os.stat(full_path)
+            size = stat_result.st_size
+            recorded = hashes.get(path)
+            sha256 = recorded['sha256'] if recorded and recorded['size'] == size and \
+                recorded['mtime_ns'] == stat_result.st_mtime_ns else None
+            if zipped.get(path) == size:
+                skipped.append({'path': path, 'size': size, 'reason': 'in stage zip'})
+            elif size > max_file_bytes and any(fnmatch.fnmatch(filename, pattern) for pattern in tail_files):
+                included.append({'path': path, 'size': tail_size(full_path, size, max_file_bytes),
+                                 'truncated_from': size})
+            elif size > max_file_bytes:
+                skipped.append({'path': path, 'size': size, 'reason': 'size cap'})
+            elif sha256 in included_content:
+                skipped.append({'path': path, 'size': size, 'reason': f'same content as {included_content[sha256]}'})
+            else:
+                included.append({'path': path, 'size': size, **({'sha256': sha256} if sha256 else {})})
+                if sha256:
+                    included_content[sha256] = path
+    return included, skipped
+
+
+def bundle_workdir(root: str = '.', output: str = BUNDLE_FILE, manifest: str = MANIFEST_FILE,
+                   max_file_bytes: int = DEFAULT_MAX_FILE_BYTES, compresslevel: int = DEFAULT_COMPRESSLEVEL,
+                   excluded_dirs: Iterable[str] = EXCLUDED_DIRS, max_workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Write the stage-out bundle of root and its manifest (both relative to root). Returns the manifest.
+    """
+    output_path = os.path.join(root, output)
+    manifest_path = os.path.join(root, manifest)
+    included, skipped = select_files(root, max_file_bytes, excluded_dirs, excluded_files=[output, manifest])
+
+    with open(output_path, 'wb') as outfile:
+        writer = ParallelGzipWriter(outfile, compresslevel=compresslevel, max_workers=max_workers)
+        try:
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for entry in included:
+                    path = os.path.join(root, entry['path'])
+                    if 'truncated_from' not in entry:
+                        tar.add(path, arcname=entry['path'], recursive=False)
+                        continue
+                    tarinfo = tar.gettarinfo(path, arcname=entry['path'])
+                    tarinfo.size = entry['size']
+                    with open(path, 'rb') as infile:
+                        infile.seek(entry['truncated_from'] - entry['size'])
+                        tar.addfile(tarinfo, infile)
+        finally:
+            writer.close()
+
+    manifest_dict = {
+        'bundle': output,
+        'max_file_bytes': max_file_bytes,
+        'included_bytes': sum(entry['size'] for entry in included),
+        'included': included,
+        'skipped': skipped,
+    }
+    with open(manifest_path, 'wt') as outfile:
+        yaml_io.dumps(manifest_dict, outfile, sort_keys=False)
+    logger.info(f"Wrote {output}: {len(included)} files included, {len(skipped)} skipped. See {manifest}.")
+    return manifest_dict
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bundle the work directory for stage-out.")
+    parser.add_argument('root', nargs='?', default='.', help="work directory")
+    parser.add_argument('--output', default=BUNDLE_FILE)
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--max-file-bytes', type=int, default=DEFAULT_MAX_FILE_BYTES)
+    parser.add_argument('--compresslevel', type=int, default=DEFAULT_COMPRESSLEVEL)
+    parser.add_argument('--exclude-dir', action='append', default=list(EXCLUDED_DIRS),
+                        help="glob pattern of folder names to leave out, can be repeated")
+    args = parser.parse_args(argv)
+    bundle_workdir(args.root, args.output, args.manifest, args.max_file_bytes, args.compresslevel,
+                   args.exclude_dir)
+
+
+if __name__ == "__main__":
+    main()
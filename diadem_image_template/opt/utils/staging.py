@@ -0,0 +1,121 @@
+"""
+Staging of files between the folders of the workflow without copying their content where possible.
+
+Inputs fetched from the out folder of a previous stage are read-only: they are hardlinked if source and target are
+on the same filesystem, reflinked (copy-on-write clone, e.g. on btrfs or XFS) or copied otherwise, and their write
+permissions are removed, so a stage cannot modify the outputs of another stage by accident. As a hardlink shares
+the inode, the file in the out folder becomes read-only as well; out folders are never modified after the stage
+has filled them.
+
+Files a stage modifies in place (e.g. the molecule.spf of DihedralParametrizer) are staged writable: reflinked
+or copied, never hardlinked. So are files that must stay independent of the work directory although they are
+read-only, like the entries of the stage cache (hardlink=False): write permissions do not stop root, so a shared
+inode would pass an in-place write of a tool on to them.
+
+An existing target is always unlinked first instead of being overwritten, so a rerun never writes into an inode
+that is shared with another folder.
+"""
+import errno
+import fcntl
+import os
+import pathlib
+import shutil
+import stat
+from collections import Counter
+from typing import Iterable, Optional, Union
+
+import structlog
+
+# Get the logger
+logger = structlog.get_logger()
+
+FICLONE = 0x40049409  # ioctl of linux/fs.h: clone the extents of a file into another file.
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+
+PathLike = Union[str, pathlib.Path]
+
+
+def _reflink(src: PathLike, dst: PathLike) -> bool:
+    """
+    Clone src into the new file dst. Returns False (and leaves no dst behind) if the filesystem cannot do it.
+    """
+    with open(src, 'rb') as infile:
+        try:
+            with open(dst, 'xb') as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise
+            os.unlink(dst)
+            return False
+    shutil.copymode(src, dst)
+    return True
+
+
+def _remove_write_permissions(path: PathLike) -> None:
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def clone_file(src: PathLike, dst: PathLike) -> bool:
+    """
+    Replace the file dst by a reflink of src, so that both share their extents until one of them is written.
+    Returns False and keeps dst as it is if the filesystem cannot clone.
+    """
+    dst = pathlib.Path(dst)
+    tmp_dst = dst.with_name(f'.{dst.name}.clone')
+    if tmp_dst.exists():
+        tmp_dst.unlink()
+    if not _reflink(src, tmp_dst):
+        return False
+    os.replace(tmp_dst, dst)
+    return True
+
+
+def stage_file(src: PathLike, dst: PathLike, read_only: bool = False, hardlink: Optional[bool] = None) -> str:
+    """
+    Make the file src available as dst (a file path or an existing directory) and return how: HARDLINK, REFLINK
+    or COPY. read_only files are hardlinked if possible (unless hardlink is False) and lose their write permissions;
+    writable files get an inode of their own.
+    """
+    hardlink = read_only if hardlink is None else hardlink and read_only
+    src = pathlib.Path(src)
+    dst = pathlib.Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    if dst.resolve() == src.resolve():
+        raise ValueError(f"Cannot stage {src} onto itself")
+    if dst.exists() or dst.is_symlink():
+        if hardlink and dst.samefile(src):  # staged by an earlier run
+            _remove_write_permissions(dst)
+            return HARDLINK
+        dst.unlink()
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            method = HARDLINK
+        except OSError:  # e.g. EXDEV: source and target are on different filesystems.
+            method = REFLINK if _reflink(src, dst) else COPY
+    else:
+        method = REFLINK if _reflink(src, dst) else COPY
+
+    if method == COPY:
+        shutil.copy(src, dst)
+    if read_only:
+        _remove_write_permissions(dst)
+    return method
+
+
+def stage_files(files: Iterable[PathLike], dst_dir: PathLike, read_only: bool = False,
+                hardlink: Optional[bool] = None) -> Counter:
+    """
+    Stage several files into the directory dst_dir. Returns how many files were staged by which method.
+    """
+    methods = Counter()
+    for file in files:
+        methods[stage_file(file, dst_dir, read_only=read_only, hardlink=hardlink)] += 1
+    return methods
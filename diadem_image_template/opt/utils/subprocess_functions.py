@@ -1,55 +1,311 @@
-from .logging_config import configure_logging
-import structlog
-import subprocess
+"""
+Running the tools of the workflow.
+
+Commands run under an asyncio supervisor, each in a process group (session) of its own:
+- The output is streamed: stdout and stderr are written to files as the output arrives (stdout to output_file if
+  given, otherwise to COMMAND_OUTPUT_DIR/<n>_<program>_stdout.log; stderr always to
+  COMMAND_OUTPUT_DIR/<n>_<program>_stderr.log). Only the last TAIL_LINES lines of each stream stay in memory; they
+  are logged and attached to the error if the command fails. The memory of the orchestrator does not grow with the
+  output of Deposit, QuantumPatch or lightforge.
+- The limits set with command_limits (per stage) are enforced: a wall-time limit and an inactivity limit. A command
+  is inactive while it neither prints anything nor modifies a file below the current directory. A command exceeding
+  a limit gets SIGTERM, after KILL_GRACE seconds SIGKILL, sent to its whole process group (e.g. mpirun and all
+  ranks), and subprocess.TimeoutExpired (CommandStalled for inactivity) is raised.
+- run_commands supervises several commands at once; if one of them fails, the others are terminated.
+"""
+import asyncio
+import contextlib
+import inspect
+import itertools
+import os
+import re
 import shlex
+import signal
+import subprocess
+import time
+from collections import deque
+from typing import Any, Iterable, List, Optional
+
+import structlog
 
-# Ensure the logging configuration is applied
-configure_logging()
+from .metrics import CommandGroupMetrics, CommandMetrics
 
 # Get the logger
 logger = structlog.get_logger()
 
+COMMAND_OUTPUT_DIR = 'command_output'
+TAIL_LINES = 50
+MAX_LINE_BYTES = 4096  # longer lines are cut in the tail, never in the files
+READ_BYTES = 64 * 1024
+WATCH_INTERVAL = 5.0  # seconds between two checks of the limits
+KILL_GRACE = 10.0  # seconds between SIGTERM and SIGKILL
 
-def run_command(command, use_shell=False, output_file=None):
+_command_counter = itertools.count(1)
+
+# Limits of the commands of the current stage. Stages running concurrently run in processes of their own.
+_limits = {'wall_time_s': None, 'deadline': None, 'inactivity_s': None}
+
+
+class CommandStalled(subprocess.TimeoutExpired):
     """
-    Run a shell command and log its output using structlog. Optionally redirect stdout to an output file.
+    Raised when a command neither printed anything nor modified a file for longer than the inactivity limit.
     """
+
+    def __str__(self):
+        return f"Command '{self.cmd}' showed no activity for {self.timeout} seconds"
+
+
+@contextlib.contextmanager
+def command_limits(wall_time_s: Optional[float] = None, inactivity_s: Optional[float] = None):
+    """
+    Limits of the commands run inside the context. The wall time counts from entering the context (the start of a
+    stage) and is shared by all its commands; the inactivity limit applies to every command. None means unlimited.
+    """
+    previous = dict(_limits)
+    _limits['wall_time_s'] = wall_time_s or None
+    _limits['deadline'] = time.monotonic() + wall_time_s if wall_time_s else None
+    _limits['inactivity_s'] = inactivity_s or None
     try:
-        logger.info(f"Running command: {command}")
-        if use_shell:
-            if output_file:
-                with open(output_file, 'w') as out_file:
-                    result = subprocess.run(command, check=True, stdout=out_file, stderr=subprocess.PIPE, shell=True,
-                                            encoding='utf8')
-                    logger.info(f"Command stdout written to {output_file}")
-                    if result.stderr:
-                        logger.error(f"Command stderr: {result.stderr}")
-            else:
-                result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
-                                        encoding='utf8')
-                if result.stdout:
-                    logger.info(f"Command stdout: {result.stdout}")
-                if result.stderr:
-                    logger.error(f"Command stderr: {result.stderr}")
+        yield
+    finally:
+        _limits.update(previous)
+
+
+def limit_errors(limits: Any, stages: Iterable[str]) -> List[str]:
+    """
+    Errors of the limits of a specification, {stage: {wall_time_s, inactivity_s}} (see command_limits): unknown
+    stages, unknown limits and values that are not positive numbers. Checked before the first stage runs.
+    """
+    if not isinstance(limits, dict):
+        return [f"limits must be a mapping, not {type(limits).__name__}"]
+    names = list(inspect.signature(command_limits).parameters)
+    stages = list(stages)
+    errors = []
+    for stage, stage_limits in limits.items():
+        if stage not in stages:
+            errors.append(f"limits: unknown stage '{stage}', expected one of {stages}")
+        elif not isinstance(stage_limits, dict):
+            errors.append(f"limits.{stage} must be a mapping, not {type(stage_limits).__name__}")
         else:
-            command_list = shlex.split(command) if isinstance(command, str) else command
-            if output_file:
-                with open(output_file, 'w') as out_file:
-                    result = subprocess.run(command_list, check=True, stdout=out_file, stderr=subprocess.PIPE,
-                                            encoding='utf8')
-                    logger.info(f"Command stdout written to {output_file}")
-                    if result.stderr:
-                        logger.error(f"Command stderr: {result.stderr}")
-            else:
-                result = subprocess.run(command_list, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                        encoding='utf8')
-                if result.stdout:
-                    logger.info(f"Command stdout: {result.stdout}")
-                if result.stderr:
-                    logger.error(f"Command stderr: {result.stderr}")
+            for name, value in stage_limits.items():
+                if name not in names:
+                    errors.append(f"limits.{stage}: unknown limit '{name}', expected one of {names}")
+                elif value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                            or value <= 0):
+                    errors.append(f"limits.{stage}.{name} must be a positive number of seconds, not {value!r}")
+    return errors
+
+
+class OutputTee:
+    """
+    Copies a stream of the process into a file and keeps a bounded tail of its lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bytes = 0
+        self.lines = 0
+        self.last_output = time.monotonic()
+        self._tail = deque(maxlen=TAIL_LINES)
+        self._partial = b''
+
+    async def pump(self, stream: asyncio.StreamReader):
+        with open(self.path, 'wb') as outfile:
+            while chunk := await stream.read(READ_BYTES):
+                outfile.write(chunk)
+                self.last_output = time.monotonic()
+                self.bytes += len(chunk)
+                self.lines += chunk.count(b'\n')
+                *complete, self._partial = (self._partial + chunk).split(b'\n')
+                self._tail.extend(line[:MAX_LINE_BYTES] for line in complete)
+                self._partial = self._partial[:MAX_LINE_BYTES]
+
+    @property
+    def tail(self) -> str:
+        lines = list(self._tail) + ([self._partial] if self._partial else [])
+        return b'\n'.join(lines).decode('utf8', errors='replace')
+
+
+def _newest_mtime(root: str = '.') -> float:
+    """
+    Latest modification time of the files below root.
+    """
+    newest = 0.0
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+                    except OSError:  # files may vanish while the tool runs
+                        continue
+        except OSError:
+            continue
+    return newest
+
+
+def _output_paths(command_string, output_file):
+    os.makedirs(COMMAND_OUTPUT_DIR, exist_ok=True)
+    words = command_string.split()
+    program = re.sub(r'[^\w.-]', '_', os.path.basename(words[0])) if words else 'command'
+    prefix = os.path.join(COMMAND_OUTPUT_DIR, f"{next(_command_counter):03d}_{program}")
+    return output_file or f"{prefix}_stdout.log", f"{prefix}_stderr.log"
+
+
+def _kill_group(pid: int, sig: int) -> None:
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _terminate(process: asyncio.subprocess.Process) -> None:
+    """
+    SIGTERM to the process group of process, SIGKILL if it is still running after KILL_GRACE seconds.
+    """
+    _kill_group(process.pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE)
+    except asyncio.TimeoutError:
+        _kill_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+
+async def _watch(command_string: str, outputs: List[OutputTee], limits: dict) -> subprocess.TimeoutExpired:
+    """
+    Returns the error to raise once the command exceeds its limits, runs until cancelled otherwise.
+    """
+    deadline, inactivity_s = limits['deadline'], limits['inactivity_s']
+    while True:
+        wait = WATCH_INTERVAL if deadline is None else min(WATCH_INTERVAL, max(deadline - time.monotonic(), 0))
+        await asyncio.sleep(wait)
+        now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            return subprocess.TimeoutExpired(command_string, limits['wall_time_s'])
+        if inactivity_s is not None and now - max(output.last_output for output in outputs) > inactivity_s:
+            # no output, the modification times of the files decide
+            newest_mtime = await asyncio.to_thread(_newest_mtime)
+            if time.time() - newest_mtime > inactivity_s:
+                return CommandStalled(command_string, inactivity_s)
+
+
+async def _supervise(command, args, use_shell, output_file=None, concurrent=False) -> subprocess.CompletedProcess:
+    """
+    Run a command under supervision, see the module docstring. The resource metrics of the process tree are
+    recorded for the stage. stdout and stderr of the returned CompletedProcess are the tails of the streams.
+    """
+    command_string = command if isinstance(command, str) else shlex.join(command)
+    limits = dict(_limits)
+    if limits['deadline'] is not None and time.monotonic() >= limits['deadline']:
+        raise subprocess.TimeoutExpired(command_string, limits['wall_time_s'])
+    stdout_path, stderr_path = _output_paths(command_string, output_file)
+
+    create = asyncio.create_subprocess_shell if use_shell else asyncio.create_subprocess_exec
+    process = await create(*([args] if use_shell else args), stdout=asyncio.subprocess.PIPE,
+                           stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    stdout, stderr = OutputTee(stdout_path), OutputTee(stderr_path)
+    watchdog = None
+    try:
+        with CommandMetrics(command_string, process.pid, concurrent=concurrent) as metrics:
+            completion = asyncio.ensure_future(
+                asyncio.gather(stdout.pump(process.stdout), stderr.pump(process.stderr), process.wait()))
+            watchdog = asyncio.ensure_future(_watch(command_string, [stdout, stderr], limits))
+            await asyncio.wait({completion, watchdog}, return_when=asyncio.FIRST_COMPLETED)
+            if not completion.done():
+                error = watchdog.result()
+                logger.error(f"Terminating the process group of {command_string}: {error}")
+                await _terminate(process)
+                try:
+                    await asyncio.wait_for(completion, KILL_GRACE)  # the rest of the output
+                except asyncio.TimeoutError:  # a process that left the group keeps the pipes open
+                    pass
+                error.output, error.stderr = stdout.tail, stderr.tail
+                raise error
+            completion.result()
+            metrics.extra = {'stdout_bytes': stdout.bytes, 'stdout_lines': stdout.lines,
+                             'stderr_bytes': stderr.bytes, 'stderr_lines': stderr.lines}
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        if process.returncode is None:  # cancelled, e.g. another command of run_commands failed
+            await asyncio.shield(_terminate(process))
+    logger.info(f"Command output written to {stdout_path} and {stderr_path}", **metrics.extra)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout.tail, stderr.tail)
+    return subprocess.CompletedProcess(args, process.returncode, stdout.tail, stderr.tail)
+
+
+def _run_streamed(command, args, use_shell, output_file=None):
+    """
+    subprocess.run(args, check=True, ...) under supervision, see _supervise.
+    """
+    return asyncio.run(_supervise(command, args, use_shell, output_file))
+
+
+def _args(command, use_shell):
+    return command if use_shell else (shlex.split(command) if isinstance(command, str) else command)
+
+
+def _log_result(result, output_file=None):
+    if result.stdout and not output_file:
+        logger.info(f"Command stdout (last {TAIL_LINES} lines): {result.stdout}")
+    if result.stderr:
+        logger.error(f"Command stderr (last {TAIL_LINES} lines): {result.stderr}")
+
+
+@contextlib.contextmanager
+def _logged_errors(command):
+    try:
+        yield
     except subprocess.CalledProcessError as e:
         logger.error("Command failed", command=command, returncode=e.returncode, output=e.output, stderr=e.stderr)
         raise
+    except subprocess.TimeoutExpired as e:
+        logger.error("Command terminated", command=command, reason=str(e), output=e.output, stderr=e.stderr)
+        raise
     except FileNotFoundError as e:
         logger.error(f"Command not found: {e.filename}", error=str(e))
         raise
+
+
+def run_command(command, use_shell=False, output_file=None):
+    """
+    Run a shell command and log the tail of its output using structlog. Optionally redirect stdout to an output
+    file.
+    """
+    with _logged_errors(command):
+        logger.info(f"Running command: {command}")
+        result = _run_streamed(command, _args(command, use_shell), use_shell, output_file)
+        _log_result(result, output_file)
+
+
+def run_commands(commands, use_shell=False):
+    """
+    Run several commands concurrently and log the tails of their output. If one of them fails, the others are
+    terminated and the error of the failed command is raised.
+    """
+
+    async def run_all():
+        tasks = [asyncio.ensure_future(_supervise(command, _args(command, use_shell), use_shell, concurrent=True))
+                 for command in commands]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    with _logged_errors(commands):
+        for command in commands:
+            logger.info(f"Running command: {command}")
+        with CommandGroupMetrics([command if isinstance(command, str) else shlex.join(command)
+                                  for command in commands]):
+            results = asyncio.run(run_all())
+        for result in results:
+            _log_result(result)
+    return results
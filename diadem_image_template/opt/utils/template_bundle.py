@@ -0,0 +1,201 @@
+"""
+The templates of /opt/tmpl as one pre-parsed bundle.
+
+WorkflowConfig reads the file lists (required_files.txt, files.txt, operationFiles/*, ...) and result.yml of every
+executable, and the stages read the settings templates. Instead of probing and parsing these files at every start,
+the image build compiles the template folder into BUNDLE_FILE:
+
+    python -m utils.template_bundle /opt/tmpl
+
+The bundle holds every template parsed (YAML documents, file lists as lists of lines, other files as text) and the
+regular expressions of all glob patterns of the file lists. Building it validates the templates: a YAML file that
+does not parse or a pattern that does not compile fails the image build. The bundle also records the sha256 of the
+templates and the size and mtime of every template file. The workflow loads the bundle with a single read and only
+stats the template files to compare them with the bundle; without a bundle (development checkouts), with a bundle of
+another BUNDLE_FORMAT or with a bundle of templates that were changed since it was built, it parses the folder
+instead.
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import os
+import pathlib
+import pickle
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import structlog
+import yaml
+
+from . import yaml_io
+from .file_index import add_translated_patterns, translate_pattern
+
+# Get the logger
+logger = structlog.get_logger()
+
+BUNDLE_FILE = 'template_bundle.pickle'
+BUNDLE_FORMAT = 2  # version of the bundle layout; a bundle of another format is not used
+
+LINES, YAML, TEXT = 'lines', 'yaml', 'text'
+
+
+class TemplateBundleError(ValueError):
+    """
+    Raised by build_bundle with all errors of the template folder.
+    """
+
+    def __init__(self, errors: Dict[str, str]):
+        self.errors = errors
+        super().__init__("Invalid templates:\n" + "\n".join(f"  {path}: {error}" for path, error in errors.items()))
+
+
+def kind_of(relative_path: str) -> str:
+    """
+    How a template file is parsed: YAML documents (*.yml, lightforge settings), file lists (*.txt and the
+    operationFiles lists) or text.
+    """
+    path = pathlib.PurePosixPath(relative_path)
+    if path.suffix in ('.yml', '.yaml') or path.name == 'settings':
+        return YAML
+    if path.suffix == '.txt' or path.parent.name == 'operationFiles':
+        return LINES
+    return TEXT
+
+
+def template_stats(tmpl_dir: Union[str, pathlib.Path]) -> Dict[str, Tuple[int, int]]:
+    """
+    The (size, mtime_ns) of all templates below tmpl_dir by their relative path. Only stats the files.
+    """
+    stats = {}
+    for dirpath, _, filenames in os.walk(tmpl_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename == BUNDLE_FILE or not os.path.isfile(path):
+                continue
+            stat_result = os.stat(path)
+            stats[pathlib.Path(os.path.relpath(path, tmpl_dir)).as_posix()] = \
+                (stat_result.st_size, stat_result.st_mtime_ns)
+    return stats
+
+
+def build_bundle(tmpl_dir: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    """
+    Parse and validate all templates below tmpl_dir. Raises TemplateBundleError with all errors.
+    """
+    tmpl_dir = pathlib.Path(tmpl_dir)
+    stats = template_stats(tmpl_dir)
+    documents = {}
+    patterns = {}
+    errors = {}
+    source_hash = hashlib.sha256()
+    for relative_path in sorted(stats):
+        text = (tmpl_dir / relative_path).read_text()
+        source_hash.update(f'{relative_path}\0{len(text)}\0'.encode() + text.encode())
+        kind = kind_of(relative_path)
+        try:
+            if kind == YAML:
+                value = yaml_io.loads(text)
+            elif kind == LINES:
+                value = [line.strip() for line in text.splitlines()]
+                for pattern in value:
+                    if glob.has_magic(pattern) and not os.path.isabs(pattern):
+                        for recursive in (False, True):
+                            regex = translate_pattern(pattern, recursive)
+                            re.compile(regex)
+                            patterns[(pattern, recursive)] = regex
+            else:
+                value = text
+        except (yaml.YAMLError, re.error) as e:
+            errors[relative_path] = str(e)
+            continue
+        documents[relative_path] = (kind, value)
+    if errors:
+        raise TemplateBundleError(errors)
+    return {'format': BUNDLE_FORMAT, 'source_hash': source_hash.hexdigest(), 'stats': stats, 'documents': documents,
+            'patterns': patterns}
+
+
+def write_bundle(tmpl_dir: Union[str, pathlib.Path], output: Optional[Union[str, pathlib.Path]] = None) -> str:
+    """
+    Build the bundle of tmpl_dir and write it to output (default: BUNDLE_FILE in tmpl_dir).
+    """
+    bundle = build_bundle(tmpl_dir)
+    output = pathlib.Path(output or pathlib.Path(tmpl_dir) / BUNDLE_FILE)
+    tmp_output = output.with_name(output.name + '.tmp')
+    with open(tmp_output, 'wb') as outfile:
+        pickle.dump(bundle, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_output, output)
+    return bundle['source_hash']
+
+
+class TemplateBundle:
+    """
+    Parsed templates addressed by their path relative to the template folder, e.g. 'Deposit/deposit_cargs.yml'.
+    """
+
+    def __init__(self, bundle: Dict[str, Any], origin: str):
+        self.source_hash: str = bundle['source_hash']
+        self.origin = origin
+        self._documents: Dict[str, Tuple[str, Any]] = bundle['documents']
+        add_translated_patterns(bundle['patterns'])
+
+    @classmethod
+    def load(cls, tmpl_dir: Union[str, pathlib.Path]) -> 'TemplateBundle':
+        """
+        The bundle of tmpl_dir, or the templates read from the folder if there is no usable bundle or the templates
+        were changed since the bundle was built.
+        """
+        bundle_path = pathlib.Path(tmpl_dir) / BUNDLE_FILE
+        try:
+            with open(bundle_path, 'rb') as infile:
+                bundle = pickle.load(infile)
+            if bundle.get('format') != BUNDLE_FORMAT:
+                logger.warning(f"Ignoring {bundle_path} of format {bundle.get('format')}, expected {BUNDLE_FORMAT}")
+            elif bundle.get('stats') != template_stats(tmpl_dir):
+                logger.warning(f"Ignoring {bundle_path}, the templates in {tmpl_dir} were changed since it was built")
+            else:
+                return cls(bundle, str(bundle_path))
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable {bundle_path}: {e}")
+        return cls(build_bundle(tmpl_dir), str(tmpl_dir))
+
+    def __contains__(self, relative_path: str) -> bool:
+        return relative_path in self._documents
+
+    def lines(self, relative_path: str) -> List[str]:
+        """
+        The stripped lines of a file list, [] if there is no such file.
+        """
+        kind, value = self._documents.get(relative_path, (LINES, []))
+        if kind != LINES:
+            raise ValueError(f"{relative_path} is not a file list")
+        return list(value)
+
+    def document(self, relative_path: str) -> Any:
+        """
+        A copy of a YAML template. Raises KeyError if there is no such file.
+        """
+        kind, value = self._documents[relative_path]
+        if kind != YAML:
+            raise ValueError(f"{relative_path} is not a YAML template")
+        return copy.deepcopy(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile the template folder into a bundle.")
+    parser.add_argument('tmpl_dir', help="template folder, e.g. /opt/tmpl")
+    parser.add_argument('--output', help=f"bundle file (default: <tmpl_dir>/{BUNDLE_FILE})")
+    args = parser.parse_args(argv)
+    try:
+        source_hash = write_bundle(args.tmpl_dir, args.output)
+    except TemplateBundleError as e:
+        sys.exit(str(e))
+    print(f"Wrote the template bundle of {args.tmpl_dir} (sha256 of the templates: {source_hash})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Registry of the external tools of the workflow.
+
+A tool is either the name of an executable on the PATH (obabel, mpirun, QuantumPatch, ...) or the path of a script
+that may reference environment variables ($DEPTOOLS/add_dihedral_angles.sh). preflight resolves all tools of a run
+before the first stage starts: the executables with shutil.which on a thread pool, the scripts after expanding the
+environment variables. Everything missing (executables, scripts, unset environment variables) is reported at once,
+instead of failing in the stage that needs it hours into the run. The resolved paths are cached for the stages.
+"""
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import structlog
+
+# Get the logger
+logger = structlog.get_logger()
+
+_ENV_VAR = re.compile(r'\$\{?(\w+)\}?')
+
+
+class MissingToolsError(EnvironmentError):
+    """
+    Raised by preflight with the report of everything that is missing.
+    """
+
+    def __init__(self, missing: Dict[str, str]):
+        self.missing = missing
+        super().__init__("Missing tools:\n" + "\n".join(f"  {tool}: {reason}" for tool, reason in missing.items()))
+
+
+def _is_script(tool: str) -> bool:
+    return '/' in tool or '$' in tool
+
+
+def _resolve(tool: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (path, None) of a tool or (None, reason) if it cannot be used.
+    """
+    if not _is_script(tool):
+        path = shutil.which(tool)
+        return (path, None) if path else (None, "not found on the PATH")
+    unset = [name for name in _ENV_VAR.findall(tool) if not os.environ.get(name)]
+    if unset:
+        return None, f"environment variable {', '.join(unset)} is not set"
+    path = os.path.expandvars(tool)
+    if not os.path.isfile(path):
+        return None, f"{path} does not exist"
+    if not os.access(path, os.X_OK):
+        return None, f"{path} is not executable"
+    return path, None
+
+
+class ToolRegistry:
+    """
+    Resolved paths of the tools, see the module docstring.
+    """
+
+    def __init__(self):
+        self.paths: Dict[str, str] = {}
+
+    def preflight(self, tools: Iterable[str], max_workers: int = 8) -> Dict[str, str]:
+        """
+        Resolve the tools in parallel. Raises MissingToolsError listing all tools that cannot be used.
+        """
+        tools: List[str] = sorted(set(tools) - set(self.paths))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            resolved = dict(zip(tools, executor.map(_resolve, tools)))
+        missing = {tool: reason for tool, (path, reason) in resolved.items() if path is None}
+        self.paths.update({tool: path for tool, (path, reason) in resolved.items() if path is not None})
+        if missing:
+            raise MissingToolsError(missing)
+        logger.info("Tools found", tools=self.paths)
+        return self.paths
+
+    def path(self, tool: str) -> str:
+        """
+        Path of a tool, resolved on first use if it was not part of the preflight.
+        Raises FileNotFoundError if it cannot be used.
+        """
+        if tool not in self.paths:
+            path, reason = _resolve(tool)
+            if path is None:
+                logger.error(f"Failed to find {tool}: {reason}")
+                raise FileNotFoundError(f"{tool} not found: {reason}")
+            self.paths[tool] = path
+        return self.paths[tool]
+
+
+# tools of this run; the stages inherit the resolved paths
+tool_registry = ToolRegistry()
@@ -0,0 +1,88 @@
+"""
+YAML reading and writing of the workflow.
+
+- The libyaml based CSafeLoader/CSafeDumper are used if PyYAML was built with libyaml, the pure-Python
+  SafeLoader/SafeDumper otherwise. The documents are the same.
+- Parsed documents are cached by absolute path (the stages change the working directory) and (mtime, size, inode):
+  reading a settings file that was just written or read again (deposit_cargs.yml, the lightforge settings) does not
+  parse it again. load returns a copy, so the callers may change it.
+- edit loads a document, lets the caller change it in memory and writes it once.
+"""
+import contextlib
+import copy
+import os
+from typing import Any, Dict, Tuple, Union
+
+import yaml
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+Dumper = getattr(yaml, 'CDumper', yaml.Dumper)  # for results that may hold numpy scalars, like yaml.dump
+
+PathLike = Union[str, os.PathLike]
+
+_cache: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+
+
+def _stat_key(path: PathLike) -> Tuple[int, int, int]:
+    stat_result = os.stat(path)
+    return stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino
+
+
+def loads(stream) -> Any:
+    """
+    yaml.safe_load
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dumps(data: Any, stream=None, safe: bool = True, **kwargs) -> Any:
+    """
+    yaml.safe_dump, or yaml.dump if not safe.
+    """
+    return yaml.dump(data, stream, Dumper=SafeDumper if safe else Dumper, **kwargs)
+
+
+def load(path: PathLike, cached: bool = True) -> Any:
+    """
+    The document in the file at path.
+    """
+    path = os.path.abspath(path)
+    if not cached:
+        with open(path, 'r') as infile:
+            return loads(infile)
+    key = _stat_key(path)
+    entry = _cache.get(path)
+    if entry is None or entry[0] != key:
+        with open(path, 'r') as infile:
+            entry = _cache[path] = (key, loads(infile))
+    return copy.deepcopy(entry[1])
+
+
+def save(data: Any, path: PathLike, safe: bool = True, **kwargs) -> None:
+    """
+    Write data to the file at path, with the options of yaml.dump.
+    """
+    path = os.path.abspath(path)
+    with open(path, 'w') as outfile:
+        dumps(data, outfile, safe=safe, **kwargs)
+    if safe:
+        _cache[path] = (_stat_key(path), copy.deepcopy(data))
+    else:
+        _cache.pop(path, None)
+
+
+@contextlib.contextmanager
+def edit(path: PathLike, **kwargs):
+    """
+    with edit('deposit_cargs.yml') as cargs:
+        cargs['machineparams']['ncpu'] = 4
+    writes the changed document once, when the block completes without error.
+    """
+    document = load(path)
+    yield document
+    save(document, path, **kwargs)
+
+
+def clear_cache() -> None:
+    _cache.clear()
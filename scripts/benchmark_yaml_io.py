@@ -0,0 +1,91 @@
+"""
+Compare utils.yaml_io with plain yaml.safe_load/safe_dump on the settings templates of the image.
+
+python scripts/benchmark_yaml_io.py [--repeat N]
+
+Cases:
+- load: parse every template (pyyaml pure-Python loader vs. yaml_io without and with its cache)
+- dump: write every template
+- deposit_cargs: the steps of the Deposit stage before this module: write deposit_cargs.yml, read it, set
+  machineparams.ncpu, write it again, read it for the command line; with yaml_io: one write and a cached read.
+"""
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+OPT = pathlib.Path(__file__).resolve().parent.parent / 'diadem_image_template' / 'opt'
+sys.path.insert(0, str(OPT))
+
+from utils import yaml_io  # noqa: E402
+
+TEMPLATES = sorted(p for p in (OPT / 'tmpl').glob('*/*') if p.name.endswith('.yml') or p.name == 'settings')
+
+
+def plain_load(path):
+    with open(path, 'r') as infile:
+        return yaml.safe_load(infile)
+
+
+def plain_save(data, path):
+    with open(path, 'w') as outfile:
+        yaml.safe_dump(data, outfile)
+
+
+def plain_deposit_cargs(template, path):
+    plain_save(plain_load(template), path)
+    cargs = plain_load(path)
+    cargs['machineparams']['ncpu'] = 8
+    plain_save(cargs, path)
+    return plain_load(path)
+
+
+def yaml_io_deposit_cargs(template, path):
+    cargs = yaml_io.load(template)
+    cargs['machineparams']['ncpu'] = 8
+    yaml_io.save(cargs, path)
+    return yaml_io.load(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    n = args.repeat
+    documents = {path: plain_load(path) for path in TEMPLATES}
+    print(f"libyaml: {yaml.__with_libyaml__}, {len(TEMPLATES)} templates, "
+          f"{sum(os.path.getsize(p) for p in TEMPLATES)} bytes, {n} repetitions")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out = pathlib.Path(tmp_dir) / 'out.yml'
+        deposit_template = OPT / 'tmpl' / 'Deposit' / 'deposit_cargs.yml'
+        cases = {
+            'load': {
+                'yaml.safe_load': lambda: [plain_load(p) for p in TEMPLATES],
+                'yaml_io.load (uncached)': lambda: [yaml_io.load(p, cached=False) for p in TEMPLATES],
+                'yaml_io.load (cached)': lambda: [yaml_io.load(p) for p in TEMPLATES],
+            },
+            'dump': {
+                'yaml.safe_dump': lambda: [plain_save(d, out) for d in documents.values()],
+                'yaml_io.save': lambda: [yaml_io.save(d, out) for d in documents.values()],
+            },
+            'deposit_cargs': {
+                'yaml.safe_load/safe_dump': lambda: plain_deposit_cargs(deposit_template, out),
+                'yaml_io': lambda: yaml_io_deposit_cargs(deposit_template, out),
+            },
+        }
+        for case, variants in cases.items():
+            baseline = None
+            for name, function in variants.items():
+                function()  # warm up, fills the cache
+                seconds = min(timeit.repeat(function, number=n, repeat=3)) / n
+                baseline = baseline or seconds
+                print(f"{case:14s} {name:26s} {seconds * 1e3:8.3f} ms  {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import zipfile
+
+from diadem_image_template.opt.utils import archive as archive_module
+from diadem_image_template.opt.utils.archive import ArchiveWriter, write_archive
+
+
+def make_tree(tmp_path):
+    analysis = tmp_path / 'Analysis'
+    (analysis / 'energy').mkdir(parents=True)
+    (analysis / 'files_for_kmc').mkdir()
+    members = {
+        'energy/DeltaE.png': b'\x89PNG' + bytes(range(256)) * 40,
+        'files_for_kmc/files_for_kmc.zip': b'PK' + bytes(range(256)) * 40,
+        'energy/energies.dat': b'1.0 2.0 3.0\n' * 5000,
+    }
+    for name, data in members.items():
+        (analysis / name).write_bytes(data)
+    return analysis, members
+
+
+def test_members_are_written_in_order(tmp_path):
+    analysis, members = make_tree(tmp_path)
+    output = tmp_path / 'QP_output_0.zip'
+    write_archive([(analysis / name, name) for name in members], output)
+
+    with zipfile.ZipFile(output) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(members)
+        for name, data in members.items():
+            assert zf.read(name) == data
+        infos = {info.filename: info for info in zf.infolist()}
+    assert infos['energy/DeltaE.png'].compress_type == zipfile.ZIP_STORED
+    assert infos['files_for_kmc/files_for_kmc.zip'].compress_type == zipfile.ZIP_STORED
+    assert infos['energy/energies.dat'].compress_type == zipfile.ZIP_DEFLATED
+    assert infos['energy/energies.dat'].compress_size < len(members['energy/energies.dat'])
+
+
+def test_compression_level(tmp_path):
+    data = bytes(i * 7 % 251 for i in range(200000))
+    (tmp_path / 'data.txt').write_bytes(data)
+    sizes = {}
+    for level in (0, 9):
+        output = tmp_path / f'level_{level}.zip'
+        write_archive([(tmp_path / 'data.txt', 'data.txt')], output, compresslevel=level)
+        with zipfile.ZipFile(output) as zf:
+            assert zf.read('data.txt') == data
+            sizes[level] = zf.getinfo('data.txt').compress_size
+    assert sizes[9] < sizes[0]
+
+
+def test_large_members_are_streamed(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_module, 'MAX_MEMBER_BYTES_IN_MEMORY', 100)
+    analysis, members = make_tree(tmp_path)
+    (tmp_path / 'small.txt').write_text('small')
+    output = tmp_path / 'bundle.zip'
+    with ArchiveWriter(output, max_workers=2) as archive:
+        archive.add(tmp_path / 'small.txt', 'small.txt')
+        for name in members:
+            archive.add(analysis / name, name)
+        archive.add(tmp_path / 'small.txt', 'small.txt')  # duplicates are written once
+
+    with zipfile.ZipFile(output) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['small.txt', *members]
+        assert zf.getinfo('energy/DeltaE.png').compress_type == zipfile.ZIP_STORED
+        assert zf.read('energy/energies.dat') == members['energy/energies.dat']
+
+
+def test_without_raw_members(tmp_path, monkeypatch):
+    # Python versions write_raw_member is not checked with: ZipFile.writestr compresses the members
+    monkeypatch.setattr(archive_module, 'RAW_MEMBERS', False)
+    analysis, members = make_tree(tmp_path)
+    output = tmp_path / 'QP_output_0.zip'
+    write_archive([(analysis / name, name) for name in members], output, compresslevel=9, max_workers=2)
+
+    with zipfile.ZipFile(output) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(members)
+        for name, data in members.items():
+            assert zf.read(name) == data
+        assert zf.getinfo('energy/DeltaE.png').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('energy/energies.dat').compress_size < len(members['energy/energies.dat'])
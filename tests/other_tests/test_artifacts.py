@@ -0,0 +1,89 @@
+import os
+import zipfile
+
+import pytest
+import yaml
+
+from diadem_image_template.opt.utils import artifacts
+from diadem_image_template.opt.utils.artifacts import ArtifactManifest, hash_files
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = {
+        'DihedralParametrizer/out/molecule_0.pdb': 'ATOM 1',
+        'Deposit/molecule_0.pdb': 'ATOM 1',
+        'QPParametrizer/out/output_molecule.mol2': '@<TRIPOS>MOLECULE',
+        'output_molecule.mol2': '@<TRIPOS>MOLECULE',
+        'structure.cml': '<molecule/>',
+    }
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+        with open(name, 'w') as file:
+            file.write(content)
+    with zipfile.ZipFile('Deposit_debugFiles.zip', 'w') as zf:
+        zf.write('Deposit/molecule_0.pdb', 'molecule_0.pdb')
+    return files
+
+
+def test_hash_files(workdir):
+    hashes = hash_files(workdir, max_workers=2)
+    assert hashes['Deposit/molecule_0.pdb'] == hashes['DihedralParametrizer/out/molecule_0.pdb']
+    assert hashes['structure.cml'] != hashes['Deposit/molecule_0.pdb']
+
+
+def test_manifest_records_copies_and_zip_members(workdir):
+    manifest = ArtifactManifest()
+    manifest.update(workdir, zips=['Deposit_debugFiles.zip'])
+    manifest.save()
+
+    assert len(manifest.artifacts) == 3
+    pdb = manifest.artifacts[manifest.files['Deposit/molecule_0.pdb']['sha256']]
+    assert pdb['paths'] == ['Deposit/molecule_0.pdb', 'DihedralParametrizer/out/molecule_0.pdb']
+    assert pdb['zip_members'] == ['Deposit_debugFiles.zip:molecule_0.pdb']
+    with open(artifacts.MANIFEST_FILE) as file:
+        assert yaml.safe_load(file)['files'] == manifest.files
+
+
+def test_dedupe(workdir, monkeypatch):
+    cloned = []
+    monkeypatch.setattr(artifacts, 'clone_file', lambda src, dst: cloned.append((src, dst)) or True)
+    manifest = ArtifactManifest()
+    manifest.update(workdir)
+    freed = manifest.dedupe(['QPParametrizer/out/output_molecule.mol2', 'output_molecule.mol2',
+                             'DihedralParametrizer/out/molecule_0.pdb'])
+
+    assert freed == len('@<TRIPOS>MOLECULE')
+    # Deposit/molecule_0.pdb is not linkable
+    assert cloned == [('QPParametrizer/out/output_molecule.mol2', 'output_molecule.mol2')]
+
+
+def test_dedupe_never_shares_an_inode(workdir):
+    os.remove('output_molecule.mol2')
+    os.link('QPParametrizer/out/output_molecule.mol2', 'output_molecule.mol2')  # left by an earlier run
+    manifest = ArtifactManifest()
+    manifest.update(workdir)
+    manifest.dedupe(['QPParametrizer/out/output_molecule.mol2', 'output_molecule.mol2'])
+
+    assert not os.path.samefile('QPParametrizer/out/output_molecule.mol2', 'output_molecule.mol2')
+    with open('output_molecule.mol2', 'w') as file:  # a rerun writing in place
+        file.write('changed')
+    with open('QPParametrizer/out/output_molecule.mol2') as file:
+        assert file.read() == '@<TRIPOS>MOLECULE'
+
+
+def test_unchanged_files_are_not_hashed_again(workdir, monkeypatch):
+    manifest = ArtifactManifest()
+    manifest.update(workdir)
+    manifest.save()
+
+    with open('structure.cml', 'w') as file:
+        file.write('<molecule id="1"/>')
+    hashed = []
+    original_hash_file = artifacts.hash_file
+    monkeypatch.setattr(artifacts, 'hash_file', lambda path: hashed.append(path) or original_hash_file(path))
+    manifest = ArtifactManifest()
+    manifest.update(workdir)
+    assert hashed == ['structure.cml']
+    assert len(manifest.files) == len(workdir)
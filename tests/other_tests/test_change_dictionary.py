@@ -6,7 +6,7 @@ import os
 # We test the module that is a part of the image: diadem_image_template/opt/utils/change_dictionary.py
 # sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../..')))
 
-from diadem_image_template.opt.utils.change_dictionary import update_dict
+from diadem_image_template.opt.utils.change_dictionary import SpecificationError, compile_settings, update_dict
 
 
 def test_update_dict():
@@ -244,5 +244,34 @@ def test_update_lf():
     assert original_dict == expected_dict
 
 
+def test_compile_settings(tmp_path):
+    template = tmp_path / 'settings'
+    template.write_text(yaml.safe_dump({'pars': {'Temperature': 300, 'fields': [0.1]}, 'layers': [{'thickness': 10}]}))
+    merged = compile_settings({'lightforge_hole': template, 'lightforge_electron': template},
+                              {'global': {'ncpus': 4}, 'lightforge_hole': {'pars': {'Temperature': 250}}},
+                              required=['lightforge_hole'])
+    assert merged == {'lightforge_hole': {'pars': {'Temperature': 250, 'fields': [0.1]},
+                                          'layers': [{'thickness': 10}]}}
+    assert yaml.safe_load(template.read_text())['pars']['Temperature'] == 300
+
+
+def test_compile_settings_reports_all_errors(tmp_path):
+    template = tmp_path / 'settings'
+    template.write_text(yaml.safe_dump({'pars': {'Temperature': 300}, 'layers': [{'thickness': 10}]}))
+    specification = {
+        'lightforge_hole': {'pars': {'Temprature': 250, 'field': 0.1}, 'layers': [{'thicknes': 5}]},
+        'lightforge_electorn': {},
+    }
+    with pytest.raises(SpecificationError) as error:
+        compile_settings({'lightforge_hole': template, 'lightforge_electron': template}, specification,
+                         required=['lightforge_hole', 'lightforge_electron'])
+    assert error.value.errors == {
+        'lightforge_electorn': ['unknown section'],
+        'lightforge_electron': ['missing section'],
+        'lightforge_hole': ["key 'pars/Temprature' not found in settings", "key 'pars/field' not found in settings",
+                            "key 'layers/0/thicknes' not found in settings"],
+    }
+
+
 if __name__ == "__main__":
     pytest.main()
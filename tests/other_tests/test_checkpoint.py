@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from diadem_image_template.opt.utils.checkpoint import MARKER_FILE, read_stage_marker, remove_stage_marker, \
+    write_stage_marker
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    original_cwd = os.getcwd()
+    (tmp_path / 'QuantumPatch' / 'out').mkdir(parents=True)
+    (tmp_path / 'QuantumPatch' / 'out' / 'QP_output_0.zip').write_text('zip')
+    stage_dir = tmp_path / 'lightforge_hole'
+    (stage_dir / 'out').mkdir(parents=True)
+    (stage_dir / 'out' / 'settings').write_text('settings')
+    (tmp_path / 'hole_mobility_vs_sqrt_field.png').write_text('png')
+    os.chdir(stage_dir)
+    yield tmp_path
+    os.chdir(original_cwd)
+
+
+def write_marker(workdir):
+    write_stage_marker('lightforge_hole', {'hole_mobility': {'value': 1e-3}}, ['../QuantumPatch/out'], workdir,
+                       ['hole_mobility_vs_sqrt_field.png'])
+
+
+def test_marker_roundtrip(workdir):
+    assert read_stage_marker('lightforge_hole', ['../QuantumPatch/out'], workdir) is None
+    write_marker(workdir)
+    assert os.path.isfile(MARKER_FILE)
+    assert read_stage_marker('lightforge_hole', ['../QuantumPatch/out'], workdir) == {
+        'hole_mobility': {'value': 1e-3}}
+    remove_stage_marker()
+    assert read_stage_marker('lightforge_hole', ['../QuantumPatch/out'], workdir) is None
+
+
+@pytest.mark.parametrize('changed_file', ['QuantumPatch/out/QP_output_0.zip', 'lightforge_hole/out/settings',
+                                          'hole_mobility_vs_sqrt_field.png'])
+def test_marker_is_invalidated_by_changed_files(workdir, changed_file):
+    write_marker(workdir)
+    (workdir / changed_file).write_text('changed')
+    assert read_stage_marker('lightforge_hole', ['../QuantumPatch/out'], workdir) is None
+
+
+def test_marker_is_invalidated_by_missing_diadem_file(workdir):
+    write_marker(workdir)
+    (workdir / 'hole_mobility_vs_sqrt_field.png').unlink()
+    assert read_stage_marker('lightforge_hole', ['../QuantumPatch/out'], workdir) is None
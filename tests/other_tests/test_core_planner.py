@@ -0,0 +1,44 @@
+import pytest
+
+from diadem_image_template.opt.utils import core_planner
+from diadem_image_template.opt.utils.core_planner import cgroup_cpu_quota, physical_cores_in_cpuset, plan_cores
+
+
+def test_cgroup_v2_quota(tmp_path):
+    (tmp_path / 'cpu.max').write_text('400000 100000\n')
+    assert cgroup_cpu_quota(tmp_path) == 4.0
+    (tmp_path / 'cpu.max').write_text('max 100000\n')
+    assert cgroup_cpu_quota(tmp_path) is None
+
+
+def test_cgroup_v1_quota(tmp_path):
+    (tmp_path / 'cpu').mkdir()
+    (tmp_path / 'cpu' / 'cpu.cfs_period_us').write_text('100000')
+    (tmp_path / 'cpu' / 'cpu.cfs_quota_us').write_text('250000')
+    assert cgroup_cpu_quota(tmp_path) == 2.5
+    (tmp_path / 'cpu' / 'cpu.cfs_quota_us').write_text('-1')
+    assert cgroup_cpu_quota(tmp_path) is None
+
+
+def test_no_cgroup(tmp_path):
+    assert cgroup_cpu_quota(tmp_path) is None
+
+
+def test_physical_cores_in_cpuset(tmp_path, monkeypatch):
+    # 2 cores with 2 hyperthreads each: cpu0/cpu2 on core 0, cpu1/cpu3 on core 1
+    for cpu, core in [(0, 0), (1, 1), (2, 0), (3, 1)]:
+        topology = tmp_path / f'cpu{cpu}' / 'topology'
+        topology.mkdir(parents=True)
+        (topology / 'physical_package_id').write_text('0')
+        (topology / 'core_id').write_text(str(core))
+    monkeypatch.setattr(core_planner.os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3})
+    assert physical_cores_in_cpuset(tmp_path) == 2
+    monkeypatch.setattr(core_planner.os, 'sched_getaffinity', lambda pid: {0, 2})
+    assert physical_cores_in_cpuset(tmp_path) == 1
+
+
+@pytest.mark.parametrize('requested, expected', [(None, 8), (4, 4), (30, 8)])
+def test_plan_cores(monkeypatch, requested, expected):
+    monkeypatch.setattr(core_planner, 'physical_cores_in_cpuset', lambda: 16)
+    monkeypatch.setattr(core_planner, 'cgroup_cpu_quota', lambda: 8.5)
+    assert plan_cores(requested) == expected
@@ -0,0 +1,74 @@
+import os
+import pathlib
+import subprocess
+
+import pytest
+
+from diadem_image_template.opt.utils.deposit_functions import deposit_working_directory, \
+    handle_deposit_working_dir_cleanup, setup_working_directory_t
+from diadem_image_template.opt.utils.subprocess_functions import COMMAND_OUTPUT_DIR, run_command
+
+TMPL = pathlib.Path(__file__).resolve().parents[2] / 'diadem_image_template' / 'opt' / 'tmpl'
+
+
+@pytest.fixture
+def deposit_dir(tmp_path):
+    original_cwd = os.getcwd()
+    deposit_dir = tmp_path / 'Deposit'
+    deposit_dir.mkdir()
+    (deposit_dir / 'molecule_0.pdb').write_text('ATOM')
+    (deposit_dir / 'deposit_cargs.yml').write_text('machineparams: {}')
+    os.chdir(deposit_dir)
+    yield deposit_dir
+    os.chdir(original_cwd)
+
+
+def test_scratch_round_trip(deposit_dir):
+    current_dir, working_dir, manifest = setup_working_directory_t('deposit_scratch')
+    assert os.getcwd() == working_dir
+    # inputs are hardlinked into the scratch, not copied
+    assert os.path.samefile('molecule_0.pdb', deposit_dir / 'molecule_0.pdb')
+
+    with open('structure.cml', 'w') as file:
+        file.write('<molecule/>')
+    os.makedirs('periodic_output')
+    with open('deposit_cargs.yml', 'a') as file:  # changed in place
+        file.write('\nchanged: true')
+    for log_file in ['Deposit.stdout', 'Deposit.stderr', 'stdout']:
+        with open(log_file, 'w') as file:
+            file.write('log')
+    structure_inode = os.stat('structure.cml').st_ino
+
+    handle_deposit_working_dir_cleanup(current_dir, working_dir, manifest)
+
+    assert os.getcwd() == str(deposit_dir)
+    assert not os.path.exists(working_dir)
+    assert (deposit_dir / 'structure.cml').read_text() == '<molecule/>'
+    assert os.stat(deposit_dir / 'structure.cml').st_ino == structure_inode  # moved, not copied
+    assert (deposit_dir / 'periodic_output').is_dir()
+    assert (deposit_dir / 'deposit_cargs.yml').read_text().endswith('changed: true')
+    assert (deposit_dir / 'molecule_0.pdb').read_text() == 'ATOM'
+    assert not list(deposit_dir.glob('*.std*')) and not (deposit_dir / 'stdout').exists()
+
+
+def test_replaced_input_is_moved_back(deposit_dir):
+    current_dir, working_dir, manifest = setup_working_directory_t('deposit_scratch')
+    os.remove('molecule_0.pdb')
+    with open('molecule_0.pdb', 'w') as file:
+        file.write('HETATM')
+
+    handle_deposit_working_dir_cleanup(current_dir, working_dir, manifest)
+    assert (deposit_dir / 'molecule_0.pdb').read_text() == 'HETATM'
+
+
+def test_output_of_a_failed_command_reaches_the_data_dir(deposit_dir):
+    with pytest.raises(subprocess.CalledProcessError):
+        with deposit_working_directory('deposit_scratch') as working_dir:
+            run_command("sh -c 'echo Deposit failed >&2; exit 2'", use_shell=True)
+
+    assert os.getcwd() == str(deposit_dir)
+    assert not os.path.exists(working_dir)
+    stderr_file, = (deposit_dir / COMMAND_OUTPUT_DIR).glob('*_stderr.log')
+    assert stderr_file.read_text() == 'Deposit failed\n'
+    # collected by the errorStageOut of Deposit
+    assert COMMAND_OUTPUT_DIR in (TMPL / 'Deposit' / 'operationFiles' / 'errorStageout').read_text().split()
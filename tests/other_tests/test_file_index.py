@@ -0,0 +1,47 @@
+import glob
+
+import pytest
+
+from diadem_image_template.opt.utils.file_index import FileIndex
+
+FILES = [
+    'QP_output_0.zip', 'settings_ng.yml', 'settings_ng.calibrated.yml', 'run.err', 'run.out', '.hidden.out',
+    'Traceback_MainLoop_3', 'Analysis/energy/DeltaE_1.png', 'Analysis/files_for_kmc/files_for_kmc.zip',
+    'Analysis/.cache/state', 'quantumpatch_runtime_files/job_0/output.out', 'quantumpatch_runtime_files/job_1.log',
+    'DFT_0_files/a.dat', 'DFT_10_files/b.dat', 'molecule.pdb', 'output_molecule.mol2',
+]
+
+
+@pytest.fixture
+def stage_dir(tmp_path, monkeypatch):
+    for file in FILES:
+        path = tmp_path / file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(file)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize('pattern', [
+    'QP_output_0.zip', 'settings_ng.*', '*.out', '*err', 'Traceback*', 'Analysis', 'Analysis/energy/DeltaE*.png',
+    '*molecule.*', 'DFT_*_files', 'DFT_?_files', 'DFT_[0-9]_files', 'DFT_[!0]*_files', '.hidden*', '*/*',
+    'quantumpatch_runtime_files', 'non_existing_file.txt', '',
+])
+@pytest.mark.parametrize('recursive', [False, True])
+def test_glob_matches_glob_module(stage_dir, pattern, recursive):
+    index = FileIndex('.')
+    assert index.glob(pattern, recursive=recursive) == sorted(glob.glob(pattern, recursive=recursive))
+
+
+@pytest.mark.parametrize('pattern', ['**', 'Analysis/**', '**/*.out', '**/files_for_kmc.zip'])
+def test_recursive_glob(stage_dir, pattern):
+    index = FileIndex('.')
+    expected = sorted(path.rstrip('/') for path in glob.glob(pattern, recursive=True))
+    assert index.glob(pattern, recursive=True) == [path for path in expected if path]
+
+
+def test_files_under(stage_dir):
+    index = FileIndex('.')
+    assert index.files_under('quantumpatch_runtime_files') == ['quantumpatch_runtime_files/job_0/output.out',
+                                                               'quantumpatch_runtime_files/job_1.log']
+    assert 'Analysis/.cache/state' in index.files_under('Analysis')
@@ -2,7 +2,9 @@ import pytest
 import yaml
 import tempfile
 import pathlib
-from diadem_image_template.opt.utils.lightforge_functions import set_carrier_type
+import numpy as np
+from diadem_image_template.opt.utils.lightforge_functions import LIGHTFORGE_SEED_KEY, merge_mobilities, plan_shards, \
+    set_carrier_type
 
 # Sample YAML content to be used for tests
 sample_yaml_content = """
@@ -106,3 +108,57 @@ def test_set_carrier_type_invalid():
         set_carrier_type(tmp_path, 'invalid')
 
     pathlib.Path(tmp_path).unlink()  # Clean up the temporary file
+
+
+def test_plan_shards():
+    settings = yaml.safe_load(sample_yaml_content)
+
+    # not split unless asked for
+    [shard] = plan_shards(settings, 12)
+    assert shard.settings is settings and shard.n_cpus == 12 and shard.simulations == 10
+
+    # 3 fields x 4 replica groups of 10 simulations, one core each
+    shards = plan_shards(settings, 12, max_shards=12)
+    assert len(shards) == 12
+    assert [shard.settings['experiments'][0]['field_strength'] for shard in shards[::4]] == ['0.02', '0.03', '0.04']
+    assert [shard.simulations for shard in shards[:4]] == [3, 3, 2, 2]
+    assert all(shard.settings['experiments'][0]['simulations'] == shard.simulations for shard in shards)
+    assert sum(shard.n_cpus for shard in shards) == 12
+    assert settings['experiments'][0]['field_strength'] == '0.02 0.03 0.04'  # the settings are not changed
+    # the replicas of a field do not repeat each other
+    assert len({shard.settings[LIGHTFORGE_SEED_KEY] for shard in shards}) == 12
+    assert LIGHTFORGE_SEED_KEY not in settings
+    seeded = plan_shards({**settings, LIGHTFORGE_SEED_KEY: 100}, 12, max_shards=12)
+    assert [shard.settings[LIGHTFORGE_SEED_KEY] for shard in seeded] == list(range(100, 112))
+
+    # fewer cores than fields: the fields are grouped
+    shards = plan_shards(settings, 2, max_shards=12)
+    assert [shard.settings['experiments'][0]['field_strength'] for shard in shards] == ['0.02 0.03', '0.04']
+    assert [shard.simulations for shard in shards] == [10, 10]
+
+    # no more shards than allowed; one shard runs the settings as they are
+    assert len(plan_shards(settings, 12, max_shards=6)) == 6
+    [shard] = plan_shards(settings, 12, max_shards=1)
+    assert shard.settings is settings and shard.n_cpus == 12 and shard.simulations == 10
+
+
+def test_merge_mobilities(tmp_path):
+    rng = np.random.default_rng(1)
+    fields = [0.2, 0.3]
+    mobilities = {field: rng.lognormal(np.log(field), 0.3, size=10) for field in fields}
+
+    for ddof in (0, 1):
+        # per field two replica shards of 6 and 4 simulations: field, mean, std and a further column
+        shard_results = []
+        for name, replicas in (('a', slice(0, 6)), ('b', slice(6, 10))):
+            path = tmp_path / f'{name}.dat'
+            np.savetxt(path, [(field, mobilities[field][replicas].mean(), mobilities[field][replicas].std(ddof=ddof),
+                               2 * mobilities[field][replicas].mean()) for field in fields])
+            shard_results.append((str(path), replicas.stop - replicas.start))
+
+        merge_mobilities(shard_results, str(tmp_path / 'mobilities_all_fields.dat'), ddof=ddof)
+        merged = np.loadtxt(tmp_path / 'mobilities_all_fields.dat')
+        assert merged[:, 0] == pytest.approx(fields)
+        assert merged[:, 1] == pytest.approx([mobilities[field].mean() for field in fields])
+        assert merged[:, 2] == pytest.approx([mobilities[field].std(ddof=ddof) for field in fields])
+        assert merged[:, 3] == pytest.approx(2 * merged[:, 1])
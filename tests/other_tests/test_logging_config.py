@@ -0,0 +1,98 @@
+import glob
+import json
+import os
+
+import pytest
+import structlog
+
+from diadem_image_template.opt.utils import logging_config
+from diadem_image_template.opt.utils.logging_config import cap_field_sizes, configure_logging, flush_logging
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path_factory, monkeypatch):
+    # the logging is configured once per process, in the cwd of the first call: keep log.txt out of the tests
+    log_dir = tmp_path_factory.getbasetemp() / 'logging'
+    log_dir.mkdir(exist_ok=True)
+    monkeypatch.chdir(log_dir)
+    return log_dir
+
+
+def test_cap_field_sizes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(logging_config, 'MAX_FIELD_CHARS', 100)
+    monkeypatch.setattr(logging_config, 'PAYLOAD_HEAD_CHARS', 10)
+    stdout = 'x' * 1000
+    event_dict = cap_field_sizes(None, 'info', {'event': 'Deposit finished', 'stdout': stdout})
+
+    assert event_dict['event'] == 'Deposit finished'
+    assert event_dict['stdout'].startswith('x' * 10 + ' . . . [1000 characters')
+    payload, = (tmp_path / logging_config.PAYLOAD_DIR).iterdir()
+    assert payload.read_text() == stdout
+    assert str(payload.relative_to(tmp_path)) in event_dict['stdout']
+
+
+def test_records_are_written_by_the_listener():
+    configure_logging()
+    structlog.get_logger().info("queued event", stage='Deposit', ncpus=4)
+    flush_logging()
+
+    log_file = logging_config._writer.handlers[0].baseFilename
+    with open(log_file) as file:
+        events = [json.loads(line) for line in file]
+    event = events[-1]
+    assert event['event'] == 'queued event'
+    assert event['stage'] == 'Deposit'
+    assert event['ncpus'] == 4
+    assert event['level'] == 'info'
+
+
+def test_listener_restarts_after_fork():
+    configure_logging()
+    pid = os.fork()
+    if pid == 0:
+        structlog.get_logger().info("event of the child")
+        flush_logging()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    structlog.get_logger().info("event of the parent")
+    flush_logging()
+
+    with open(logging_config._writer.handlers[0].baseFilename) as file:
+        events = [json.loads(line)['event'] for line in file]
+    assert events[-2:] == ["event of the child", "event of the parent"]
+
+
+def test_forked_processes_share_the_rotating_writer(monkeypatch):
+    configure_logging()
+    file_handler = logging_config._writer.handlers[0]
+    log_file = file_handler.baseFilename
+    flush_logging()
+    monkeypatch.setattr(file_handler, 'maxBytes', 2000)
+    monkeypatch.setattr(file_handler, 'backupCount', 100)
+    pids = []
+    for child in range(4):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(50):
+                structlog.get_logger().info("event of a child", child=child, i=i)
+            flush_logging()
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    flush_logging()
+
+    # only the writer of the parent rotates: no record is lost or overwritten
+    backups = sorted(glob.glob(f'{log_file}.*'))
+    try:
+        events = []
+        for path in backups + [log_file]:
+            with open(path) as file:
+                events += [json.loads(line) for line in file]
+        children = {(event['child'], event['i']) for event in events if event['event'] == "event of a child"}
+        assert children == {(child, i) for child in range(4) for i in range(50)}
+        assert len(backups) > 1
+    finally:
+        for path in backups:
+            os.remove(path)
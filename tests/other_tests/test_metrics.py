@@ -0,0 +1,73 @@
+import os
+import pathlib
+import sys
+
+import pytest
+import yaml
+
+from diadem_image_template.opt.utils import metrics as metrics_module
+from diadem_image_template.opt.utils.metrics import StageMetrics, aggregate_metrics
+from diadem_image_template.opt.utils.subprocess_functions import run_command, run_commands
+
+
+@pytest.fixture
+def stage_dir(tmp_path):
+    original_cwd = os.getcwd()
+    stage_dir = tmp_path / 'Deposit'
+    stage_dir.mkdir()
+    os.chdir(stage_dir)
+    yield stage_dir
+    os.chdir(original_cwd)
+
+
+def test_stage_metrics(stage_dir, monkeypatch):
+    monkeypatch.setattr(metrics_module, 'SAMPLE_INTERVAL', 0.1)
+    # the child touches ~50 MB, the tree sampler has to see it.
+    script = "import time; x = b'x' * (50 * 2**20); time.sleep(0.5)"
+    with StageMetrics('Deposit', 4):
+        run_command([sys.executable, '-c', script])
+
+    with open('metrics.yml') as file:
+        metrics = yaml.safe_load(file)
+    assert metrics['stage'] == 'Deposit'
+    assert metrics['status'] == 'completed'
+    assert metrics['ncpus'] == 4
+    assert metrics['wall_time_s'] >= 0.5
+    command, = metrics['commands']
+    assert command['peak_rss_bytes'] >= 50 * 2 ** 20
+    assert command['cpu_time_s'] > 0
+    assert metrics['peak_rss_bytes'] >= command['peak_rss_bytes']
+
+
+def test_concurrent_command_metrics(stage_dir):
+    # getrusage of the children cannot tell concurrent commands apart: the CPU time is recorded for the group
+    script = "import time; start = time.process_time(); [0 for _ in iter(lambda: time.process_time() - start > 0.2, True)]"
+    with StageMetrics('lightforge_hole', 2):
+        run_commands([[sys.executable, '-c', script], [sys.executable, '-c', script]])
+
+    with open('metrics.yml') as file:
+        metrics = yaml.safe_load(file)
+    assert [command['cpu_time_s'] for command in metrics['commands']] == [None, None]
+    group, = metrics['concurrent_commands']
+    assert len(group['commands']) == 2
+    assert group['cpu_time_s'] >= 0.4
+
+
+def test_failed_stage_metrics(stage_dir):
+    with pytest.raises(RuntimeError):
+        with StageMetrics('Deposit', 4):
+            raise RuntimeError("Deposit failed")
+    with open('metrics.yml') as file:
+        assert yaml.safe_load(file)['status'] == 'failed'
+
+
+def test_aggregate_metrics(stage_dir):
+    with StageMetrics('Deposit', 4):
+        pass
+    os.chdir(stage_dir.parent)
+    metrics = aggregate_metrics([pathlib.Path('Deposit'), pathlib.Path('QuantumPatch')], wall_time_s=10.0)
+    assert list(metrics['stages']) == ['Deposit']
+    assert metrics['total']['wall_time_s'] == 10.0
+    assert 'commands' not in metrics['stages']['Deposit']
+    with open('metrics.yml') as file:
+        assert yaml.safe_load(file) == metrics
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from diadem_image_template.opt.utils.plots import PlotRenderer, mobility_plot
+
+PLOT_ARGS = ([0.2, 0.3, 0.4], [1.2e-2, 2.7e-2, 3.9e-2], [7e-4, 2.8e-3, 3.3e-3], 6.3e-4, 9.4, (4e-4, 9e-4))
+
+
+def failing_plot(path):
+    raise RuntimeError(f"cannot render {path}")
+
+
+def test_submit_without_renderer_renders_right_away(tmp_path):
+    path = tmp_path / 'hole_mobility_vs_sqrt_field.png'
+    renderer = PlotRenderer()
+    renderer.submit(mobility_plot, str(path), *PLOT_ARGS)
+    assert path.read_bytes().startswith(b'\x89PNG')
+    assert renderer.wait() == []
+
+
+def test_background_renderer(tmp_path):
+    renderer = PlotRenderer()
+    renderer.start()
+    paths = [tmp_path / f'{carrier}_mobility_vs_sqrt_field.png' for carrier in ('hole', 'electron')]
+    for path in paths:
+        renderer.submit(mobility_plot, str(path), *PLOT_ARGS)
+    # plots submitted from a forked process (a stage) go through the same queue
+    pid = os.fork()
+    if pid == 0:
+        renderer.submit(mobility_plot, str(tmp_path / 'from_stage.png'), *PLOT_ARGS)
+        os._exit(0)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    assert renderer.wait() == []
+    for path in paths + [tmp_path / 'from_stage.png']:
+        assert path.read_bytes().startswith(b'\x89PNG')
+
+
+def test_background_renderer_reports_errors(tmp_path):
+    renderer = PlotRenderer()
+    renderer.start()
+    renderer.submit(failing_plot, str(tmp_path / 'failed.png'))
+    renderer.submit(mobility_plot, str(tmp_path / 'rendered.png'), *PLOT_ARGS)
+    errors = renderer.wait()
+    assert len(errors) == 1 and 'cannot render' in errors[0]
+    assert (tmp_path / 'rendered.png').is_file()
+    assert not (tmp_path / 'failed.png').exists()
+
+
+if __name__ == "__main__":
+    pytest.main()
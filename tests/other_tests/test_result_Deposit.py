@@ -1,5 +1,6 @@
+import numpy as np
 import pytest
-from diadem_image_template.opt.utils.result import get_result_from
+from diadem_image_template.opt.utils.result import _rounding_tolerance, density_analysis, get_result_from
 
 @pytest.fixture
 def local_result_template():
@@ -39,10 +40,41 @@ def test_deposit(local_result_template):
 
     print(local_result_template)
 
-    assert local_result_template["morphology"]["results"]["mass_density"]["value"] == 1.13
-    assert local_result_template["morphology"]["results"]["mass_density"]["std"] == 0.01
-    assert local_result_template["morphology"]["results"]["number_density"]["value"] == 4.40e+21
-    assert local_result_template["morphology"]["results"]["number_density"]["std"] == 1.43e+20
+    # statistics of the 20 per-sample densities; the summary lines print them rounded (1.13 +. 0.01, 4.40E+21 + 1.43E+20)
+    mass_density = local_result_template["morphology"]["results"]["mass_density"]
+    assert mass_density["value"] == pytest.approx(1.13328286535)
+    assert mass_density["std"] == pytest.approx(0.01126631341272973)
+    assert mass_density["stderr"] == pytest.approx(0.011558993669267317 / np.sqrt(20))
+    assert mass_density["samples"] == 20
+    number_density = local_result_template["morphology"]["results"]["number_density"]
+    assert number_density["value"] == pytest.approx(4.39865e+21)
+    assert number_density["std"] == pytest.approx(1.4347343830828058e+20)
+    assert number_density["samples"] == 20
     assert local_result_template["morphology"]["results"]["molecular_volume"]["value"] == 0.23
     assert local_result_template["morphology"]["results"]["rdf_first_peak"]["value"] == 5.297805642633229
-    assert local_result_template["morphology"]["results"]["average_neighbors"]["value"] == 19.8
\ No newline at end of file
+    assert local_result_template["morphology"]["results"]["average_neighbors"]["value"] == 19.8
+
+
+def test_density_analysis_summary_only(tmp_path):
+    # output without per-sample lines: the summary lines are used
+    path = tmp_path / 'DensityAnalysis.out'
+    path.write_text("box density avg over 20 samples: 1.13 +. 0.01\n"
+                    "box density avg over 20 samples: 4.40E+21 + 1.43E+20\n"
+                    "Average neighbors of 80d0 around central 80d0: 19.8\n")
+    analysis = density_analysis(str(path))
+    assert analysis["mass_density"] == {"value": 1.13, "std": 0.01}
+    assert analysis["number_density"] == {"value": 4.40e+21, "std": 1.43e+20}
+    assert analysis["average_neighbors"] == 19.8
+
+
+def test_density_analysis_mismatching_summary(tmp_path):
+    path = tmp_path / 'DensityAnalysis.out'
+    path.write_text("computing density for cuts 1 2 3: 1.0 g/cm3\n"
+                    "computing density for cuts 1 2 3: 3.0 g/cm3\n"
+                    "box density avg over 2 samples: 1.50 +. 1.00\n")
+    analysis = density_analysis(str(path))
+    # the samples count, the summary line is only a cross-check
+    assert analysis["mass_density"] == {"value": 2.0, "std": 1.0, "stderr": 1.0, "samples": 2}
+    assert "number_density" not in analysis
+    assert _rounding_tolerance('1.50') == pytest.approx(0.005)
+    assert _rounding_tolerance('4.40E+21') == pytest.approx(5e+18)
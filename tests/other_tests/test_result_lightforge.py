@@ -1,7 +1,11 @@
+import pathlib
+
 import pytest
-from diadem_image_template.opt.utils.result import get_result_from
+from diadem_image_template.opt.utils.result import fit_line, get_result_from, poole_frenkel_fit
 import numpy as np
 
+INPUTS = pathlib.Path(__file__).parent / 'inputs'
+
 @pytest.fixture
 def local_result_template():
     return {
@@ -42,9 +46,10 @@ def local_result_template():
     }
 
 
-def test_lightforge(local_result_template):
-    mobilities_file = "inputs/mobilities_all_fields.dat"
-    settings_file = "inputs/settings"
+def test_lightforge(local_result_template, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the plots are written to the cwd
+    mobilities_file = INPUTS / "mobilities_all_fields.dat"
+    settings_file = INPUTS / "settings"
 
 
     # Run the lightforge function
@@ -65,6 +70,51 @@ def test_lightforge(local_result_template):
             2.157156189860654893e-03/np.sqrt(10), 8.981448462374695338e-03/np.sqrt(10), 1.049719255916519572e-02 / np.sqrt(10)
         ], rel=1e-6)
         assert local_result_template[hole_or_electron_mobility]["value"] is not None  # Check if zero-field mobility is set
+        # intercept of the least squares fit of log(mobility) vs sqrt(field), weighted with the standard errors.
+        assert local_result_template[hole_or_electron_mobility]["value"] == pytest.approx(6.3131742134983e-04,
+                                                                                          rel=1e-9)
+        ci = local_result_template[hole_or_electron_mobility]["results"]["zero_field_mobility_ci"]
+        assert ci["confidence_level"] == 0.95
+        assert ci["values"][0] < local_result_template[hole_or_electron_mobility]["value"] < ci["values"][1]
+
+
+def test_lightforge_plot(local_result_template, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    get_result_from.lightforge(local_result_template, str(INPUTS / "mobilities_all_fields.dat"),
+                               str(INPUTS / "settings"), hole_or_electron='hole')
+    # the plot of a resumed stage is rendered from its result
+    (tmp_path / 'hole_mobility_vs_sqrt_field.png').unlink()
+    get_result_from.lightforge_plot(local_result_template, 'hole')
+    assert (tmp_path / 'hole_mobility_vs_sqrt_field.png').read_bytes().startswith(b'\x89PNG')
+
+
+def test_fit_line():
+    x = np.array([0.0, 1.0, 2.0, 3.0])
+    # unweighted: the intercept of ordinary least squares, as before
+    assert fit_line(x, [1.0, 3.0, 5.2, 6.8]) == pytest.approx((1.06, 1.96))
+    # a point with a huge error does not pull the line
+    assert fit_line(x, [1.0, 3.0, 5.0, 100.0], weights=[1, 1, 1, 1e-12]) == pytest.approx((1.0, 2.0))
+    # several data sets at once
+    intercepts, slopes = fit_line(x, np.array([1 + 2 * x, 3 - x]))
+    assert intercepts == pytest.approx([1, 3]) and slopes == pytest.approx([2, -1])
+
+
+def test_poole_frenkel_fit():
+    fields = np.array([0.04, 0.09, 0.16, 0.25])
+    mobilities = 1e-3 * np.exp(2.0 * np.sqrt(fields))
+    zero_field_mobility, slope, (lower, upper) = poole_frenkel_fit(fields, mobilities, 0.05 * mobilities)
+    assert zero_field_mobility == pytest.approx(1e-3)
+    assert slope == pytest.approx(2.0)
+    assert lower < 1e-3 < upper
+
+    # smaller errors, narrower interval; the same seed, the same interval
+    _, _, narrow = poole_frenkel_fit(fields, mobilities, 0.005 * mobilities)
+    assert narrow[1] - narrow[0] < (upper - lower) / 5
+    assert poole_frenkel_fit(fields, mobilities, 0.005 * mobilities)[2] == narrow
+
+    # standard errors as large as the mobilities: a wide interval, but no resample is cut off at zero
+    _, _, (lower, upper) = poole_frenkel_fit(fields, mobilities, mobilities)
+    assert 1e-6 < lower < 1e-3 < upper < 1
 
 
 if __name__ == "__main__":
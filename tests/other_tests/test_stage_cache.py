@@ -0,0 +1,83 @@
+import os
+import pathlib
+
+import pytest
+import yaml
+
+from diadem_image_template.opt.utils.stage_cache import StageCache, hash_file
+
+
+@pytest.fixture
+def stage_dir(tmp_path):
+    original_cwd = os.getcwd()
+    stage_dir = tmp_path / 'QPParametrizer'
+    (stage_dir / 'out').mkdir(parents=True)
+    (stage_dir / 'out' / 'molecule.pdb').write_text('ATOM')
+    (stage_dir / 'output_molecule.mol2').write_text('@<TRIPOS>MOLECULE')
+    (tmp_path / 'xtb' / 'out').mkdir(parents=True)
+    (tmp_path / 'xtb' / 'out' / 'input_molecule.mol2').write_text('@<TRIPOS>MOLECULE xtb')
+    os.chdir(stage_dir)
+    yield stage_dir
+    os.chdir(original_cwd)
+
+
+def test_hash_file(tmp_path):
+    file = tmp_path / 'file.txt'
+    file.write_text('abc')
+    assert hash_file(file) == 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+
+
+def test_key_depends_on_settings_and_inputs(stage_dir):
+    key = StageCache.key('KEY', 'QPParametrizer', {'Threads': 30}, ['../xtb/out'], 'mobility:0.0.1')
+    assert key == StageCache.key('KEY', 'QPParametrizer', {'Threads': 30}, ['../xtb/out'], 'mobility:0.0.1')
+    assert key != StageCache.key('KEY', 'QPParametrizer', {'Threads': 16}, ['../xtb/out'], 'mobility:0.0.1')
+    assert key != StageCache.key('KEY', 'QPParametrizer', {'Threads': 30}, ['../xtb/out'], 'mobility:0.0.2')
+    (stage_dir.parent / 'xtb' / 'out' / 'input_molecule.mol2').write_text('changed')
+    assert key != StageCache.key('KEY', 'QPParametrizer', {'Threads': 30}, ['../xtb/out'], 'mobility:0.0.1')
+
+
+def test_store_and_restore(stage_dir, tmp_path):
+    cache = StageCache(tmp_path / 'cache')
+    diadem_dir = tmp_path / 'diadem'
+    diadem_dir.mkdir()
+
+    assert cache.restore('QPParametrizer', 'abc', diadem_dir) is None
+    cache.store('QPParametrizer', 'abc', ['output_molecule.mol2'], {'HOMO': {'value': -5.2}})
+
+    # a fresh stage folder of a later run
+    new_stage_dir = tmp_path / 'rerun'
+    new_stage_dir.mkdir()
+    os.chdir(new_stage_dir)
+    result = cache.restore('QPParametrizer', 'abc', diadem_dir)
+    assert result == {'HOMO': {'value': -5.2}}
+    assert pathlib.Path('out/molecule.pdb').read_text() == 'ATOM'
+    # the entry does not share an inode with the out folders, an in-place write cannot reach it
+    entry_file, = (tmp_path / 'cache').glob('QPParametrizer/abc/out/molecule.pdb')
+    assert not entry_file.samefile('out/molecule.pdb')
+    assert not entry_file.samefile(stage_dir / 'out' / 'molecule.pdb')
+    assert (diadem_dir / 'output_molecule.mol2').is_file()
+    with open('result.yml') as file:
+        assert yaml.safe_load(file) == result
+
+
+def test_restore_replaces_hardlinked_diadem_files(stage_dir, tmp_path):
+    cache = StageCache(tmp_path / 'cache')
+    cache.store('QPParametrizer', 'abc', ['output_molecule.mol2'], {})
+    diadem_dir = tmp_path / 'diadem'
+    diadem_dir.mkdir()
+
+    # an earlier run left the diadem file as a read-only hardlink of an out file (artifact manifest dedupe)
+    linked_out_file = tmp_path / 'linked.mol2'
+    linked_out_file.write_text('out file of another stage')
+    os.link(linked_out_file, diadem_dir / 'output_molecule.mol2')
+    linked_out_file.chmod(0o444)
+
+    cache.restore('QPParametrizer', 'abc', diadem_dir)
+    assert (diadem_dir / 'output_molecule.mol2').read_text() == '@<TRIPOS>MOLECULE'
+    assert linked_out_file.read_text() == 'out file of another stage'
+
+
+def test_stage_without_result(stage_dir, tmp_path):
+    cache = StageCache(tmp_path / 'cache')
+    cache.store('DihedralParametrizer', 'abc', [], None)
+    assert cache.restore('DihedralParametrizer', 'abc', tmp_path) == {}
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from diadem_image_template.opt.utils.stage_graph import Stage, StageGraph, StageError, split_cores
+
+
+def test_split_cores():
+    assert split_cores(30, 1) == [30]
+    assert split_cores(30, 2) == [15, 15]
+    assert split_cores(7, 2) == [4, 3]
+    assert split_cores(1, 2) == [1, 1]
+
+
+def test_levels_and_concurrent_run():
+    stages = [
+        Stage('QuantumPatch', lambda n: {'qp': n}, outputs=['QP_output_0.zip']),
+        Stage('lightforge_hole', lambda n: {'hole': (n, os.getpid())}, depends_on=['QuantumPatch'],
+              inputs=['QP_output_0.zip']),
+        Stage('lightforge_electron', lambda n: {'electron': (n, os.getpid())}, depends_on=['QuantumPatch'],
+              inputs=['QP_output_0.zip']),
+    ]
+    graph = StageGraph(stages)
+    assert [[stage.name for stage in level] for level in graph.levels()] == [
+        ['QuantumPatch'], ['lightforge_hole', 'lightforge_electron']]
+
+    results = graph.run(8)
+    assert results['QuantumPatch'] == {'qp': 8}
+    hole_cores, hole_pid = results['lightforge_hole']['hole']
+    electron_cores, electron_pid = results['lightforge_electron']['electron']
+    assert hole_cores == electron_cores == 4
+    assert hole_pid != os.getpid() and electron_pid != os.getpid() and hole_pid != electron_pid
+
+
+def test_failed_stage_raises():
+    def fail(n):
+        raise FileNotFoundError("mobilities_all_fields.dat")
+
+    graph = StageGraph([
+        Stage('lightforge_hole', fail),
+        Stage('lightforge_electron', lambda n: None),
+    ])
+    with pytest.raises(StageError) as excinfo:
+        graph.run(2)
+    assert list(excinfo.value.failed) == ['lightforge_hole']
+
+
+def test_invalid_graphs():
+    with pytest.raises(ValueError, match="unknown stage"):
+        StageGraph([Stage('Deposit', lambda n: None, depends_on=['DihedralParametrizer'])])
+    with pytest.raises(ValueError, match="not outputs of its dependencies"):
+        StageGraph([Stage('xtb', lambda n: None, outputs=['input_molecule.mol2']),
+                    Stage('QPParametrizer', lambda n: None, depends_on=['xtb'], inputs=['molecule.pdb'])])
+    with pytest.raises(ValueError, match="Cyclic"):
+        StageGraph([Stage('a', lambda n: None, depends_on=['b']), Stage('b', lambda n: None, depends_on=['a'])])
+
+
+@pytest.fixture
+def workflow():
+    return StageGraph([
+        Stage('xtb', lambda n: None, outputs=['input_molecule.mol2']),
+        Stage('DihedralParametrizer', lambda n: None, depends_on=['xtb'], inputs=['input_molecule.mol2'],
+              outputs=['molecule_0.pdb']),
+        Stage('Deposit', lambda n: None, depends_on=['DihedralParametrizer'], inputs=['molecule_0.pdb'],
+              outputs=['structurePBC.cml']),
+        Stage('QuantumPatch', lambda n: None, depends_on=['Deposit'], inputs=['structurePBC.cml'],
+              outputs=['QP_output_0.zip']),
+        Stage('lightforge_hole', lambda n: None, depends_on=['QuantumPatch', 'DihedralParametrizer'],
+              inputs=['QP_output_0.zip', 'molecule_0.pdb']),
+    ])
+
+
+def test_select_stop_after(workflow):
+    graph = workflow.select(stop_after='Deposit')
+    assert list(graph.stages) == ['xtb', 'DihedralParametrizer', 'Deposit']
+    assert graph.supplied == []
+
+
+def test_select_start_from(workflow):
+    graph = workflow.select(start_from='QuantumPatch')
+    assert list(graph.stages) == ['QuantumPatch', 'lightforge_hole']
+    assert graph.supplied == ['DihedralParametrizer', 'Deposit']
+    assert graph.stages['lightforge_hole'].depends_on == ['QuantumPatch']
+    assert graph.stages['lightforge_hole'].inputs == ['QP_output_0.zip']
+    assert workflow.ancestors('lightforge_hole') == ['xtb', 'DihedralParametrizer', 'Deposit', 'QuantumPatch']
+
+
+def test_select_range(workflow):
+    graph = workflow.select(start_from='DihedralParametrizer', stop_after='QuantumPatch')
+    assert list(graph.stages) == ['DihedralParametrizer', 'Deposit', 'QuantumPatch']
+    assert graph.supplied == ['xtb']
+    with pytest.raises(ValueError, match="No stage to run"):
+        workflow.select(start_from='QuantumPatch', stop_after='Deposit')
+    with pytest.raises(ValueError, match="Unknown stage"):
+        workflow.select(stop_after='Depositt')
@@ -0,0 +1,96 @@
+import os
+import tarfile
+import zipfile
+
+import yaml
+
+from diadem_image_template.opt.utils import stageout
+from diadem_image_template.opt.utils.stageout import bundle_workdir
+
+
+def make_workdir(root):
+    files = {
+        'result.yml': b'hole_mobility: 1e-4\n',
+        'log.txt': b'{"event": "done"}\n' * 100,
+        'Deposit/run.out': b'deposit output\n',
+        'Deposit/grid.vdw.gz': os.urandom(4096),
+        'Deposit/deposit_scratch/grid.es': b'scratch',
+        'QuantumPatch/qp_scratch_abc/job.tmp': b'scratch',
+        'QuantumPatch/Analysis/energy/DeltaE_1.png': b'png',
+        'QuantumPatch/settings_ng.yml': b'Analysis: {}\n',
+    }
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    with zipfile.ZipFile(root / 'QuantumPatch_debugFiles.zip', 'w') as zf:
+        zf.write(root / 'QuantumPatch/Analysis/energy/DeltaE_1.png', 'Analysis/energy/DeltaE_1.png')
+        zf.writestr('settings_ng.yml', 'changed since it was zipped\n')
+    return files
+
+
+def test_bundle_workdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(stageout, 'BLOCK_BYTES', 1024)  # several gzip members
+    make_workdir(tmp_path)
+    manifest = bundle_workdir(str(tmp_path), max_file_bytes=2048, max_workers=3)
+
+    with tarfile.open(tmp_path / 'workdir_bundle.tar.gz', 'r:gz') as tar:
+        names = tar.getnames()
+        assert tar.extractfile('log.txt').read() == b'{"event": "done"}\n' * 100
+    assert sorted(names) == ['Deposit/run.out', 'QuantumPatch/settings_ng.yml', 'QuantumPatch_debugFiles.zip',
+                             'log.txt', 'result.yml']
+    assert [entry['path'] for entry in manifest['included']] == names
+
+    reasons = {entry['path']: entry['reason'] for entry in manifest['skipped']}
+    assert reasons == {
+        'Deposit/deposit_scratch': 'scratch',
+        'Deposit/grid.vdw.gz': 'size cap',
+        'QuantumPatch/qp_scratch_abc': 'scratch',
+        'QuantumPatch/Analysis/energy/DeltaE_1.png': 'in stage zip',
+    }
+    with open(tmp_path / 'workdir_bundle_manifest.yml') as file:
+        assert yaml.safe_load(file) == manifest
+
+
+def test_bundle_is_not_bundled_again(tmp_path):
+    make_workdir(tmp_path)
+    bundle_workdir(str(tmp_path))
+    bundle_workdir(str(tmp_path))
+    with tarfile.open(tmp_path / 'workdir_bundle.tar.gz', 'r:gz') as tar:
+        assert not {'workdir_bundle.tar.gz', 'workdir_bundle_manifest.yml'} & set(tar.getnames())
+
+
+def test_same_content_is_bundled_once(tmp_path):
+    make_workdir(tmp_path)
+    (tmp_path / 'Deposit' / 'run_copy.out').write_bytes(b'deposit output\n')
+    files = {}
+    for path in ['Deposit/run.out', 'Deposit/run_copy.out']:
+        stat_result = os.stat(tmp_path / path)
+        files[path] = {'sha256': 'a' * 64, 'crc32': 0, 'size': stat_result.st_size,
+                       'mtime_ns': stat_result.st_mtime_ns}
+    with open(tmp_path / 'artifact_manifest.yml', 'w') as file:
+        yaml.safe_dump({'files': files}, file)
+
+    manifest = bundle_workdir(str(tmp_path))
+    included = {entry['path']: entry for entry in manifest['included']}
+    assert included['Deposit/run.out']['sha256'] == 'a' * 64
+    assert 'Deposit/run_copy.out' not in included
+    assert {'path': 'Deposit/run_copy.out', 'size': 15, 'reason': 'same content as Deposit/run.out'} in \
+        manifest['skipped']
+
+
+def test_logs_larger_than_the_cap_are_bundled_as_their_tail(tmp_path):
+    log = b''.join(b'{"event": "line %d"}\n' % i for i in range(200))
+    (tmp_path / 'log.txt').write_bytes(log)
+    (tmp_path / 'commands').mkdir()
+    (tmp_path / 'commands/1_lightforge_stderr.log').write_bytes(b'x' * 3000)
+    (tmp_path / 'output.dat').write_bytes(b'x' * 3000)
+    manifest = bundle_workdir(str(tmp_path), max_file_bytes=1024)
+
+    with tarfile.open(tmp_path / 'workdir_bundle.tar.gz', 'r:gz') as tar:
+        tail = tar.extractfile('log.txt').read()
+        assert tar.extractfile('commands/1_lightforge_stderr.log').read() == b'x' * 1024
+    assert len(tail) <= 1024 and log.endswith(tail) and tail.startswith(b'{"event": "line ')
+    assert {entry['path']: (entry['size'], entry.get('truncated_from')) for entry in manifest['included']} == {
+        'log.txt': (len(tail), len(log)), 'commands/1_lightforge_stderr.log': (1024, 3000)}
+    assert manifest['skipped'] == [{'path': 'output.dat', 'size': 3000, 'reason': 'size cap'}]
@@ -0,0 +1,105 @@
+import os
+import stat
+
+import pytest
+
+from diadem_image_template.opt.utils import staging
+from diadem_image_template.opt.utils.staging import COPY, HARDLINK, REFLINK, clone_file, stage_file, stage_files
+
+
+def is_writable(path):
+    return bool(os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+@pytest.fixture
+def out_dir(tmp_path):
+    out_dir = tmp_path / 'QuantumPatch' / 'out'
+    out_dir.mkdir(parents=True)
+    (out_dir / 'QP_output_0.zip').write_bytes(b'zip' * 1000)
+    (out_dir / 'molecule_0.pdb').write_text('ATOM')
+    return out_dir
+
+
+def test_read_only_inputs_are_hardlinked(tmp_path, out_dir):
+    stage_dir = tmp_path / 'lightforge_hole'
+    stage_dir.mkdir()
+    methods = stage_files(out_dir.iterdir(), stage_dir, read_only=True)
+
+    assert methods == {HARDLINK: 2}
+    staged = stage_dir / 'QP_output_0.zip'
+    assert staged.samefile(out_dir / 'QP_output_0.zip')
+    assert staged.read_bytes() == b'zip' * 1000
+    assert not is_writable(staged)
+    # a rerun stages the same inode again
+    assert stage_file(out_dir / 'QP_output_0.zip', stage_dir, read_only=True) == HARDLINK
+
+
+def test_writable_files_get_their_own_inode(tmp_path, out_dir):
+    stage_dir = tmp_path / 'DihedralParametrizer'
+    stage_dir.mkdir()
+    method = stage_file(out_dir / 'molecule_0.pdb', stage_dir)
+
+    assert method in (REFLINK, COPY)
+    staged = stage_dir / 'molecule_0.pdb'
+    assert not staged.samefile(out_dir / 'molecule_0.pdb')
+    assert is_writable(staged)
+    staged.write_text('HETATM')
+    assert (out_dir / 'molecule_0.pdb').read_text() == 'ATOM'
+
+
+def test_existing_target_is_replaced_not_overwritten(tmp_path, out_dir):
+    stage_dir = tmp_path / 'Deposit'
+    stage_dir.mkdir()
+    stage_file(out_dir / 'molecule_0.pdb', stage_dir, read_only=True)
+    (tmp_path / 'new.pdb').write_text('new')
+
+    stage_file(tmp_path / 'new.pdb', stage_dir / 'molecule_0.pdb')
+    assert (stage_dir / 'molecule_0.pdb').read_text() == 'new'
+    assert (out_dir / 'molecule_0.pdb').read_text() == 'ATOM'
+
+
+def test_copy_fallback_across_filesystems(tmp_path, out_dir, monkeypatch):
+    def cross_device_link(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(staging.os, 'link', cross_device_link)
+    monkeypatch.setattr(staging, '_reflink', lambda src, dst: False)
+    stage_dir = tmp_path / 'lightforge_electron'
+    stage_dir.mkdir()
+
+    assert stage_file(out_dir / 'QP_output_0.zip', stage_dir, read_only=True) == COPY
+    staged = stage_dir / 'QP_output_0.zip'
+    assert staged.read_bytes() == b'zip' * 1000
+    assert not staged.samefile(out_dir / 'QP_output_0.zip')
+    assert not is_writable(staged)
+
+
+def test_read_only_files_without_hardlink_get_their_own_inode(tmp_path, out_dir):
+    entry_dir = tmp_path / 'cache_entry'
+    entry_dir.mkdir()
+    os.link(out_dir / 'molecule_0.pdb', entry_dir / 'molecule_0.pdb')  # hardlinked by an earlier run
+
+    assert stage_files(out_dir.iterdir(), entry_dir, read_only=True, hardlink=False).keys() <= {REFLINK, COPY}
+    staged = entry_dir / 'molecule_0.pdb'
+    assert not staged.samefile(out_dir / 'molecule_0.pdb')
+    assert not is_writable(staged)
+    (out_dir / 'molecule_0.pdb').write_text('HETATM')  # root writes despite the permissions
+    assert staged.read_text() == 'ATOM'
+
+
+def test_clone_file(tmp_path, out_dir, monkeypatch):
+    copy = tmp_path / 'molecule_0.pdb'
+    copy.write_text('ATOM')
+    inode = copy.stat().st_ino
+    monkeypatch.setattr(staging, '_reflink', lambda src, dst: False)
+    assert not clone_file(out_dir / 'molecule_0.pdb', copy)
+    assert copy.stat().st_ino == inode and copy.read_text() == 'ATOM'
+
+    def fake_reflink(src, dst):
+        staging.shutil.copy(src, dst)
+        return True
+
+    monkeypatch.setattr(staging, '_reflink', fake_reflink)
+    assert clone_file(out_dir / 'molecule_0.pdb', copy)
+    assert not copy.samefile(out_dir / 'molecule_0.pdb') and copy.read_text() == 'ATOM'
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith('.')] == []
@@ -0,0 +1,40 @@
+import ast
+import pathlib
+import subprocess
+import sys
+
+OPT = pathlib.Path(__file__).parents[2] / 'diadem_image_template' / 'opt'
+
+# cold import of everything the orchestrator imports from utils, in seconds.
+IMPORT_BUDGET = 1.0
+DEFERRED_MODULES = ['sklearn', 'matplotlib', 'numpy']
+
+
+def orchestrator_utils_imports():
+    """
+    The imports of the orchestrator from utils, as statements importing every name: 'from utils import yaml_io' and
+    'import utils.result' as well as 'from utils.result import get_result_from'.
+    """
+    tree = ast.parse((OPT / 'get_mobility.py').read_text())
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.level == 0 and node.module and \
+                (node.module == 'utils' or node.module.startswith('utils.')):
+            imports.add(f"from {node.module} import {', '.join(sorted(alias.name for alias in node.names))}")
+        elif isinstance(node, ast.Import):
+            imports.update(f"import {alias.name}" for alias in node.names
+                           if alias.name == 'utils' or alias.name.startswith('utils.'))
+    return sorted(imports)
+
+
+def test_orchestrator_cold_start(tmp_path):
+    imports = orchestrator_utils_imports()
+    assert 'from utils.result import get_result_from' in imports and 'from utils import yaml_io' in imports
+    script = (f"import sys, time; start = time.perf_counter(); sys.path.insert(0, {str(OPT)!r}); "
+              f"{'; '.join(imports)}; print(time.perf_counter() - start); "
+              f"print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))")
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=tmp_path, encoding='utf8').splitlines()
+    import_time, loaded_heavy_modules = float(output[0]), output[1] if len(output) > 1 else ''
+    assert loaded_heavy_modules == '', f"heavy modules imported at startup: {loaded_heavy_modules}"
+    assert import_time < IMPORT_BUDGET, f"cold start took {import_time:.2f} s, budget is {IMPORT_BUDGET} s"
+    assert list(tmp_path.iterdir()) == [], "importing utils must not configure the logging (log.txt)"
@@ -0,0 +1,119 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from diadem_image_template.opt.utils import subprocess_functions
+from diadem_image_template.opt.utils.subprocess_functions import TAIL_LINES, CommandStalled, _run_streamed, \
+    command_limits, limit_errors, run_command, run_commands
+
+
+@pytest.fixture(autouse=True)
+def stage_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_output_is_streamed_to_files_with_a_bounded_tail(stage_dir):
+    script = "import sys\nfor i in range(100000): print(f'line {i}')\nprint('warning', file=sys.stderr)"
+    result = _run_streamed('python', [sys.executable, '-c', script], False)
+
+    stdout_file, = stage_dir.glob('command_output/*_python_stdout.log')
+    stderr_file, = stage_dir.glob('command_output/*_python_stderr.log')
+    assert stdout_file.read_text() == ''.join(f'line {i}\n' for i in range(100000))
+    assert stderr_file.read_text() == 'warning\n'
+    tail = result.stdout.splitlines()
+    assert len(tail) == TAIL_LINES
+    assert tail[-1] == 'line 99999'
+    assert result.stderr == 'warning'
+
+
+def test_output_file(stage_dir):
+    run_command(f"{sys.executable} -c \"print('density 1.2')\"", output_file='DensityAnalysis.out')
+    assert (stage_dir / 'DensityAnalysis.out').read_text() == 'density 1.2\n'
+
+
+def test_long_lines_are_cut_in_the_tail(stage_dir, monkeypatch):
+    monkeypatch.setattr(subprocess_functions, 'MAX_LINE_BYTES', 10)
+    result = _run_streamed('printf', "printf 'x%.0s' $(seq 1000)", True)
+    assert result.stdout == 'x' * 10
+    stdout_file, = stage_dir.glob('command_output/*_printf_stdout.log')
+    assert stdout_file.read_text() == 'x' * 1000
+
+
+def test_failed_command_reports_the_tail(stage_dir):
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_command("echo started; echo 'no license' >&2; exit 3", use_shell=True)
+    assert error.value.returncode == 3
+    assert error.value.output == 'started'
+    assert error.value.stderr == 'no license'
+
+
+@pytest.fixture
+def fast_watch(monkeypatch):
+    monkeypatch.setattr(subprocess_functions, 'WATCH_INTERVAL', 0.1)
+    monkeypatch.setattr(subprocess_functions, 'KILL_GRACE', 1.0)
+
+
+def group_is_gone(pid_file):
+    try:
+        with open(f'/proc/{int(pid_file.read_text())}/stat') as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] == 'Z'  # killed, not reaped by the init of the container
+    except FileNotFoundError:
+        return True
+
+
+def test_wall_time_kills_the_process_group(stage_dir, fast_watch):
+    start = time.monotonic()
+    with command_limits(wall_time_s=1):
+        with pytest.raises(subprocess.TimeoutExpired) as error:
+            run_command("echo started; sleep 60 & echo $! > child.pid; wait", use_shell=True)
+    assert time.monotonic() - start < 10
+    assert not isinstance(error.value, CommandStalled)
+    assert error.value.output == 'started'
+    time.sleep(0.2)
+    assert group_is_gone(stage_dir / 'child.pid')
+
+
+def test_inactivity_is_detected(stage_dir, fast_watch):
+    with command_limits(inactivity_s=0.5):
+        with pytest.raises(CommandStalled):
+            run_command("sleep 60", use_shell=True)
+
+
+def test_file_modifications_count_as_activity(stage_dir, fast_watch):
+    with command_limits(inactivity_s=1):
+        run_command("for i in $(seq 8); do sleep 0.25; touch progress; done", use_shell=True)
+
+
+def test_concurrent_commands(stage_dir, fast_watch):
+    start = time.monotonic()
+    results = run_commands([f"{sys.executable} -c \"import time; time.sleep(1); print({i})\"" for i in range(3)])
+    assert time.monotonic() - start < 2.5
+    assert [result.stdout for result in results] == ['0', '1', '2']
+
+
+def test_failed_concurrent_command_terminates_the_others(stage_dir, fast_watch):
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        run_commands(["sleep 60 & echo $! > child.pid; wait", "sleep 0.5; exit 1"], use_shell=True)
+    assert time.monotonic() - start < 10
+    time.sleep(0.2)
+    assert group_is_gone(stage_dir / 'child.pid')
+
+
+def test_limit_errors():
+    stages = ['QuantumPatch', 'lightforge']
+    assert limit_errors({}, stages) == []
+    assert limit_errors({'lightforge': {'wall_time_s': 3600, 'inactivity_s': None}}, stages) == []
+    errors = limit_errors({'lightfroge': {'wall_time_s': 10},
+                           'QuantumPatch': {'wall_time': 10, 'inactivity_s': '1h'},
+                           'lightforge': 60}, stages)
+    assert len(errors) == 4
+    assert "unknown stage 'lightfroge'" in errors[0]
+    assert "unknown limit 'wall_time'" in errors[1]
+    assert 'limits.QuantumPatch.inactivity_s' in errors[2]
+    assert 'limits.lightforge must be a mapping' in errors[3]
+    assert limit_errors({'lightforge': {'wall_time_s': True}}, stages)
+    assert limit_errors(['lightforge'], stages) == ['limits must be a mapping, not list']
@@ -0,0 +1,92 @@
+import os
+import pathlib
+import pickle
+
+import pytest
+
+from diadem_image_template.opt.utils import file_index, template_bundle
+from diadem_image_template.opt.utils.template_bundle import BUNDLE_FILE, TemplateBundle, TemplateBundleError, \
+    build_bundle, write_bundle
+
+TMPL = pathlib.Path(__file__).resolve().parents[2] / 'diadem_image_template' / 'opt' / 'tmpl'
+
+
+@pytest.fixture
+def tmpl_dir(tmp_path):
+    files = {
+        'Deposit/deposit_cargs.yml': 'machineparams: {ncpu: 1}\n',
+        'Deposit/files.txt': 'structure.cml\nDensityAnalysis.out\n',
+        'Deposit/operationFiles/debugFiles': 'Analysis/**\n*.out\n',
+        'Deposit/deposit_init.sh': '#!/bin/bash\n',
+        'lightforge_hole/settings': 'pars: {Temperature: 300}\n',
+    }
+    for name, content in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return tmp_path
+
+
+def test_bundle_of_the_image_templates(tmp_path):
+    output = tmp_path / BUNDLE_FILE
+    write_bundle(TMPL, output)
+    with open(output, 'rb') as infile:
+        bundle = TemplateBundle(pickle.load(infile), str(output))
+    from_folder = TemplateBundle.load(TMPL)
+    assert bundle.source_hash == from_folder.source_hash
+    for name in ['QuantumPatch/settings_ng.yml', 'Deposit/result.yml', 'lightforge_hole/settings']:
+        assert bundle.document(name) == from_folder.document(name)
+    assert bundle.lines('QuantumPatch/required_files.txt') == ['QP_output_0.zip']
+
+
+def test_load_prefers_the_bundle(tmpl_dir, monkeypatch):
+    write_bundle(tmpl_dir)
+    monkeypatch.setattr(template_bundle, 'build_bundle', None)  # the templates are not parsed again
+    monkeypatch.setattr(pathlib.Path, 'read_text', None)  # nor read
+    templates = TemplateBundle.load(tmpl_dir)
+    assert templates.origin == str(tmpl_dir / BUNDLE_FILE)
+    assert templates.lines('Deposit/files.txt') == ['structure.cml', 'DensityAnalysis.out']
+    assert templates.lines('xtb/files.txt') == []
+    assert 'Deposit/deposit_init.sh' in templates
+
+
+def test_bundle_of_changed_templates_is_ignored(tmpl_dir):
+    write_bundle(tmpl_dir)
+    (tmpl_dir / 'Deposit' / 'files.txt').write_text('changed after the build\n')
+    templates = TemplateBundle.load(tmpl_dir)
+    assert templates.origin == str(tmpl_dir)
+    assert templates.lines('Deposit/files.txt') == ['changed after the build']
+
+    write_bundle(tmpl_dir)
+    os.utime(tmpl_dir / 'Deposit' / 'deposit_init.sh', ns=(0, 0))  # same size, touched
+    assert TemplateBundle.load(tmpl_dir).origin == str(tmpl_dir)
+
+
+def test_bundle_of_another_format_is_ignored(tmpl_dir):
+    with open(tmpl_dir / BUNDLE_FILE, 'wb') as outfile:
+        pickle.dump({'format': 0}, outfile)
+    templates = TemplateBundle.load(tmpl_dir)
+    assert templates.origin == str(tmpl_dir)
+    assert templates.document('Deposit/deposit_cargs.yml') == {'machineparams': {'ncpu': 1}}
+
+
+def test_documents_are_copies(tmpl_dir):
+    templates = TemplateBundle.load(tmpl_dir)
+    templates.document('lightforge_hole/settings')['pars']['Temperature'] = 0
+    assert templates.document('lightforge_hole/settings') == {'pars': {'Temperature': 300}}
+    with pytest.raises(ValueError):
+        templates.document('Deposit/files.txt')
+
+
+def test_patterns_are_translated_at_build_time(tmpl_dir):
+    bundle = build_bundle(tmpl_dir)
+    assert bundle['patterns'][('Analysis/**', True)] == file_index.translate_pattern('Analysis/**', True)
+    assert ('structure.cml', False) not in bundle['patterns']
+
+
+def test_invalid_templates_fail_the_build(tmpl_dir):
+    (tmpl_dir / 'Deposit' / 'deposit_cargs.yml').write_text('machineparams: {ncpu: 1\n')
+    (tmpl_dir / 'lightforge_hole' / 'settings').write_text('pars: [\n')
+    with pytest.raises(TemplateBundleError) as error:
+        build_bundle(tmpl_dir)
+    assert set(error.value.errors) == {'Deposit/deposit_cargs.yml', 'lightforge_hole/settings'}
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from diadem_image_template.opt.utils.tools import MissingToolsError, ToolRegistry
+
+
+@pytest.fixture
+def tool_dir(tmp_path, monkeypatch):
+    for name in ['xtb', 'add_dihedral_angles.sh', 'README']:
+        path = tmp_path / name
+        path.write_text('#!/bin/sh\n')
+        if name != 'README':
+            path.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path))
+    monkeypatch.setenv('DEPTOOLS', str(tmp_path))
+    return tmp_path
+
+
+def test_preflight_resolves_executables_and_scripts(tool_dir):
+    registry = ToolRegistry()
+    paths = registry.preflight(['xtb', '$DEPTOOLS/add_dihedral_angles.sh', 'xtb'])
+    assert paths == {'xtb': str(tool_dir / 'xtb'),
+                     '$DEPTOOLS/add_dihedral_angles.sh': str(tool_dir / 'add_dihedral_angles.sh')}
+
+
+def test_preflight_reports_everything_missing(tool_dir, monkeypatch):
+    monkeypatch.delenv('DEPTOOLS')
+    monkeypatch.setenv('SCRIPTS', str(tool_dir))
+    with pytest.raises(MissingToolsError) as error:
+        ToolRegistry().preflight(['xtb', 'QuantumPatch', '$DEPTOOLS/add_periodic_copies.py', '$SCRIPTS/README',
+                                  '$SCRIPTS/missing.sh'])
+    assert error.value.missing == {
+        'QuantumPatch': 'not found on the PATH',
+        '$DEPTOOLS/add_periodic_copies.py': 'environment variable DEPTOOLS is not set',
+        '$SCRIPTS/README': f'{tool_dir}/README is not executable',
+        '$SCRIPTS/missing.sh': f'{tool_dir}/missing.sh does not exist',
+    }
+    assert 'QuantumPatch: not found on the PATH' in str(error.value)
+
+
+def test_paths_are_cached(tool_dir):
+    registry = ToolRegistry()
+    registry.preflight(['xtb'])
+    os.remove(tool_dir / 'xtb')
+    assert registry.path('xtb') == str(tool_dir / 'xtb')
+    with pytest.raises(FileNotFoundError):
+        registry.path('lightforge')
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+import yaml
+
+from diadem_image_template.opt.utils import yaml_io
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    yaml_io.clear_cache()
+
+
+def test_documents_match_pyyaml(tmp_path):
+    document = {'machineparams': {'ncpu': 4}, 'pars': [{'Temperature': 300.0, 'name': 'a: b'}], 'on': 'yes'}
+    path = tmp_path / 'settings.yml'
+    yaml_io.save(document, path)
+    assert path.read_text() == yaml.safe_dump(document)
+    assert yaml_io.load(path) == yaml.safe_load(path.read_text()) == document
+
+
+def test_load_returns_copies_and_follows_changes(tmp_path):
+    path = tmp_path / 'settings.yml'
+    path.write_text('pars: {Temperature: 300}\n')
+    first = yaml_io.load(path)
+    first['pars']['Temperature'] = 0
+    assert yaml_io.load(path) == {'pars': {'Temperature': 300}}
+
+    path.write_text('pars: {Temperature: 250, fields: 3}\n')  # written by another program
+    assert yaml_io.load(path) == {'pars': {'Temperature': 250, 'fields': 3}}
+
+
+def test_cached_documents_are_not_parsed_again(tmp_path, monkeypatch):
+    path = tmp_path / 'deposit_cargs.yml'
+    yaml_io.save({'machineparams': {'ncpu': 1}}, path)
+    parsed = []
+    monkeypatch.setattr(yaml_io, 'loads', lambda stream: parsed.append(stream))
+    assert yaml_io.load(path) == {'machineparams': {'ncpu': 1}}
+    assert parsed == []
+
+
+def test_relative_paths_are_cached_by_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(yaml_io, '_stat_key', lambda path: (0, 0, 0))  # same stat key, e.g. a reused inode
+    for name, ncpu in (('hole', 1), ('electron', 2)):
+        (tmp_path / name).mkdir()
+        monkeypatch.chdir(tmp_path / name)
+        yaml_io.save({'ncpu': ncpu}, 'settings')
+    monkeypatch.chdir(tmp_path / 'hole')
+    assert yaml_io.load('settings') == {'ncpu': 1}
+    monkeypatch.chdir(tmp_path / 'electron')
+    assert yaml_io.load('settings') == {'ncpu': 2}
+
+
+def test_edit_writes_once(tmp_path):
+    path = tmp_path / 'deposit_cargs.yml'
+    path.write_text('machineparams: {ncpu: 1}\nsimparams: {Nmol: 100}\n')
+    with yaml_io.edit(path) as cargs:
+        cargs['machineparams']['ncpu'] = 8
+        cargs['simparams']['Nmol'] = 1000
+    assert yaml.safe_load(path.read_text()) == {'machineparams': {'ncpu': 8}, 'simparams': {'Nmol': 1000}}
+
+    mtime_ns = os.stat(path).st_mtime_ns
+    with pytest.raises(KeyError):
+        with yaml_io.edit(path) as cargs:
+            cargs['machineparams']['ncpu'] = 2
+            cargs['missing']
+    assert os.stat(path).st_mtime_ns == mtime_ns
+    assert yaml_io.load(path)['machineparams']['ncpu'] == 8
+
+
+def test_unsafe_dump_for_results(tmp_path):
+    path = tmp_path / 'result.yml'
+    yaml_io.save({'mobility': (1, 2)}, path, safe=False)
+    assert path.read_text() == yaml.dump({'mobility': (1, 2)})